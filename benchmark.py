@@ -0,0 +1,458 @@
+""" latency / throughput benchmark of recognition models with per-stage breakdown """
+import os
+import copy
+import json
+import time
+import string
+import argparse
+import itertools
+import subprocess
+from functools import partial
+
+import torch
+import torch.backends.cudnn as cudnn
+import torch.nn.functional as F
+import numpy as np
+
+from utils import CTCLabelConverter, AttnLabelConverter, TransformerLabelConverter
+from dataset import hierarchical_dataset, AlignCollate, lmdb_worker_init_fn
+from model import Model
+from test import validation
+from modules.stage_profiler import StageProfiler
+from modules.transformer_component.Block import get_position_ids
+import modules.transformer_component.Constants as Constants
+from train import transformer_loss
+
+
+def synchronize(device):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize(device)
+
+
+def summarize(samples, batch_size):
+    """ statistics of a list of per-iteration times in seconds, reported in milliseconds """
+    samples = np.array(samples) * 1000
+    return {'mean_ms': float(samples.mean()),
+            'p50_ms': float(np.percentile(samples, 50)),
+            'p90_ms': float(np.percentile(samples, 90)),
+            'p99_ms': float(np.percentile(samples, 99)),
+            'images_per_sec': float(batch_size / samples.mean() * 1000)}
+
+
+def build_model(opt, device):
+    if 'Transformer' in opt.SequenceModeling:
+        converter = TransformerLabelConverter(opt.character, device=device)
+    elif 'CTC' in opt.Prediction:
+        converter = CTCLabelConverter(opt.character)
+    else:
+        converter = AttnLabelConverter(opt.character, device=device)
+    opt.num_class = len(converter.character)
+
+    model = Model(opt)
+    if opt.saved_model != '':
+        checkpoint = torch.load(opt.saved_model, map_location='cpu')
+        if type(checkpoint) == dict:
+            checkpoint = checkpoint['state_dict']
+        model.load_state_dict(checkpoint)
+    model = model.to(device)
+    model.eval()
+    if opt.fold_bn:
+        model.fold_bn()
+    return model, converter
+
+
+def run_model(model, converter, image, opt):
+    """ forward pass for max length prediction, like validation() """
+    batch_size = image.size(0)
+    text_for_pred = torch.zeros(batch_size, opt.batch_max_length + 1, dtype=torch.long, device=image.device)
+    if 'Transformer' in opt.SequenceModeling:
+        text_pos = get_position_ids(batch_size, opt.batch_max_length + 1, image.device)
+        preds = model(image, text_for_pred, is_train=False, tgt_pos=text_pos)
+    else:
+        preds = model(image, text_for_pred, is_train=False)
+    return preds
+
+
+def decode(preds, converter, opt):
+    batch_size = preds.size(0)
+    _, preds_index = preds.max(2)
+    if 'CTC' in opt.Prediction and 'Transformer' not in opt.SequenceModeling:
+        preds_size = torch.IntTensor([preds.size(1)] * batch_size)
+        return converter.decode(preds_index.view(-1).cpu(), preds_size)
+    length_for_pred = torch.IntTensor([opt.batch_max_length] * batch_size)
+    return converter.decode(preds_index.cpu(), length_for_pred)
+
+
+def evaluate(model, converter, opt, device):
+    """ accuracy on opt.eval_data, to weigh the decoding modes against their latency """
+    if 'Transformer' in opt.SequenceModeling:
+        criterion = torch.nn.CrossEntropyLoss(ignore_index=2).to(device)
+    elif 'CTC' in opt.Prediction:
+        criterion = torch.nn.CTCLoss(zero_infinity=True).to(device)
+    else:
+        criterion = torch.nn.CrossEntropyLoss(ignore_index=0).to(device)
+    eval_data = hierarchical_dataset(root=opt.eval_data, opt=opt)
+    evaluation_loader = torch.utils.data.DataLoader(
+        eval_data, batch_size=opt.batch_size, shuffle=False, num_workers=int(opt.workers),
+        worker_init_fn=lmdb_worker_init_fn,
+        collate_fn=AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD,
+                               variable_width=opt.variable_width), pin_memory=True)
+    _, accuracy, norm_ED, _, _, infer_time, length_of_data = validation(
+        model, criterion, evaluation_loader, converter, opt)
+    return {'accuracy': accuracy, 'norm_ED': norm_ED, 'ms_per_image': infer_time / length_of_data * 1000}
+
+
+def benchmark_config(opt, device):
+    """ warmup, then time end-to-end latency and the per-stage breakdown of one configuration """
+    model, converter = build_model(opt, device)
+    image = torch.rand(opt.batch_size, opt.input_channel, opt.imgH, opt.imgW, device=device).sub_(0.5).div_(0.5)
+
+    with torch.no_grad():
+        for _ in range(opt.warmup):
+            decode(run_model(model, converter, image, opt), converter, opt)
+        synchronize(device)
+
+        # end-to-end
+        e2e, forward = [], []
+        for _ in range(opt.num_iter):
+            start_time = time.perf_counter()
+            preds = run_model(model, converter, image, opt)
+            synchronize(device)
+            forward_time = time.perf_counter() - start_time
+            decode(preds, converter, opt)
+            e2e.append(time.perf_counter() - start_time)
+            forward.append(forward_time)
+
+        # per-stage breakdown
+        model.profiler = StageProfiler(use_cuda=device.startswith('cuda'))
+        decode_times = []
+        for _ in range(opt.num_iter):
+            preds = run_model(model, converter, image, opt)
+            synchronize(device)
+            start_time = time.perf_counter()
+            decode(preds, converter, opt)
+            decode_times.append(time.perf_counter() - start_time)
+        stages = {stage: stat['device'] for stage, stat in model.profiler.stats().items()}
+        stages['Decode'] = decode_times
+        model.profiler = None
+
+    result = {'end_to_end': summarize(e2e, opt.batch_size),
+              'forward': summarize(forward, opt.batch_size),
+              'stages': {stage: summarize(times, opt.batch_size) for stage, times in stages.items()}}
+    if opt.eval_data and device.startswith('cuda'):  # validation() copies the images to cuda
+        result['evaluation'] = evaluate(model, converter, opt, device)
+    return result
+
+
+def train_step(model, criterion, optimizer, image, text, length, text_pos, opt):
+    """ one optimization step, like the loop in train.py """
+    if 'Transformer' in opt.SequenceModeling:
+        preds = model(image, text, tgt_pos=text_pos)
+        target = text[:, 1:]
+        if opt.decode_mode == 'parallel':
+            preds, target = preds
+        cost = criterion(preds.view(-1, preds.shape[-1]), target.contiguous().view(-1))
+    elif 'CTC' in opt.Prediction:
+        preds = model(image, text).log_softmax(2)
+        preds_size = torch.IntTensor([preds.size(1)] * image.size(0))
+        cost = criterion(preds.permute(1, 0, 2), text, preds_size, length)
+    else:
+        preds = model(image, text)
+        cost = criterion(preds.view(-1, preds.shape[-1]), text[:, 1:].contiguous().view(-1))
+    model.zero_grad()
+    cost.backward()
+    torch.nn.utils.clip_grad_norm_(model.parameters(), 5)
+    optimizer.step()
+
+
+def benchmark_train(opt, device):
+    """ training iterations per second on random images and labels """
+    model, converter = build_model(opt, device)
+    model.train()
+    if opt.checkpoint_layers > 0 and opt.SequenceModeling == 'Transformer':
+        model.SequenceModeling.set_checkpoint_layers(opt.checkpoint_layers)
+    image = torch.rand(opt.batch_size, opt.input_channel, opt.imgH, opt.imgW, device=device).sub_(0.5).div_(0.5)
+    rng = np.random.RandomState(0)
+    labels = [''.join(rng.choice(list(opt.character), rng.randint(1, opt.batch_max_length + 1)))
+              for _ in range(opt.batch_size)]
+    text_pos = None
+    if 'Transformer' in opt.SequenceModeling:
+        text, length, text_pos = converter.encode(labels, opt.batch_max_length)
+        criterion = torch.nn.CrossEntropyLoss(ignore_index=2)
+    elif 'CTC' in opt.Prediction:
+        text, length = converter.encode(labels)
+        criterion = torch.nn.CTCLoss(zero_infinity=True)
+    else:
+        text, length = converter.encode(labels, opt.batch_max_length)
+        criterion = torch.nn.CrossEntropyLoss(ignore_index=0)
+    optimizer = torch.optim.Adadelta(model.parameters(), lr=1)
+
+    def run():
+        for _ in range(opt.warmup):
+            train_step(model, criterion, optimizer, image, text, length, text_pos, opt)
+        synchronize(device)
+        if device.startswith('cuda'):
+            torch.cuda.reset_peak_memory_stats(device)
+        times = []
+        for _ in range(opt.num_iter):
+            start_time = time.perf_counter()
+            train_step(model, criterion, optimizer, image, text, length, text_pos, opt)
+            synchronize(device)
+            times.append(time.perf_counter() - start_time)
+        result = summarize(times, opt.batch_size)
+        result['iters_per_sec'] = 1000 / result['mean_ms']
+        if device.startswith('cuda'):
+            result['peak_memory_mib'] = torch.cuda.max_memory_allocated(device) / 2**20
+        return result
+
+    result = {'train': run()}
+    if opt.Prediction == 'Attn':
+        # the per step reference path, to compare against the teacher forced fast path
+        model.Prediction.fast_train = False
+        result['train_stepwise'] = run()
+    return result
+
+
+def dense_smoothed_loss(pred, gold, eps=0.1):
+    """ the label smoothed loss through a dense smoothed one-hot, as before the fused transformer_loss """
+    gold = gold.contiguous().view(-1)
+    n_class = pred.size(1)
+    one_hot = torch.zeros_like(pred).scatter(1, gold.view(-1, 1), 1)
+    one_hot = one_hot * (1 - eps) + (1 - one_hot) * eps / (n_class - 1)
+    log_prb = F.log_softmax(pred, dim=1)
+    loss = -(one_hot * log_prb).sum(dim=1)
+    return loss.masked_select(gold.ne(Constants.PAD)).mean()
+
+
+def benchmark_loss(opt, device):
+    """ forward + backward time and memory of the label smoothed Transformer loss, dense one-hot against fused,
+    on random logits for batch_size random labels """
+    converter = TransformerLabelConverter(opt.character, device=device)
+    rng = np.random.RandomState(0)
+    labels = [''.join(rng.choice(list(opt.character), rng.randint(1, opt.batch_max_length + 1)))
+              for _ in range(opt.batch_size)]
+    text, _, _ = converter.encode(labels, opt.batch_max_length)
+    gold = text[:, 1:].contiguous().view(-1)
+    torch.manual_seed(0)
+    logits = torch.randn(gold.size(0), len(converter.character), device=device)
+
+    def step(criterion):
+        pred = logits.detach().requires_grad_()
+        loss = criterion(pred, gold)
+        loss.backward()
+        return loss.detach(), pred.grad
+
+    def run(criterion):
+        for _ in range(opt.warmup):
+            step(criterion)
+        synchronize(device)
+        times = []
+        for _ in range(opt.num_iter):
+            start_time = time.perf_counter()
+            step(criterion)
+            synchronize(device)
+            times.append(time.perf_counter() - start_time)
+        result = summarize(times, opt.batch_size)
+        if device.startswith('cuda'):
+            memory_start = torch.cuda.memory_allocated(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            step(criterion)
+            result['peak_memory_mib'] = (torch.cuda.max_memory_allocated(device) - memory_start) / 2**20
+        else:
+            # the memory allocated by the ops, as the caching allocator stats are cuda only
+            with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+                step(criterion)
+            result['allocated_mib'] = sum(max(event.self_cpu_memory_usage, 0) for event in prof.key_averages()) / 2**20
+        return result
+
+    criteria = {'dense': dense_smoothed_loss, 'fused': partial(transformer_loss, smoothing=True)}
+    result = {f'loss_{name}': run(criterion) for name, criterion in criteria.items()}
+    (dense_loss, dense_grad), (fused_loss, fused_grad) = [step(criterion) for criterion in criteria.values()]
+    result['max_loss_diff'] = (dense_loss - fused_loss).abs().item()
+    result['max_grad_diff'] = (dense_grad - fused_grad).abs().max().item()
+    return result
+
+
+def benchmark_loader(opt, root):
+    """ samples per second of the training input pipeline over root, LMDB or create_array_dataset.py arrays """
+    dataset = hierarchical_dataset(root=root, opt=opt)
+    data_loader = torch.utils.data.DataLoader(
+        dataset, batch_size=opt.batch_size, shuffle=True, num_workers=int(opt.workers),
+        worker_init_fn=lmdb_worker_init_fn,
+        collate_fn=AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD,
+                               variable_width=opt.variable_width), pin_memory=True)
+    data_iter = iter(data_loader)
+    n_batches = min(opt.warmup + opt.num_iter, len(data_loader))
+    times = []
+    n_samples = 0
+    start_time = time.perf_counter()
+    for i in range(n_batches):
+        batch = next(data_iter)
+        if i >= opt.warmup:  # the first batches include the worker start up
+            times.append(time.perf_counter() - start_time)
+            n_samples += batch[0].size(0)
+        start_time = time.perf_counter()
+    assert times, f'{root} has no batches left after --warmup {opt.warmup}'
+    return {'samples_per_sec': n_samples / sum(times), 'batch_ms': summarize(times, opt.batch_size)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(opt):
+    report = {'commit': git_commit(), 'torch': torch.__version__, 'results': []}
+    if opt.mode == 'loader':
+        for root, batch_size, imgW in itertools.product(opt.loader_data.split(','),
+                                                        [int(b) for b in opt.batch_sizes.split(',')],
+                                                        [int(w) for w in opt.widths.split(',')]):
+            config = copy.deepcopy(opt)
+            config.batch_size, config.imgW = batch_size, imgW
+            result = {'data': root, 'batch_size': batch_size, 'imgH': config.imgH, 'imgW': imgW, 'workers': opt.workers}
+            result.update(benchmark_loader(config, root))
+            print(f'{root} batch {batch_size} width {imgW}: {result["samples_per_sec"]:0.1f} samples/sec')
+            report['results'].append(result)
+        sweep = ()  # no models
+    elif opt.mode == 'loss':
+        for device, batch_size in itertools.product(opt.devices.split(','), [int(b) for b in opt.batch_sizes.split(',')]):
+            if device.startswith('cuda') and not torch.cuda.is_available():
+                print(f'skipping {device}: cuda is not available')
+                continue
+            result = {'device': device, 'batch_size': batch_size, 'num_class': len(opt.character) + 3,
+                      'batch_max_length': opt.batch_max_length}
+            config = copy.deepcopy(opt)
+            config.batch_size = batch_size
+            result.update(benchmark_loss(config, device))
+            memory = 'peak_memory_mib' if device.startswith('cuda') else 'allocated_mib'
+            print(f'{device} batch {batch_size}: ' + '\t'.join(
+                f'{path}: {stat["mean_ms"]:0.3f} ms, {stat[memory]:0.1f} MiB ({memory})'
+                for path, stat in result.items() if path.startswith('loss_')) +
+                f'\tmax grad diff {result["max_grad_diff"]:0.2e}')
+            report['results'].append(result)
+        sweep = ()  # no models
+    else:
+        devices = []
+        for device in opt.devices.split(','):
+            if device.startswith('cuda') and not torch.cuda.is_available():
+                print(f'skipping {device}: cuda is not available')
+                continue
+            devices.append(device)
+        sweep = itertools.product(devices, opt.stages.split(','), opt.decode_modes.split(','),
+                                  opt.memory_formats.split(','),
+                                  [int(b) for b in opt.batch_sizes.split(',')], [int(w) for w in opt.widths.split(',')])
+    for device, stages, decode_mode, memory_format, batch_size, imgW in sweep:
+        config = copy.deepcopy(opt)
+        config.Transformation, config.FeatureExtraction, config.SequenceModeling, config.Prediction = stages.split('-')
+        if config.SequenceModeling != 'Transformer' and decode_mode != opt.decode_modes.split(',')[0]:
+            continue  # decoding modes only apply to the Transformer
+        # parallel:N decodes in one pass followed by N refinement passes
+        config.decode_mode, _, refine_iters = decode_mode.partition(':')
+        config.refine_iters = int(refine_iters or opt.refine_iters)
+        config.channels_last = memory_format == 'channels_last'
+        config.batch_size = batch_size
+        config.imgW = imgW
+        name = f'{device} {stages} {decode_mode} {memory_format} batch {batch_size} width {imgW}'
+        result = {'device': device,
+                  'device_name': torch.cuda.get_device_name(device) if device.startswith('cuda') else 'cpu',
+                  'model': stages, 'decode_mode': config.decode_mode, 'refine_iters': config.refine_iters,
+                  'memory_format': memory_format, 'batch_size': batch_size, 'imgH': config.imgH, 'imgW': imgW}
+        try:
+            if opt.mode == 'train':
+                result.update(benchmark_train(config, device))
+                print(f'{name}: ' + '\t'.join(f'{path}: {stat["iters_per_sec"]:0.2f} it/s ({stat["mean_ms"]:0.3f} ms)'
+                                              for path, stat in result.items() if path.startswith('train')))
+            else:
+                result.update(benchmark_config(config, device))
+                e2e = result['end_to_end']
+                accuracy = f', accuracy {result["evaluation"]["accuracy"]:0.3f}' if 'evaluation' in result else ''
+                print(f'{name}: {e2e["mean_ms"]:0.3f} ms (p90 {e2e["p90_ms"]:0.3f}), '
+                      f'{e2e["images_per_sec"]:0.1f} images/sec{accuracy}\t' +
+                      '\t'.join(f'{stage}: {stat["mean_ms"]:0.3f}' for stage, stat in result['stages'].items()))
+        except Exception as e:  # configurations not supported on this device / input size.
+            print(f'{name}: failed with {e!r}')
+            result['error'] = repr(e)
+        report['results'].append(result)
+        if device.startswith('cuda'):
+            torch.cuda.empty_cache()
+
+    with open(opt.output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f'benchmark results written to {opt.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    """ Sweep """
+    parser.add_argument('--mode', type=str, default='inference',
+                        help='inference: latency per stage | train: training iterations per second | '
+                             'loader: samples per second of the input pipeline over --loader_data | '
+                             'loss: label smoothed Transformer loss, dense one-hot against fused')
+    parser.add_argument('--loader_data', type=str, default='',
+                        help='--mode loader: comma separated dataset roots, e.g. an LMDB root and its create_array_dataset.py copy')
+    parser.add_argument('--stages', type=str, default='None-VGG-BiLSTM-CTC,TPS-ResNet-BiLSTM-Attn',
+                        help='comma separated stage combinations Transformation-FeatureExtraction-SequenceModeling-Prediction')
+    parser.add_argument('--batch_sizes', type=str, default='1,32,192', help='comma separated batch sizes')
+    parser.add_argument('--widths', type=str, default='100', help='comma separated image widths')
+    parser.add_argument('--devices', type=str, default='cuda,cpu', help='comma separated devices')
+    parser.add_argument('--decode_modes', type=str, default='greedy',
+                        help='comma separated Transformer decoding modes, e.g. greedy,parallel:0,parallel:2 '
+                             '(parallel:N refines N times)')
+    parser.add_argument('--memory_formats', type=str, default='contiguous',
+                        help='comma separated memory formats of the convolutional stages: contiguous,channels_last')
+    parser.add_argument('--checkpoint_layers', type=int, default=0,
+                        help='--mode train: recompute the first N Transformer encoder and decoder layers in backward')
+    parser.add_argument('--eval_data', default='', help='optional lmdb evaluation data, adds accuracy to cuda results')
+    parser.add_argument('--workers', type=int, default=4, help='number of data loading workers for --eval_data')
+    parser.add_argument('--decode_threads', type=int, default=2, help='image decoding threads per data loading worker, 1 decodes serially')
+    parser.add_argument('--warmup', type=int, default=10, help='number of untimed warmup iterations')
+    parser.add_argument('--num_iter', type=int, default=50, help='number of timed iterations')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='where to write the json report')
+    parser.add_argument('--saved_model', default='', help='optional weights, random weights are used otherwise')
+    parser.add_argument('--fold_bn', action='store_true', help='fold batch norms for inference (RCNN)')
+    """ Data processing """
+    parser.add_argument('--batch_max_length', type=int, default=25, help='maximum-label-length')
+    parser.add_argument('--imgH', type=int, default=32, help='the height of the input image')
+    parser.add_argument('--PAD', action='store_true', help='whether to keep ratio then pad for image resize')
+    parser.add_argument('--variable_width', action='store_true',
+                        help='--loader_data / --eval_data: keep the ratio of each image up to imgW and pad per batch')
+    parser.add_argument('--rgb', action='store_true', help='use rgb input')
+    parser.add_argument('--character', type=str, default='0123456789abcdefghijklmnopqrstuvwxyz', help='character label')
+    parser.add_argument('--sensitive', action='store_true', help='for sensitive character mode')
+    """ Model Architecture """
+    parser.add_argument('--num_fiducial', type=int, default=20, help='number of fiducial points of TPS-STN')
+    parser.add_argument('--input_channel', type=int, default=1, help='the number of input channel of Feature extractor')
+    parser.add_argument('--output_channel', type=int, default=512,
+                        help='the number of output channel of Feature extractor')
+    parser.add_argument('--hidden_size', type=int, default=256, help='the size of the LSTM hidden state')
+    """ Transformer """
+    parser.add_argument('-d_word_vec', type=int, default=512)
+    parser.add_argument('-d_model', type=int, default=512)
+    parser.add_argument('-d_inner_hid', type=int, default=256)
+    parser.add_argument('-d_k', type=int, default=64)
+    parser.add_argument('-d_v', type=int, default=64)
+
+    parser.add_argument('-n_head', type=int, default=8)
+    parser.add_argument('-n_layers_enc', type=int, default=6)
+    parser.add_argument('-n_layers_dec', type=int, default=6)
+
+    parser.add_argument('-dropout', type=float, default=0.1)
+    parser.add_argument('--decode_mode', type=str, default='greedy', help='Transformer decoding: greedy | parallel')
+    parser.add_argument('--refine_iters', type=int, default=2,
+                        help='refinement passes that re-feed the predictions in parallel decoding')
+    parser.add_argument('-embs_share_weight', action='store_true')
+    parser.add_argument('-proj_share_weight', action='store_true')
+
+    opt = parser.parse_args()
+
+    """ vocab / character number configuration """
+    if opt.sensitive:
+        opt.character = string.printable[:-6]  # same with ASTER setting (use 94 char).
+    if opt.rgb:
+        opt.input_channel = 3
+
+    cudnn.benchmark = True
+    benchmark(opt)
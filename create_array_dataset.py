@@ -0,0 +1,84 @@
+""" convert LMDB datasets (create_lmdb_dataset.py) into pre-resized uint8 arrays, read by dataset.ArrayDataset """
+
+import fire
+import os
+import json
+import lmdb
+import six
+
+import numpy as np
+from PIL import Image
+
+from dataset import AlignCollate
+
+
+def convertLmdb(lmdbPath, outputPath, imgH, imgW, PAD, rgb):
+    """
+    Resize every image of one LMDB dataset once and write it into a fixed stride memmap.
+    outputPath gets
+        images.u8  : uint8 [num_samples x channels x imgH x imgW], with PAD the image fills the first width columns
+        widths.npy : resized width of every sample
+        labels.txt : one label per line
+        meta.json  : shape and resize settings
+    """
+    os.makedirs(outputPath, exist_ok=True)
+    env = lmdb.open(lmdbPath, max_readers=32, readonly=True, lock=False, readahead=False, meminit=False)
+    channels = 3 if rgb else 1
+    alignCollate = AlignCollate(imgH=imgH, imgW=imgW, keep_ratio_with_pad=PAD)
+
+    with env.begin(write=False) as txn:
+        nSamples = int(txn.get('num-samples'.encode()))
+        dedup = txn.get('num-images'.encode()) is not None
+        images = np.memmap(os.path.join(outputPath, 'images.u8'), dtype=np.uint8, mode='w+',
+                           shape=(nSamples, channels, imgH, imgW))
+        labels, widths = [], []
+        for index in range(1, nSamples + 1):  # lmdb starts with 1
+            label = txn.get('label-%09d'.encode() % index).decode('utf-8')
+            if dedup:
+                imgKey = txn.get('imagekey-%09d'.encode() % index)
+            else:
+                imgKey = 'image-%09d'.encode() % index
+            try:
+                img = Image.open(six.BytesIO(txn.get(imgKey))).convert('RGB' if rgb else 'L')
+            except IOError:
+                print(f'Corrupted image for {index}')
+                continue
+
+            width = alignCollate._resized_width(img) if PAD else imgW
+            img = np.asarray(img.resize((width, imgH), Image.BICUBIC))
+            images[len(labels), :, :, :width] = img.transpose(2, 0, 1) if rgb else img[None]
+            labels.append(label.replace('\n', ' '))
+            widths.append(width)
+
+            if len(labels) % 10000 == 0:
+                print('Converted %d / %d' % (len(labels), nSamples))
+
+    images.flush()
+    np.save(os.path.join(outputPath, 'widths.npy'), np.array(widths, dtype=np.int32))
+    with open(os.path.join(outputPath, 'labels.txt'), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(labels))
+    with open(os.path.join(outputPath, 'meta.json'), 'w') as f:
+        json.dump({'num_samples': len(labels), 'channels': channels, 'imgH': imgH, 'imgW': imgW,
+                   'keep_ratio_with_pad': PAD}, f)
+    print('Converted %s with %d samples into %s' % (lmdbPath, len(labels), outputPath))
+
+
+def createArrayDataset(inputPath, outputPath, imgH=32, imgW=100, PAD=False, rgb=False):
+    """
+    Convert every LMDB dataset under inputPath, keeping the directory structure in outputPath.
+    The result can replace inputPath as --train_data / --valid_data / --eval_data.
+    ARGS:
+        inputPath  : root of the LMDB datasets
+        outputPath : output root
+        imgH, imgW : the --imgH / --imgW used for training
+        PAD        : resize like --PAD (and --variable_width), keeping the aspect ratio
+        rgb        : store RGB instead of grayscale images, like --rgb
+    """
+    for dirpath, dirnames, filenames in os.walk(inputPath):
+        if not dirnames and 'data.mdb' in filenames:
+            convertLmdb(dirpath, os.path.join(outputPath, os.path.relpath(dirpath, inputPath)),
+                        imgH, imgW, PAD, rgb)
+
+
+if __name__ == '__main__':
+    fire.Fire(createArrayDataset)
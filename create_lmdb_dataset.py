@@ -2,6 +2,7 @@
 
 import fire
 import os
+import hashlib
 import lmdb
 import cv2
 
@@ -25,7 +26,7 @@ def writeCache(env, cache):
             txn.put(k, v)
 
 
-def createDataset(inputPath, gtFile, outputPath, checkValid=True):
+def createDataset(inputPath, gtFile, outputPath, checkValid=True, dedup=True):
     """
     Create LMDB dataset for training and evaluation.
     ARGS:
@@ -33,11 +34,15 @@ def createDataset(inputPath, gtFile, outputPath, checkValid=True):
         outputPath : LMDB output path
         gtFile     : list of image path and label
         checkValid : if true, check the validity of every image
+        dedup      : if true, store every distinct image once under image-<sha1 of its bytes>,
+                     imagekey-%09d holds the key of the image of every sample
     """
     os.makedirs(outputPath, exist_ok=True)
     env = lmdb.open(outputPath, map_size=1099511627776)
     cache = {}
     cnt = 1
+    seen = set()
+    duplicateBytes = 0
 
     with open(gtFile, 'r', encoding='utf-8') as data:
         datalist = data.readlines()
@@ -67,10 +72,19 @@ def createDataset(inputPath, gtFile, outputPath, checkValid=True):
                     log.write('%s-th image data occured error\n' % str(i))
                 continue
 
-        imageKey = 'image-%09d'.encode() % cnt
         labelKey = 'label-%09d'.encode() % cnt
-        cache[imageKey] = imageBin
         cache[labelKey] = label.encode()
+        if dedup:
+            imageKey = 'image-'.encode() + hashlib.sha1(imageBin).hexdigest().encode()
+            cache['imagekey-%09d'.encode() % cnt] = imageKey
+            if imageKey in seen:
+                duplicateBytes += len(imageBin)
+            else:
+                seen.add(imageKey)
+                cache[imageKey] = imageBin
+        else:
+            imageKey = 'image-%09d'.encode() % cnt
+            cache[imageKey] = imageBin
 
         if cnt % 1000 == 0:
             writeCache(env, cache)
@@ -79,8 +93,12 @@ def createDataset(inputPath, gtFile, outputPath, checkValid=True):
         cnt += 1
     nSamples = cnt-1
     cache['num-samples'.encode()] = str(nSamples).encode()
+    if dedup:
+        cache['num-images'.encode()] = str(len(seen)).encode()
     writeCache(env, cache)
     print('Created dataset with %d samples' % nSamples)
+    if dedup:
+        print('%d distinct images, %.1f MiB of duplicates skipped' % (len(seen), duplicateBytes / 2**20))
 
 
 if __name__ == '__main__':
@@ -1,11 +1,16 @@
 import os
 import sys
 import re
+import json
+import bisect
+import collections
 import six
 import math
 import lmdb
 import torch
+import torch.nn.functional as F
 
+from concurrent.futures import ThreadPoolExecutor
 from natsort import natsorted
 from PIL import Image
 import numpy as np
@@ -13,6 +18,8 @@ from torch.utils.data import Dataset, ConcatDataset, Subset
 from torch._utils import _accumulate
 import torchvision.transforms as transforms
 
+from utils import CTCLabelConverter
+
 
 class Batch_Balanced_Dataset(object):
 
@@ -26,9 +33,13 @@ class Batch_Balanced_Dataset(object):
         print(f'dataset_root: {opt.train_data}\nopt.select_data: {opt.select_data}\nopt.batch_ratio: {opt.batch_ratio}')
         assert len(opt.select_data) == len(opt.batch_ratio)
 
-        _AlignCollate = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD)
+        _AlignCollate = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD,
+                                     variable_width=opt.variable_width)
         self.data_loader_list = []
         self.dataloader_iter_list = []
+        self.samplers = []
+        self.batch_indices = []  # (sampler, indices, size) of every source in the last batch, with --hard_sampling
+        self.pending_losses = []
         batch_size_list = []
         Total_batch_size = 0
         for selected_d, batch_ratio_d in zip(opt.select_data, opt.batch_ratio):
@@ -52,11 +63,33 @@ class Batch_Balanced_Dataset(object):
             batch_size_list.append(str(_batch_size))
             Total_batch_size += _batch_size
 
-            _data_loader = torch.utils.data.DataLoader(
-                _dataset, batch_size=_batch_size,
-                shuffle=True,
-                num_workers=int(opt.workers),
-                collate_fn=_AlignCollate, pin_memory=True)
+            if opt.token_budget > 0 or opt.curriculum_iters > 0:
+                assert not opt.hard_sampling, '--hard_sampling does not combine with --token_budget / --curriculum_iters'
+                label_lengths, widths = length_index(_dataset)
+                _sampler = TokenBudgetBatchSampler(
+                    label_lengths, widths if opt.variable_width else None, _batch_size,
+                    token_budget=int(opt.token_budget * float(batch_ratio_d)), imgW=opt.imgW,
+                    batch_max_length=opt.batch_max_length, seed=opt.manualSeed + len(self.samplers))
+                _data_loader = torch.utils.data.DataLoader(
+                    _dataset, batch_sampler=_sampler,
+                    num_workers=int(opt.workers), worker_init_fn=lmdb_worker_init_fn,
+                    collate_fn=_AlignCollate, pin_memory=True)
+            elif opt.hard_sampling:
+                # every source keeps its share of the batch, samples are drawn by loss within the source
+                _sampler = HardExampleSampler(len(_dataset), _batch_size, alpha=opt.hard_alpha,
+                                              uniform_ratio=opt.hard_uniform, seed=opt.manualSeed + len(self.samplers))
+                _data_loader = torch.utils.data.DataLoader(
+                    _dataset, batch_sampler=_sampler,
+                    num_workers=int(opt.workers), worker_init_fn=lmdb_worker_init_fn,
+                    collate_fn=_AlignCollate, pin_memory=True)
+            else:
+                _sampler = None
+                _data_loader = torch.utils.data.DataLoader(
+                    _dataset, batch_size=_batch_size,
+                    shuffle=True,
+                    num_workers=int(opt.workers), worker_init_fn=lmdb_worker_init_fn,
+                    collate_fn=_AlignCollate, pin_memory=True)
+            self.samplers.append(_sampler)
             self.data_loader_list.append(_data_loader)
             self.dataloader_iter_list.append(iter(_data_loader))
         print('-' * 80)
@@ -65,26 +98,237 @@ class Batch_Balanced_Dataset(object):
         print('-' * 80)
 
     def get_batch(self):
+        """ (images, texts), or (images, texts, widths) with variable_width or PAD """
         balanced_batch_images = []
         balanced_batch_texts = []
+        balanced_batch_widths = []
+        self.batch_indices = []
 
         for i, data_loader_iter in enumerate(self.dataloader_iter_list):
             try:
-                image, text = data_loader_iter.next()
-                balanced_batch_images.append(image)
-                balanced_batch_texts += text
+                batch = next(data_loader_iter)
             except StopIteration:
                 self.dataloader_iter_list[i] = iter(self.data_loader_list[i])
-                image, text = self.dataloader_iter_list[i].next()
-                balanced_batch_images.append(image)
-                balanced_batch_texts += text
+                batch = next(self.dataloader_iter_list[i])
             except ValueError:
-                pass
+                continue
+            if isinstance(self.samplers[i], HardExampleSampler):
+                indices = self.samplers[i].pop_batch(batch[0].size(0))
+                self.batch_indices.append((self.samplers[i], indices, batch[0].size(0)))
+            balanced_batch_images.append(batch[0])
+            balanced_batch_texts += batch[1]
+            balanced_batch_widths += batch[2:]
+
+        if balanced_batch_widths:
+            # every source is padded to its own widest image, bring them to a common width.
+            batch_w = max(image.size(3) for image in balanced_batch_images)
+            balanced_batch_images = [F.pad(image, (0, batch_w - image.size(3), 0, 0), mode='replicate')
+                                     for image in balanced_batch_images]
+            balanced_batch_images = torch.cat(balanced_batch_images, 0)
+            return balanced_batch_images, balanced_batch_texts, torch.cat(balanced_batch_widths, 0)
 
         balanced_batch_images = torch.cat(balanced_batch_images, 0)
 
         return balanced_batch_images, balanced_batch_texts
 
+    def update_losses(self, sample_losses):
+        """
+        Report the per-sample losses of the last get_batch to the --hard_sampling samplers.
+        The (GPU) losses are only read at the next call, so that it does not wait for the step.
+        """
+        if not self.batch_indices:
+            return
+        for batch_indices, losses in self.pending_losses:
+            losses = losses.float().cpu().numpy()
+            offset = 0
+            for sampler, indices, size in batch_indices:
+                if indices is not None:
+                    sampler.update(indices, losses[offset:offset + size])
+                offset += size
+        self.pending_losses = [(self.batch_indices, sample_losses.detach())]
+
+    def set_max_length(self, max_length):
+        """ only sample labels up to max_length from now on (--curriculum_iters) """
+        for sampler in self.samplers:
+            if isinstance(sampler, TokenBudgetBatchSampler):
+                sampler.max_length = max_length
+
+    def state_dict(self):
+        return [sampler.state_dict() if isinstance(sampler, HardExampleSampler) else None for sampler in self.samplers]
+
+    def load_state_dict(self, state_dict):
+        for i, (sampler, state) in enumerate(zip(self.samplers, state_dict)):
+            if isinstance(sampler, HardExampleSampler) and state is not None:
+                sampler.load_state_dict(state)
+                # drop the batches prefetched with the initial priorities
+                self.dataloader_iter_list[i] = iter(self.data_loader_list[i])
+
+
+class SumTree(object):
+
+    def __init__(self, size, value=1.0):
+        """ array-backed binary tree of priorities, every node is the sum of its children, the leaves are the samples """
+        self.size = size
+        self.capacity = 1 << max(size - 1, 1).bit_length()
+        self.tree = np.zeros(2 * self.capacity)
+        self.tree[self.capacity:self.capacity + size] = value
+        level = self.capacity // 2
+        while level >= 1:
+            self.tree[level:2 * level] = self.tree[2 * level:4 * level:2] + self.tree[2 * level + 1:4 * level:2]
+            level //= 2
+
+    def total(self):
+        return self.tree[1]
+
+    def update(self, indices, values):
+        """ set the priorities of indices, then recompute their ancestors level by level """
+        nodes = np.asarray(indices, dtype=np.int64) + self.capacity
+        self.tree[nodes] = values
+        while nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """ leaves where the cumulative sums reach values (in [0, total)), all values descend together """
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        while nodes[0] < self.capacity:
+            left = self.tree[2 * nodes]
+            right = values >= left
+            values -= left * right
+            nodes = 2 * nodes + right
+        return np.minimum(nodes - self.capacity, self.size - 1)
+
+
+class HardExampleSampler(object):
+
+    def __init__(self, dataset_size, batch_size, alpha=1.0, uniform_ratio=0.2, init_loss=1.0, seed=0):
+        """
+        Batch sampler drawing samples with a probability proportional to loss ** alpha of their most recent loss,
+        kept in a float32 array and a SumTree over the priorities. uniform_ratio of every batch is drawn
+        uniformly so that every sample keeps being revisited, unseen samples count as init_loss.
+        The indices of the yielded batches are queued until pop_batch, as the DataLoader prefetches them.
+        """
+        self.dataset_size = dataset_size
+        self.batch_size = batch_size
+        self.alpha = alpha
+        self.num_uniform = int(round(batch_size * uniform_ratio))
+        self.init_loss = init_loss
+        self.losses = np.full(dataset_size, np.nan, dtype=np.float32)
+        self.tree = SumTree(dataset_size, init_loss ** alpha)
+        self.rng = np.random.RandomState(seed)
+        self.issued = collections.deque()
+
+    def __len__(self):
+        return max(self.dataset_size // self.batch_size, 1)
+
+    def __iter__(self):
+        self.issued.clear()  # a new DataLoader iterator, the batches of the previous one are dropped
+        for _ in range(len(self)):
+            indices = np.concatenate([
+                self.rng.randint(self.dataset_size, size=self.num_uniform),
+                self.tree.find(self.rng.random_sample(self.batch_size - self.num_uniform) * self.tree.total())])
+            self.issued.append(indices)
+            yield indices.tolist()
+
+    def pop_batch(self, batch_size):
+        """ indices of the next batch delivered by the DataLoader, None if samples were dropped from it """
+        indices = self.issued.popleft()
+        return indices if len(indices) == batch_size else None
+
+    def update(self, indices, losses):
+        self.losses[indices] = losses
+        self.tree.update(indices, np.maximum(losses, 1e-6) ** self.alpha)
+
+    def state_dict(self):
+        return {'losses': self.losses, 'rng': self.rng.get_state()}
+
+    def load_state_dict(self, state_dict):
+        self.losses = state_dict['losses']
+        self.rng.set_state(state_dict['rng'])
+        priorities = np.where(np.isnan(self.losses), self.init_loss, np.maximum(self.losses, 1e-6)) ** self.alpha
+        self.tree = SumTree(self.dataset_size)
+        self.tree.update(np.arange(self.dataset_size), priorities)
+
+
+class TokenBudgetBatchSampler(object):
+
+    def __init__(self, label_lengths, widths, batch_size, token_budget=0, imgW=100, batch_max_length=25,
+                 pool_batches=100, seed=0):
+        """
+        Batch sampler for the length index of a dataset (see length_index), with batches sized by a token budget.
+        A batch costs its size times the longest label plus the widest image, both counted in tokens:
+        label length + 1, and width / imgW * (batch_max_length + 1) (imgW when widths is None), so batches of
+        short words or narrow images are larger, and the memory and step time stay roughly constant.
+        Samples are shuffled, then sorted by cost within pools of pool_batches * batch_size samples,
+        cut into batches and the batches of a pool shuffled again.
+        token_budget 0 keeps batch_size samples per batch.
+        Labels longer than max_length are skipped, it can be raised while training (curriculum).
+        """
+        self.label_tokens = np.asarray(label_lengths, dtype=np.float32) + 1
+        if widths is not None:
+            self.width_tokens = np.asarray(widths, dtype=np.float32) / imgW * (batch_max_length + 1)
+        else:
+            self.width_tokens = np.full(len(self.label_tokens), batch_max_length + 1, dtype=np.float32)
+        self.batch_size = batch_size
+        self.token_budget = token_budget
+        self.pool_size = pool_batches * batch_size
+        self.max_length = batch_max_length
+        self.rng = np.random.RandomState(seed)
+        self.permutation = None  # of the next epoch, drawn by __len__ or __iter__
+        self.num_batches = {}  # max_length -> number of batches of self.permutation, see __len__
+
+    def _next_permutation(self):
+        if self.permutation is None:
+            self.permutation = self.rng.permutation(len(self.label_tokens))
+        return self.permutation
+
+    def __len__(self):
+        """ number of batches of the next epoch at the current max_length, cached for the epoch """
+        if self.max_length not in self.num_batches:
+            self.num_batches[self.max_length] = sum(
+                len(batches) for batches in self._pool_batches(self._next_permutation()))
+        return self.num_batches[self.max_length]
+
+    def _cut(self, pool):
+        """ consecutive batches of the pool within the token budget. The cost of the first k samples from a start,
+        k times the running maxima of their label and width tokens, only grows with k, so every batch is
+        the longest prefix within the budget (at least one sample), found by searchsorted """
+        batches, start = [], 0
+        label_tokens, width_tokens = self.label_tokens[pool], self.width_tokens[pool]
+        while start < len(pool):
+            # no batch holds more samples than fit at the cost of its first one
+            end = min(start + int(self.token_budget // (label_tokens[start] + width_tokens[start])) + 1, len(pool))
+            sizes = np.arange(1, end - start + 1)
+            costs = sizes * (np.maximum.accumulate(label_tokens[start:end]) +
+                             np.maximum.accumulate(width_tokens[start:end]))
+            size = max(int(np.searchsorted(costs, self.token_budget, side='right')), 1)
+            batches.append(pool[start:start + size])
+            start += size
+        return batches
+
+    def _pool_batches(self, permutation):
+        """ the batches of every pool of the permutation, in pool order """
+        for offset in range(0, len(permutation), self.pool_size):
+            pool = permutation[offset:offset + self.pool_size]
+            # read for every pool, so that a raised max_length applies to the next pool
+            pool = pool[self.label_tokens[pool] <= self.max_length + 1]
+            if len(pool) == 0:
+                continue
+            if self.token_budget > 0:
+                pool = pool[np.argsort(self.label_tokens[pool] + self.width_tokens[pool], kind='stable')]
+                batches = self._cut(pool)
+            else:
+                batches = [pool[start:start + self.batch_size] for start in range(0, len(pool), self.batch_size)]
+            yield batches
+
+    def __iter__(self):
+        permutation = self._next_permutation()
+        self.permutation, self.num_batches = None, {}
+        for batches in self._pool_batches(permutation):
+            for batch_index in self.rng.permutation(len(batches)):
+                yield batches[batch_index].tolist()
+
 
 def hierarchical_dataset(root, opt, select_data='/'):
     """ select_data='/' contains all sub-directory of root directory """
@@ -99,32 +343,111 @@ def hierarchical_dataset(root, opt, select_data='/'):
                     break
 
             if select_flag:
-                dataset = LmdbDataset(dirpath, opt)
+                if os.path.exists(os.path.join(dirpath, 'meta.json')):  # from create_array_dataset.py
+                    dataset = ArrayDataset(dirpath, opt)
+                else:
+                    dataset = LmdbDataset(dirpath, opt)
                 print(f'sub-directory:\t/{os.path.relpath(dirpath, root)}\t num samples: {len(dataset)}')
                 dataset_list.append(dataset)
 
-    concatenated_dataset = ConcatDataset(dataset_list)
+    concatenated_dataset = BatchConcatDataset(dataset_list)
 
     return concatenated_dataset
 
 
+class BatchConcatDataset(ConcatDataset):
+    """ ConcatDataset forwarding batched __getitems__ to the concatenated datasets """
+
+    def __getitems__(self, indices):
+        samples = [None] * len(indices)
+        groups = {}
+        for position, index in enumerate(indices):
+            dataset_idx = bisect.bisect_right(self.cumulative_sizes, index)
+            sample_idx = index - self.cumulative_sizes[dataset_idx - 1] if dataset_idx > 0 else index
+            groups.setdefault(dataset_idx, []).append((position, sample_idx))
+        for dataset_idx, group in groups.items():
+            dataset = self.datasets[dataset_idx]
+            sample_indices = [sample_idx for _, sample_idx in group]
+            if hasattr(dataset, '__getitems__'):
+                batch = dataset.__getitems__(sample_indices)
+            else:
+                batch = [dataset[sample_idx] for sample_idx in sample_indices]
+            for (position, _), sample in zip(group, batch):
+                samples[position] = sample
+        return samples
+
+
+_decode_pool = None
+
+
+def decode_map(fn, items, num_threads):
+    """ list(map(fn, items)) in a thread pool of the current process (PIL decoding releases the GIL) """
+    global _decode_pool
+    if num_threads <= 1 or len(items) <= 1:
+        return [fn(*item) for item in items]
+    if _decode_pool is None or _decode_pool[0] != os.getpid():
+        _decode_pool = (os.getpid(), ThreadPoolExecutor(num_threads))
+    return list(_decode_pool[1].map(lambda item: fn(*item), items))
+
+
+def lmdb_worker_init_fn(worker_id):
+    """ DataLoader worker_init_fn: open the lmdb environments of the worker's dataset in the worker itself """
+    datasets = [torch.utils.data.get_worker_info().dataset]
+    while datasets:
+        dataset = datasets.pop()
+        if isinstance(dataset, LmdbDataset):
+            dataset.open()
+        elif isinstance(dataset, ConcatDataset):
+            datasets += dataset.datasets
+        elif isinstance(dataset, Subset):
+            datasets.append(dataset.dataset)
+
+
+def length_index(dataset):
+    """ (label lengths, resized widths or None) of every sample of an LmdbDataset / ArrayDataset,
+    through ConcatDataset and Subset """
+    if isinstance(dataset, Subset):
+        label_lengths, widths = length_index(dataset.dataset)
+        indices = np.asarray(dataset.indices, dtype=np.int64)
+        return label_lengths[indices], widths[indices] if widths is not None else None
+    if isinstance(dataset, ConcatDataset):
+        index = [length_index(d) for d in dataset.datasets]
+        widths = [widths for _, widths in index]
+        return (np.concatenate([label_lengths for label_lengths, _ in index]),
+                np.concatenate(widths) if all(w is not None for w in widths) else None)
+    return dataset.label_lengths, dataset.sample_widths
+
+
+def normalize_label(label, opt):
+    """ the label as the model sees it: lowercased unless opt.sensitive, without the characters out of opt.character """
+    if not opt.sensitive:
+        label = label.lower()
+
+    # We only train and evaluate on alphanumerics (or pre-defined character set in train.py)
+    out_of_char = f'[^{opt.character}]'
+    return re.sub(out_of_char, '', label)
+
+
 class LmdbDataset(Dataset):
 
     def __init__(self, root, opt):
 
         self.root = root
         self.opt = opt
-        self.env = lmdb.open(root, max_readers=32, readonly=True, lock=False, readahead=False, meminit=False)
-        if not self.env:
+        env = self._open_env()
+        if not env:
             print('cannot create lmdb from %s' % (root))
             sys.exit(0)
 
-        with self.env.begin(write=False) as txn:
+        with env.begin(write=False) as txn:
             nSamples = int(txn.get('num-samples'.encode()))
             self.nSamples = nSamples
+            # deduplicated datasets (create_lmdb_dataset.py dedup=True) point every sample to its image key.
+            self.dedup = txn.get('num-images'.encode()) is not None
 
             # Filtering
             self.filtered_index_list = []
+            label_lengths = []
             for index in range(self.nSamples):
                 index += 1  # lmdb starts with 1
                 label_key = 'label-%09d'.encode() % index
@@ -136,48 +459,130 @@ class LmdbDataset(Dataset):
                     continue
 
                 self.filtered_index_list.append(index)
+                label_lengths.append(len(normalize_label(label, self.opt)))
 
             self.nSamples = len(self.filtered_index_list)
+            # label length of every sample, for TokenBudgetBatchSampler
+            self.label_lengths = np.array(label_lengths, dtype=np.int16)
+            self.sample_widths = None
+        # the environment is opened again lazily by every process reading from it, see open().
+        env.close()
+        self.env, self.txn, self.pid = None, None, None
+
+    def _open_env(self):
+        return lmdb.open(self.root, max_readers=32, readonly=True, lock=False, readahead=False, meminit=False)
+
+    def open(self):
+        """ the environment and a long-lived read-only transaction of the current process,
+        so DataLoader workers never share a forked environment and samples do not open transactions """
+        if self.pid != os.getpid():
+            self.env = self._open_env()
+            self.txn = self.env.begin(write=False)
+            self.pid = os.getpid()
+        return self.txn
+
+    def __getstate__(self):
+        # environments are per process, see open().
+        state = self.__dict__.copy()
+        state['env'], state['txn'], state['pid'] = None, None, None
+        return state
 
     def __len__(self):
         return self.nSamples
 
+    def get_many(self, keys):
+        """ values of keys, read in one sorted cursor sweep """
+        values = dict(self.open().cursor().getmulti(sorted(set(keys))))
+        return [values.get(key) for key in keys]
+
+    def fetch(self, indices):
+        """ (label, image bytes) of the samples at lmdb indices, with batched key lookups """
+        labels = self.get_many(['label-%09d'.encode() % index for index in indices])
+        if self.dedup:
+            img_keys = self.get_many(['imagekey-%09d'.encode() % index for index in indices])
+        else:
+            img_keys = ['image-%09d'.encode() % index for index in indices]
+        return [(label.decode('utf-8'), imgbuf) for label, imgbuf in zip(labels, self.get_many(img_keys))]
+
+    def decode(self, index, label, imgbuf):
+        """ (image, label) of a sample from its raw record """
+        buf = six.BytesIO()
+        buf.write(imgbuf)
+        buf.seek(0)
+        try:
+            if self.opt.rgb:
+                img = Image.open(buf).convert('RGB')  # for color image
+            else:
+                img = Image.open(buf).convert('L')
+
+        except IOError:
+            print(f'Corrupted image for {index}')
+            # make dummy image and dummy label for corrupted image.
+            if self.opt.rgb:
+                img = Image.new('RGB', (self.opt.imgW, self.opt.imgH))
+            else:
+                img = Image.new('L', (self.opt.imgW, self.opt.imgH))
+            label = '[dummy_label]'
+
+        return (img, normalize_label(label, self.opt))
+
+    def __getitems__(self, indices):
+        """ a whole batch for the DataLoader: the records are read in sorted cursor sweeps,
+        and the images decoded by opt.decode_threads threads """
+        indices = [self.filtered_index_list[index] for index in indices]
+        records = self.fetch(indices)
+        return decode_map(self.decode, [(index, label, imgbuf) for index, (label, imgbuf) in zip(indices, records)],
+                          self.opt.decode_threads)
+
     def __getitem__(self, index):
         assert index <= len(self), 'index range error'
         index = self.filtered_index_list[index]
 
-        with self.env.begin(write=False) as txn:
-            label_key = 'label-%09d'.encode() % index
-            label = txn.get(label_key).decode('utf-8')
+        txn = self.open()
+        label = txn.get('label-%09d'.encode() % index).decode('utf-8')
+        if self.dedup:
+            img_key = txn.get('imagekey-%09d'.encode() % index)
+        else:
             img_key = 'image-%09d'.encode() % index
-            imgbuf = txn.get(img_key)
+        return self.decode(index, label, txn.get(img_key))
 
-            buf = six.BytesIO()
-            buf.write(imgbuf)
-            buf.seek(0)
-            try:
-                if self.opt.rgb:
-                    img = Image.open(buf).convert('RGB')  # for color image
-                else:
-                    img = Image.open(buf).convert('L')
 
-            except IOError:
-                print(f'Corrupted image for {index}')
-                # make dummy image and dummy label for corrupted image.
-                if self.opt.rgb:
-                    img = Image.new('RGB', (self.opt.imgW, self.opt.imgH))
-                else:
-                    img = Image.new('L', (self.opt.imgW, self.opt.imgH))
-                label = '[dummy_label]'
+class ArrayDataset(Dataset):
+
+    def __init__(self, root, opt):
+        """ images already resized to imgH x imgW by create_array_dataset.py, in a fixed stride uint8 memmap.
+        __getitem__ returns (uint8 tensor [c, imgH, width], label), without any decoding. """
+        self.root = root
+        self.opt = opt
+        with open(os.path.join(root, 'meta.json')) as f:
+            self.meta = json.load(f)
+        assert (self.meta['imgH'], self.meta['imgW'], self.meta['keep_ratio_with_pad']) == \
+            (opt.imgH, opt.imgW, opt.PAD or opt.variable_width), \
+            f'{root} was converted for imgH {self.meta["imgH"]}, imgW {self.meta["imgW"]}, ' \
+            f'keep_ratio_with_pad {self.meta["keep_ratio_with_pad"]}'
+        assert self.meta['channels'] == (3 if opt.rgb else 1), f'{root} has {self.meta["channels"]} channels'
+        shape = (self.meta['num_samples'], self.meta['channels'], self.meta['imgH'], self.meta['imgW'])
+        self.images = np.memmap(os.path.join(root, 'images.u8'), dtype=np.uint8, mode='r', shape=shape)
+        self.widths = np.load(os.path.join(root, 'widths.npy'))
+        with open(os.path.join(root, 'labels.txt'), encoding='utf-8') as f:
+            self.labels = f.read().split('\n')[:shape[0]]
+
+        self.filtered_index_list = [index for index, label in enumerate(self.labels)
+                                    if len(label) <= self.opt.batch_max_length]
+        self.nSamples = len(self.filtered_index_list)
+        self.label_lengths = np.array([len(normalize_label(self.labels[index], self.opt))
+                                       for index in self.filtered_index_list], dtype=np.int16)
+        self.sample_widths = self.widths[self.filtered_index_list]
 
-            if not self.opt.sensitive:
-                label = label.lower()
+    def __len__(self):
+        return self.nSamples
 
-            # We only train and evaluate on alphanumerics (or pre-defined character set in train.py)
-            out_of_char = f'[^{self.opt.character}]'
-            label = re.sub(out_of_char, '', label)
+    def __getitem__(self, index):
+        assert index <= len(self), 'index range error'
+        index = self.filtered_index_list[index]
+        img = torch.from_numpy(np.array(self.images[index, :, :, :self.widths[index]]))
 
-        return (img, label)
+        return (img, normalize_label(self.labels[index], self.opt))
 
 
 class RawDataset(Dataset):
@@ -216,6 +621,10 @@ class RawDataset(Dataset):
 
         return (img, self.image_path_list[index])
 
+    def __getitems__(self, indices):
+        """ a whole batch for the DataLoader, decoded by opt.decode_threads threads """
+        return decode_map(self.__getitem__, [(index,) for index in indices], self.opt.decode_threads)
+
 
 class ResizeNormalize(object):
 
@@ -253,42 +662,172 @@ class NormalizePAD(object):
 
 class AlignCollate(object):
 
-    def __init__(self, imgH=32, imgW=100, keep_ratio_with_pad=False):
+    def __init__(self, imgH=32, imgW=100, keep_ratio_with_pad=False, variable_width=False):
+        """
+        variable_width : keep the ratio of every image, up to a width of imgW, and pad only up to the widest
+            image of the batch. The batch is then (image_tensors, labels, widths) with the unpadded widths.
+        keep_ratio_with_pad : pad every image to imgW, the batch is (image_tensors, labels, widths) as well.
+        """
         self.imgH = imgH
         self.imgW = imgW
         self.keep_ratio_with_pad = keep_ratio_with_pad
+        self.variable_width = variable_width
+        self.min_width = 8  # narrowest input all the feature extractors accept
+
+    def _resized_width(self, image):
+        w, h = image.size
+        ratio = w / float(h)
+        if math.ceil(self.imgH * ratio) > self.imgW:
+            resized_w = self.imgW
+        else:
+            resized_w = math.ceil(self.imgH * ratio)
+        return resized_w
+
+    def _collate_tensors(self, images, labels):
+        """ uint8 [c, imgH, width] images already resized by ArrayDataset, only padded and normalized here """
+        widths = [image.size(2) for image in images]
+        if self.variable_width:
+            batch_w = max(max(widths), self.min_width)
+        else:
+            batch_w = self.imgW
+        # replicate the border column like NormalizePAD
+        image_tensors = torch.cat([F.pad(image.unsqueeze(0).float(), (0, batch_w - image.size(2), 0, 0), mode='replicate')
+                                   for image in images], 0)
+        image_tensors.div_(127.5).sub_(1)
+        if self.variable_width or self.keep_ratio_with_pad:
+            return image_tensors, labels, torch.IntTensor(widths)
+        return image_tensors, labels
 
     def __call__(self, batch):
-        batch = filter(lambda x: x is not None, batch)
+        if None in batch:
+            batch = [sample for sample in batch if sample is not None]
         images, labels = zip(*batch)
 
-        if self.keep_ratio_with_pad:  # same concept with 'Rosetta' paper
+        if torch.is_tensor(images[0]):
+            return self._collate_tensors(images, labels)
+
+        if self.variable_width:
+            resized_images = [image.resize((self._resized_width(image), self.imgH), Image.BICUBIC)
+                              for image in images]
+            widths = [image.size[0] for image in resized_images]
+            transform = NormalizePAD((len(images[0].getbands()), self.imgH, max(max(widths), self.min_width)))
+            image_tensors = torch.cat([transform(image).unsqueeze(0) for image in resized_images], 0)
+
+            return image_tensors, labels, torch.IntTensor(widths)
+
+        elif self.keep_ratio_with_pad:  # same concept with 'Rosetta' paper
             resized_max_w = self.imgW
             transform = NormalizePAD((1, self.imgH, resized_max_w))
 
             resized_images = []
+            widths = []
             for image in images:
-                w, h = image.size
-                ratio = w / float(h)
-                if math.ceil(self.imgH * ratio) > self.imgW:
-                    resized_w = self.imgW
-                else:
-                    resized_w = math.ceil(self.imgH * ratio)
-
+                resized_w = self._resized_width(image)
                 resized_image = image.resize((resized_w, self.imgH), Image.BICUBIC)
                 resized_images.append(transform(resized_image))
+                widths.append(resized_w)
                 # resized_image.save('./image_test/%d_test.jpg' % w)
 
             image_tensors = torch.cat([t.unsqueeze(0) for t in resized_images], 0)
+            return image_tensors, labels, torch.IntTensor(widths)
 
         else:
-            transform = ResizeNormalize((self.imgW, self.imgH))
-            image_tensors = [transform(image) for image in images]
-            image_tensors = torch.cat([t.unsqueeze(0) for t in image_tensors], 0)
+            # like ResizeNormalize, converting and normalizing the whole batch at once
+            resized_images = np.stack([np.asarray(image.resize((self.imgW, self.imgH), Image.BICUBIC))
+                                       for image in images])
+            image_tensors = torch.from_numpy(resized_images)
+            image_tensors = image_tensors.permute(0, 3, 1, 2) if image_tensors.dim() == 4 else image_tensors.unsqueeze(1)
+            image_tensors = image_tensors.float().div_(255).sub_(0.5).div_(0.5)
 
         return image_tensors, labels
 
 
+class ResidentDataset(object):
+
+    def __init__(self, data_loader, dtype='uint8', converter=None, batch_max_length=25,
+                 mmap_path='', max_gpu_fraction=0.5):
+        """
+        Decode, resize and normalize a fixed dataset (e.g. the validation set) once and keep it
+        resident as a uint8 or fp16 tensor store, together with the (optionally pre-encoded) labels.
+        The store sits on the GPU when it fits in max_gpu_fraction of the free memory, otherwise in
+        pinned host memory, or in a memory-mapped file when mmap_path is given.
+        Iterating over it yields (image_tensors, labels) batches just like data_loader does,
+        or (image_tensors, labels, widths) when data_loader provides the widths.
+
+        AlignCollate produces (p / 255 - 0.5) / 0.5 from 8-bit pixels p, so uint8 storage is lossless.
+        """
+        self.batch_size = data_loader.batch_size
+        self.dtype = dtype
+        self.labels = []
+        self.widths = []
+        self.encoded = None
+
+        store = None
+        n_filled = 0
+        for batch in data_loader:
+            image_tensors, labels = batch[:2]
+            self.widths += batch[2:]
+            if store is None:
+                shape = (len(data_loader.dataset),) + tuple(image_tensors.size()[1:])
+                store = self._allocate(shape, mmap_path)
+            store[n_filled:n_filled + image_tensors.size(0)] = self._quantize(image_tensors)
+            n_filled += image_tensors.size(0)
+            self.labels += labels
+        self.nSamples = n_filled
+        self.store = store[:n_filled]
+        del store  # self.store is the only reference to the host copy, so it is freed once copied to the GPU
+        self.widths = torch.cat(self.widths, 0) if self.widths else None
+
+        nbytes = self.store.numel() * self.store.element_size()
+        if torch.cuda.is_available() and nbytes < torch.cuda.mem_get_info()[0] * max_gpu_fraction:
+            self.store = self.store.cuda()
+            self.device = 'cuda'
+        else:
+            self.device = 'mmap' if mmap_path else 'pinned' if torch.cuda.is_available() else 'cpu'
+        print(f'resident dataset: {self.nSamples} samples, {nbytes / 2**20:0.1f} MiB ({dtype}) on {self.device}')
+
+        if converter is not None:
+            # the batches are fixed, so the labels can be encoded once as well.
+            self.encoded = []
+            for index in range(0, self.nSamples, self.batch_size):
+                labels = self.labels[index:index + self.batch_size]
+                if isinstance(converter, CTCLabelConverter):
+                    self.encoded.append(converter.encode(labels))
+                else:
+                    self.encoded.append(converter.encode(labels, batch_max_length))
+
+    def _allocate(self, shape, mmap_path):
+        torch_dtype = torch.uint8 if self.dtype == 'uint8' else torch.float16
+        if mmap_path:
+            np_dtype = np.uint8 if self.dtype == 'uint8' else np.float16
+            return torch.from_numpy(np.memmap(mmap_path, dtype=np_dtype, mode='w+', shape=shape))
+        # allocated pinned, pin_memory() would copy the whole store
+        return torch.empty(shape, dtype=torch_dtype, pin_memory=torch.cuda.is_available())
+
+    def _quantize(self, image_tensors):
+        if self.dtype == 'uint8':
+            return image_tensors.add(1).mul_(127.5).round_().clamp_(0, 255).to(torch.uint8)
+        return image_tensors.half()
+
+    def _dequantize(self, image_tensors):
+        if self.dtype == 'uint8':
+            return image_tensors.float().div_(127.5).sub_(1)
+        return image_tensors.float()
+
+    def __len__(self):
+        return (self.nSamples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for index in range(0, self.nSamples, self.batch_size):
+            image_tensors = self.store[index:index + self.batch_size]
+            if self.device != 'cuda' and torch.cuda.is_available():
+                image_tensors = image_tensors.cuda(non_blocking=True)
+            batch = self._dequantize(image_tensors), tuple(self.labels[index:index + self.batch_size])
+            if self.widths is not None:
+                batch += (self.widths[index:index + self.batch_size],)
+            yield batch
+
+
 def tensor2im(image_tensor, imtype=np.uint8):
     image_numpy = image_tensor.cpu().float().numpy()
     if image_numpy.shape[0] == 1:
@@ -7,7 +7,7 @@ import torch.utils.data
 
 from utils import CTCLabelConverter, AttnLabelConverter, TransformerLabelConverter
 from dataset import RawDataset, AlignCollate
-from model import Model
+from model import Model, get_preds_size
 
 
 def demo(opt):
@@ -45,7 +45,8 @@ def demo(opt):
         model = model.cuda()
 
     # prepare data. two demo images from https://github.com/bgshih/crnn#run-demo
-    AlignCollate_demo = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD)
+    AlignCollate_demo = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD,
+                                     variable_width=opt.variable_width)
     demo_data = RawDataset(root=opt.image_folder, opt=opt)  # use RawDataset
     demo_loader = torch.utils.data.DataLoader(
         demo_data, batch_size=opt.batch_size,
@@ -55,7 +56,11 @@ def demo(opt):
 
     # predict
     model.eval()
-    for image_tensors, image_path_list in demo_loader:
+    if opt.fold_bn:
+        model.module.fold_bn()
+    for batch in demo_loader:
+        image_tensors, image_path_list = batch[:2]
+        input_widths = batch[2] if len(batch) > 2 else None
         batch_size = image_tensors.size(0)
         with torch.no_grad():
             image = image_tensors.cuda()
@@ -63,22 +68,22 @@ def demo(opt):
             length_for_pred = torch.cuda.IntTensor([opt.batch_max_length] * batch_size)
             text_for_pred = torch.cuda.LongTensor(batch_size, opt.batch_max_length + 1).fill_(0)
         if 'Transformer' in opt.SequenceModeling:
-            preds = model(image, text_for_pred, is_train=False)
+            preds = model(image, text_for_pred, is_train=False, input_widths=input_widths)
             # select max probabilty (greedy decoding) then decode index to character
             _, preds_index = preds.max(2)
             preds_str = converter.decode(preds_index, length_for_pred)
 
         elif 'CTC' in opt.Prediction:
-            preds = model(image, text_for_pred).log_softmax(2)
+            preds = model(image, text_for_pred, input_widths=input_widths).log_softmax(2)
 
-            # Select max probabilty (greedy decoding) then decode index to character
-            preds_size = torch.IntTensor([preds.size(1)] * batch_size)
-            _, preds_index = preds.permute(1, 0, 2).max(2)
-            preds_index = preds_index.transpose(1, 0).contiguous().view(-1)
-            preds_str = converter.decode(preds_index.data, preds_size.data)
+            # Select max probabilty (greedy decoding) then decode the valid frames of every sample to character
+            preds_size = get_preds_size(preds, input_widths, image.size(3), opt)
+            _, preds_index = preds.max(2)
+            valid = torch.arange(preds_index.size(1)).unsqueeze(0) < preds_size.unsqueeze(1)
+            preds_str = converter.decode(preds_index[valid.to(preds_index.device)].data, preds_size.data)
 
         else:
-            preds = model(image, text_for_pred, is_train=False)
+            preds = model(image, text_for_pred, is_train=False, input_widths=input_widths)
 
             # select max probabilty (greedy decoding) then decode index to character
             _, preds_index = preds.max(2)
@@ -100,8 +105,10 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--image_folder', required=True, help='path to image_folder which contains text images')
     parser.add_argument('--workers', type=int, help='number of data loading workers', default=4)
+    parser.add_argument('--decode_threads', type=int, default=2, help='image decoding threads per data loading worker, 1 decodes serially')
     parser.add_argument('--batch_size', type=int, default=192, help='input batch size')
     parser.add_argument('--saved_model', required=True, help="path to saved_model to evaluation")
+    parser.add_argument('--fold_bn', action='store_true', help='fold batch norms for inference (RCNN)')
     """ Data processing """
     parser.add_argument('--batch_max_length', type=int, default=25, help='maximum-label-length')
     parser.add_argument('--imgH', type=int, default=32, help='the height of the input image')
@@ -110,6 +117,8 @@ if __name__ == '__main__':
     parser.add_argument('--character', type=str, default='0123456789abcdefghijklmnopqrstuvwxyz', help='character label')
     parser.add_argument('--sensitive', action='store_true', help='for sensitive character mode')
     parser.add_argument('--PAD', action='store_true', help='whether to keep ratio then pad for image resize')
+    parser.add_argument('--variable_width', action='store_true',
+                        help='keep the ratio of each image up to imgW and pad per batch, masking the padding (Transformer)')
     """ Model Architecture """
     parser.add_argument('--Transformation', type=str, required=True, help='Transformation stage. None|TPS')
     parser.add_argument('--FeatureExtraction', type=str, required=True, help='FeatureExtraction stage. VGG|RCNN|ResNet')
@@ -120,6 +129,7 @@ if __name__ == '__main__':
     parser.add_argument('--output_channel', type=int, default=512,
                         help='the number of output channel of Feature extractor')
     parser.add_argument('--hidden_size', type=int, default=256, help='the size of the LSTM hidden state')
+    parser.add_argument('--channels_last', action='store_true', help='run the convolutional stages in channels_last')
     """ Transformer """
     parser.add_argument('-d_word_vec', type=int, default=512)
     parser.add_argument('-d_model', type=int, default=512)
@@ -133,6 +143,9 @@ if __name__ == '__main__':
     parser.add_argument('-n_warmup_steps', type=int, default=16000)
 
     parser.add_argument('-dropout', type=float, default=0.1)
+    parser.add_argument('--decode_mode', type=str, default='greedy', help='Transformer decoding: greedy | parallel')
+    parser.add_argument('--refine_iters', type=int, default=2,
+                        help='refinement passes that re-feed the predictions in parallel decoding')
     parser.add_argument('-embs_share_weight', action='store_true')
     parser.add_argument('-proj_share_weight', action='store_true')
     parser.add_argument('-use_scheduled_optim', action='store_true')
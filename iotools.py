@@ -2,11 +2,14 @@ from __future__ import absolute_import
 
 import os
 import os.path as osp
+import re
 import errno
 import json
 from collections import OrderedDict
 import warnings
 import shutil
+import queue
+import threading
 import torch
 
 
@@ -41,6 +44,130 @@ def write_json(obj, fpath):
 def save_checkpoint(state, is_best=False, fpath='checkpoint.pth.tar'):
     if len(osp.dirname(fpath)) != 0:
         mkdir_if_missing(osp.dirname(fpath))
-    torch.save(state, fpath)
+    # write to a temporary file first, so a crash never leaves a truncated checkpoint behind.
+    tmp_fpath = fpath + '.tmp'
+    with open(tmp_fpath, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fpath, fpath)
+    fsync_dir(osp.dirname(fpath) or '.')
     if is_best:
-        shutil.copy(fpath, osp.join(osp.dirname(fpath), 'best_model.pth.tar'))
\ No newline at end of file
+        link_or_copy(fpath, osp.join(osp.dirname(fpath), 'best_model.pth.tar'))
+
+
+def fsync_dir(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def link_or_copy(src, dst):
+    """ hard link dst to src, falling back to a copy on filesystems without hard links """
+    if osp.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def snapshot_to_cpu(obj):
+    """ copy every tensor of a (nested) state dict to host memory """
+    if isinstance(obj, torch.Tensor):
+        if obj.is_cuda:
+            return torch.empty_like(obj, device='cpu').pin_memory().copy_(obj.detach(), non_blocking=True)
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        snapshot = obj.__class__((k, snapshot_to_cpu(v)) for k, v in obj.items())
+        # the module versions of a state_dict, load_state_dict migrates older versions with them
+        if hasattr(obj, '_metadata'):
+            snapshot._metadata = obj._metadata.copy()
+        return snapshot
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointWriter(object):
+
+    def __init__(self, keep_last=0, asynchronous=True, max_pending=1):
+        """
+        Save checkpoints with save_checkpoint, optionally on a background thread.
+        The state is snapshotted to host memory on the calling thread, serialization and fsync happen
+        in the background; at most max_pending snapshots wait for the writer before save() blocks.
+        keep_last > 0 keeps only that many of the checkpoints saved with rotate=True, counting the ones with the
+        same name pattern (e.g. iter_*.pth) already in the directory, so a resumed run prunes those as well.
+        """
+        self.keep_last = keep_last
+        self.asynchronous = asynchronous
+        self.rotated = None
+        self.error = None
+        if self.asynchronous:
+            self.queue = queue.Queue(maxsize=max_pending)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def save(self, state, is_best=False, fpath='checkpoint.pth.tar', rotate=False):
+        self._check_error()
+        if not self.asynchronous:
+            self._write(state, is_best, fpath, rotate)
+            return
+        snapshot = snapshot_to_cpu(state)
+        # the writer waits for the non-blocking copies, the training thread does not
+        copied = None
+        if torch.cuda.is_available():
+            copied = torch.cuda.Event()
+            copied.record()
+        self.queue.put((copied, snapshot, is_best, fpath, rotate))
+
+    def _existing_rotated(self, fpath):
+        """ checkpoints in the directory of fpath named like it up to the numbers, oldest first """
+        directory, name = osp.split(fpath)
+        pattern = re.compile(r'\d+'.join(re.escape(part) for part in re.split(r'\d+', name)) + '$')
+        existing = [f for f in os.listdir(directory or '.') if pattern.match(f)]
+        existing.sort(key=lambda f: [int(n) for n in re.findall(r'\d+', f)])
+        return [osp.join(directory, f) for f in existing if f != name]
+
+    def _write(self, state, is_best, fpath, rotate):
+        save_checkpoint(state, is_best, fpath)
+        if rotate:
+            if self.rotated is None:
+                self.rotated = self._existing_rotated(fpath)
+            self.rotated.append(fpath)
+            while self.keep_last > 0 and len(self.rotated) > self.keep_last:
+                old_fpath = self.rotated.pop(0)
+                if osp.exists(old_fpath):
+                    os.remove(old_fpath)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            copied, item = item[0], item[1:]
+            try:
+                if copied is not None:
+                    copied.synchronize()
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        """ wait for the pending checkpoints to be written """
+        if self.asynchronous:
+            self.queue.put(None)
+            self.thread.join()
+        self._check_error()
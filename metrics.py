@@ -0,0 +1,169 @@
+import os
+import csv
+import json
+import time
+import queue
+import threading
+
+import torch
+import torch.nn.functional as F
+
+
+def sequence_accuracy(preds, target, ignore_index):
+    """
+    (correct tokens, tokens, correct sequences) of teacher forced preds [batch_size x num_steps x num_class]
+    against target [batch_size x num_steps], as device tensors, skipping the ignore_index positions.
+    """
+    mask = target.ne(ignore_index)
+    correct = preds.argmax(2).eq(target) & mask
+    return correct.sum(), mask.sum(), (correct | ~mask).all(1).sum()
+
+
+def ctc_accuracy(preds, preds_size, text, length):
+    """
+    (correct tokens, tokens, correct sequences) of the greedy CTC decoding of preds [batch_size x T x num_class]
+    against the concatenated targets text with length [batch_size], as device tensors.
+    Tokens are compared position by position after removing repeats and blanks, without leaving the device.
+    """
+    batch_size, num_frames = preds.size(0), preds.size(1)
+    device = preds.device
+    preds_index = preds.argmax(2)
+    frames = torch.arange(num_frames, device=device)
+    keep = preds_index.ne(0) & frames.lt(preds_size.to(device).unsqueeze(1))
+    keep &= preds_index.ne(F.pad(preds_index, (1, 0), value=-1)[:, :-1])
+
+    # longest target on the host, so nothing waits for the device
+    width = max(num_frames, int(length.max()) if len(length) else 0)
+    decoded = preds_index.new_zeros(batch_size, width + 1)  # the last column collects the dropped frames
+    positions = torch.where(keep, keep.cumsum(1) - 1, torch.full_like(preds_index, width))
+    decoded.scatter_(1, positions, preds_index)
+    decoded = decoded[:, :width]
+
+    length = length.to(device)
+    columns = torch.arange(width, device=device)
+    mask = columns.lt(length.unsqueeze(1))
+    offsets = length.cumsum(0) - length
+    target_index = (offsets.unsqueeze(1) + columns).clamp(max=max(len(text) - 1, 0))
+    target = text.to(device).long()[target_index] if len(text) else torch.zeros_like(decoded)
+    correct = decoded.eq(target) & mask
+    correct_seqs = (correct | ~mask).all(1) & keep.sum(1).eq(length)
+    return correct.sum(), mask.sum(), correct_seqs.sum()
+
+
+class TrainMetrics(object):
+
+    def __init__(self, log_dir, interval=100, formats=('jsonl',), tensorboard=False, device='cuda'):
+        """
+        Accumulate the training loss, token and sequence accuracy of every batch on the device, without syncs,
+        and flush them every interval steps from a background thread, together with the throughput
+        (images/sec) and the data-wait fraction (time in the data loading / wall time).
+        Writes log_dir/metrics.jsonl and / or log_dir/metrics.csv, and TensorBoard events with tensorboard.
+        """
+        self.log_dir = log_dir
+        self.interval = interval
+        self.formats = formats
+        self.device = torch.device(device)
+        # loss sum, loss count, correct tokens, tokens, correct sequences
+        self.totals = torch.zeros(5, dtype=torch.float64, device=self.device)
+        self.num_images = 0
+        self.data_time = 0.0
+        self.excluded_time = 0.0
+        self.last_flush = time.time()
+        self.tb_writer = None
+        if tensorboard:
+            from torch.utils.tensorboard import SummaryWriter
+            self.tb_writer = SummaryWriter(os.path.join(log_dir, 'tensorboard'))
+        self.csv_fields = None
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add_data_time(self, seconds):
+        self.data_time += seconds
+
+    def exclude_time(self, seconds):
+        """ leave seconds spent outside the training steps (e.g. validation) out of the current record """
+        self.excluded_time += seconds
+
+    def add_batch(self, loss, num_images, correct_tokens, num_tokens, correct_seqs):
+        """ loss is the mean loss of the batch, the counts are device tensors """
+        batch = torch.stack([loss.detach().double() * num_images, torch.ones_like(self.totals[0]) * num_images,
+                             correct_tokens.double(), num_tokens.double(), correct_seqs.double()])
+        self.totals += batch
+        self.num_images += num_images
+
+    def step(self, iteration, **values):
+        """ end of an optimizer step, flushes every interval steps. values (e.g. lr) are logged as they are """
+        if (iteration + 1) % self.interval != 0:
+            return
+        self._check_error()
+        now = time.time()
+        elapsed = now - self.last_flush - self.excluded_time
+        if self.totals.is_cuda:
+            totals = torch.empty(self.totals.size(), dtype=self.totals.dtype, pin_memory=True)
+            totals.copy_(self.totals, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            totals, event = self.totals.clone(), None
+        values.update({'step': iteration + 1, 'images_per_sec': self.num_images / elapsed,
+                       'data_wait': self.data_time / elapsed})
+        self.queue.put((event, totals, values))
+        self.totals.zero_()
+        self.num_images = 0
+        self.data_time = 0.0
+        self.excluded_time = 0.0
+        self.last_flush = now
+
+    def _write(self, event, totals, values):
+        if event is not None:
+            event.synchronize()
+        loss_sum, loss_count, correct_tokens, num_tokens, correct_seqs = totals.tolist()
+        record = {'step': values.pop('step'),
+                  'loss': loss_sum / max(loss_count, 1),
+                  'token_accuracy': correct_tokens / max(num_tokens, 1),
+                  'sequence_accuracy': correct_seqs / max(loss_count, 1)}
+        record.update(values)
+        if 'jsonl' in self.formats:
+            with open(os.path.join(self.log_dir, 'metrics.jsonl'), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if 'csv' in self.formats:
+            path = os.path.join(self.log_dir, 'metrics.csv')
+            if self.csv_fields is None:
+                self.csv_fields = list(record.keys())
+                write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+            else:
+                write_header = False
+            with open(path, 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=self.csv_fields, extrasaction='ignore')
+                if write_header:
+                    writer.writeheader()
+                writer.writerow(record)
+        if self.tb_writer is not None:
+            for key, value in record.items():
+                if key != 'step':
+                    self.tb_writer.add_scalar(f'train/{key}', value, record['step'])
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        """ wait for the pending records to be written """
+        self.queue.put(None)
+        self.thread.join()
+        if self.tb_writer is not None:
+            self.tb_writer.close()
+        self._check_error()
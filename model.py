@@ -14,15 +14,34 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import math
+from contextlib import nullcontext
+
 import torch.nn as nn
 
 from modules.transformation import TPS_SpatialTransformerNetwork
 from modules.feature_extraction import VGG_FeatureExtractor, RCNN_FeatureExtractor, ResNet_FeatureExtractor,SimpleConv
 from modules.sequence_modeling import BidirectionalLSTM, Transformer
 from modules.prediction import Attention
+from modules.transformer_component.Block import get_position_ids
 import torch
 
 
+def get_feature_lengths(input_widths, input_width, feature_width):
+    """ number of feature columns covering the unpadded part of every image of width input_widths """
+    feature_lengths = torch.ceil(input_widths.float() * feature_width / input_width).long()
+    return feature_lengths.clamp_(1, feature_width)
+
+
+def get_preds_size(preds, input_widths, input_width, opt):
+    """ CTC preds_size [batch_size], the output frames computed from the unpadded part of every image.
+    Every frame counts without widths, or after TPS rectification. """
+    batch_size, preds_length = preds.size(0), preds.size(1)
+    if input_widths is None or opt.Transformation != 'None':
+        return torch.IntTensor([preds_length] * batch_size)
+    return get_feature_lengths(input_widths.cpu(), input_width, preds_length).int()
+
+
 class Model(nn.Module):
 
     def __init__(self, opt):
@@ -30,6 +49,8 @@ class Model(nn.Module):
         self.opt = opt
         self.stages = {'Trans': opt.Transformation, 'Feat': opt.FeatureExtraction,
                        'Seq': opt.SequenceModeling, 'Pred': opt.Prediction}
+        # set to a modules.stage_profiler.StageProfiler to instrument forward
+        self.profiler = None
 
         """ Transformation """
         if opt.Transformation == 'TPS':
@@ -42,10 +63,9 @@ class Model(nn.Module):
         if opt.FeatureExtraction == 'SimpleConv':
             assert opt.output_channel == 512
             assert opt.imgH == 32
-            assert opt.imgW == 100
             self.FeatureExtraction = SimpleConv(
                 opt.input_channel, opt.output_channel)
-            len_feature = 25
+            len_feature = math.ceil(opt.imgW / 4)
         elif opt.FeatureExtraction == 'VGG':
             self.FeatureExtraction = VGG_FeatureExtractor(
                 opt.input_channel, opt.output_channel)
@@ -74,8 +94,8 @@ class Model(nn.Module):
                 BidirectionalLSTM(opt.hidden_size, opt.hidden_size, opt.hidden_size))
             self.SequenceModeling_output = opt.hidden_size
         elif opt.SequenceModeling == 'Transformer':
-            
-            self.src_pos = torch.arange(1, len_feature+1).expand(opt.batch_size, -1).long().cuda()
+            # encoder positions are derived from the actual feature length in forward,
+            # len_feature only sizes the initial position table.
             self.SequenceModeling = Transformer(
                 n_src_vocab=self.FeatureExtraction_output,
                 n_tgt_vocab=opt.num_class,
@@ -91,7 +111,9 @@ class Model(nn.Module):
                 n_layers_enc=opt.n_layers_enc,
                 n_layers_dec=opt.n_layers_dec,
                 n_head=opt.n_head,
-                dropout=opt.dropout
+                dropout=opt.dropout,
+                decode_mode=opt.decode_mode,
+                refine_iters=opt.refine_iters
             )
             self.SequenceModeling_output = None
         else:
@@ -110,39 +132,88 @@ class Model(nn.Module):
         else:
             raise Exception('SequenceModeling != Transformer => Prediction is neither CTC or Attn')
 
-    def forward(self, input, text, is_train=True,tgt_pos=None):
+        # run the convolutional stages in NHWC, the conv weights are converted once here.
+        self.channels_last = opt.channels_last
+        if self.channels_last:
+            self.to(memory_format=torch.channels_last)
+
+    def fold_bn(self):
+        """ fold the batch norms of the modules supporting it (GRCL) for inference, after eval() """
+        for module in self.modules():
+            if module is not self and hasattr(module, 'fold_bn'):
+                module.fold_bn()
+        return self
+
+    def _profile(self, stage):
+        if self.profiler is None:
+            return nullcontext({})
+        return self.profiler.stage(stage)
+
+    def forward(self, input, text, is_train=True,tgt_pos=None, input_widths=None):
+        """ input_widths : unpadded width of every image of a variable width or PAD batch """
+        if self.channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
+
         """ Transformation stage """
         if not self.stages['Trans'] == "None":
-            input = self.Transformation(input)
+            with self._profile('Transformation') as record:
+                input = self.Transformation(input)
+                record['output'] = input
+            input_widths = None  # the rectified image has no padded region left
 
         """ Feature extraction stage """
-        visual_feature = self.FeatureExtraction(input)
-        if not self.stages['Seq'] == 'Transformer':
-            visual_feature = self.AdaptiveAvgPool(
-                visual_feature.permute(0, 3, 1, 2))  # [b, c, h, w] -> [b, w, c, h]
-            visual_feature = visual_feature.squeeze(3)
-        else:
-            batch_size = visual_feature.size(0)
-            visual_feature = visual_feature.permute(0, 2, 3, 1).contiguous() # [b, c, h, w] -> [b, h, w, c]
-            visual_feature = visual_feature.view(batch_size, -1, self.FeatureExtraction_output)
+        with self._profile('FeatureExtraction') as record:
+            visual_feature = self.FeatureExtraction(input)
+            if not self.stages['Seq'] == 'Transformer':
+                visual_feature = self.AdaptiveAvgPool(
+                    visual_feature.permute(0, 3, 1, 2))  # [b, c, h, w] -> [b, w, c, h]
+                visual_feature = visual_feature.squeeze(3)
+            else:
+                batch_size, _, feature_h, feature_w = visual_feature.size()
+                visual_feature = visual_feature.permute(0, 2, 3, 1) # [b, c, h, w] -> [b, h, w, c]
+                # a view when the features are NHWC in memory (channels_last, SimpleConv)
+                visual_feature = visual_feature.reshape(batch_size, -1, self.FeatureExtraction_output)
+                src_non_pad = None
+                if input_widths is not None:
+                    # mask the feature columns computed from padding, [b, w] -> [b, h * w] like visual_feature
+                    feature_lengths = get_feature_lengths(input_widths.to(visual_feature.device), input.size(3), feature_w)
+                    column = torch.arange(feature_w, device=visual_feature.device)
+                    src_non_pad = column.unsqueeze(0) < feature_lengths.unsqueeze(1)
+                    src_non_pad = src_non_pad.unsqueeze(1).expand(-1, feature_h, -1).reshape(batch_size, -1)
+            record['output'] = visual_feature
 
         """ Sequence modeling stage """
-        if self.stages['Seq'] == 'BiLSTM':
-            contextual_feature = self.SequenceModeling(visual_feature)
-        elif self.stages['Seq'] == 'Transformer':
-            src_pos = self.src_pos[:batch_size]
-            prediction = self.SequenceModeling(visual_feature.contiguous(
-            ), src_pos, text, tgt_pos, self.opt.batch_max_length, is_train)
+        with self._profile('SequenceModeling') as record:
+            if self.stages['Seq'] == 'BiLSTM' and self.stages['Pred'] == 'CTC' and input_widths is not None:
+                # the LSTMs skip the frames computed from padding, CTC only decodes the frames of preds_size.
+                # Attn attends over every frame unmasked, so it keeps the unpacked LSTMs.
+                contextual_feature = visual_feature
+                feature_lengths = get_feature_lengths(input_widths, input.size(3), visual_feature.size(1))
+                for layer in self.SequenceModeling:
+                    contextual_feature = layer(contextual_feature, feature_lengths)
+                record['output'] = contextual_feature
+            elif self.stages['Seq'] == 'BiLSTM':
+                contextual_feature = self.SequenceModeling(visual_feature)
+                record['output'] = contextual_feature
+            elif self.stages['Seq'] == 'Transformer':
+                src_pos = get_position_ids(batch_size, visual_feature.size(1), visual_feature.device)
+                prediction = self.SequenceModeling(visual_feature, src_pos, text, tgt_pos, self.opt.batch_max_length,
+                                                   is_train, src_non_pad=src_non_pad)
+                record['output'] = prediction
+            else:
+                # for convenience. this is NOT contextually modeled by BiLSTM
+                contextual_feature = visual_feature
+        if self.stages['Seq'] == 'Transformer':
             return prediction # Transformer return final predict
-        else:
-            # for convenience. this is NOT contextually modeled by BiLSTM
-            contextual_feature = visual_feature
 
         """ Prediction stage """
-        if self.stages['Pred'] == 'CTC':
-            prediction = self.Prediction(contextual_feature.contiguous())
-        else:
-            prediction = self.Prediction(contextual_feature.contiguous(
-            ), text, is_train, batch_max_length=self.opt.batch_max_length)
+        with self._profile('Prediction') as record:
+            if self.stages['Pred'] == 'CTC':
+                prediction = self.Prediction(contextual_feature)
+            else:
+                # training labels may be encoded to the longest label of the batch (--token_budget)
+                batch_max_length = text.size(1) - 2 if is_train else self.opt.batch_max_length
+                prediction = self.Prediction(contextual_feature, text, is_train, batch_max_length=batch_max_length)
+            record['output'] = prediction
 
         return prediction
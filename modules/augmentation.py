@@ -0,0 +1,126 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+from modules.transformation import GridGenerator
+
+
+class BatchAugmentation(object):
+
+    def __init__(self, opt, device='cuda', num_fiducial=10):
+        """
+        Random augmentation of whole normalized batches [batch_size x channel x imgH x W] on the device,
+        after the H2D copy, instead of per-image PIL transforms in the data loading workers.
+        Every sample draws its own parameters, each augmentation is applied with probability opt.aug_prob:
+            warp     : rotation (opt.aug_rotate degrees), perspective (opt.aug_perspective) and local horizontal
+                       stretch (opt.aug_stretch) as one TPS grid, sampled with F.grid_sample like the TPS-STN
+            blur     : gaussian blur with sigma up to opt.aug_blur pixels
+            noise    : gaussian noise with std up to opt.aug_noise
+            contrast : contrast scaled by 1 +- opt.aug_contrast
+        A magnitude of 0 disables the augmentation. The parameters come from a generator seeded with
+        opt.aug_seed, or opt.manualSeed when it is negative.
+        """
+        self.prob = opt.aug_prob
+        self.rotate = opt.aug_rotate
+        self.perspective = opt.aug_perspective
+        self.stretch = opt.aug_stretch
+        self.blur = opt.aug_blur
+        self.noise = opt.aug_noise
+        self.contrast = opt.aug_contrast
+        self.device = torch.device(device)
+        self.num_fiducial = num_fiducial
+        self.grid_generators = {}  # (imgH, W) -> GridGenerator, as the width varies with --variable_width
+
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(opt.aug_seed if opt.aug_seed >= 0 else opt.manualSeed)
+
+    def _uniform(self, batch_size, magnitude):
+        """ per-sample U(-magnitude, magnitude), zero for the samples that skip the augmentation """
+        value = torch.rand(batch_size, generator=self.generator, device=self.device).mul_(2).sub_(1).mul_(magnitude)
+        apply = torch.rand(batch_size, generator=self.generator, device=self.device) < self.prob
+        return value * apply
+
+    def _grid_generator(self, height, width):
+        if (height, width) not in self.grid_generators:
+            self.grid_generators[(height, width)] = GridGenerator(self.num_fiducial, (height, width)).to(self.device)
+        return self.grid_generators[(height, width)]
+
+    def warp(self, image, widths):
+        """ move the fiducial points of the valid region of every sample and resample the image """
+        batch_size, _, height, width = image.size()
+        grid_generator = self._grid_generator(height, width)
+        # coordinates are normalized to [-1, 1] over the valid width of every sample
+        C = image.new_tensor(grid_generator.C).repeat(batch_size, 1, 1)  # batch_size x F x 2
+        x, y = C[:, :, 0], C[:, :, 1]
+        n_columns = self.num_fiducial // 2
+
+        # local stretch: shift the inner columns of fiducial points, by less than half their spacing
+        shift = torch.stack([self._uniform(batch_size, self.stretch * 0.45) for _ in range(n_columns - 2)], 1)
+        shift = F.pad(shift, (1, 1)).repeat(1, 2) * (2.0 / (n_columns - 1))
+        x = x + shift
+        # perspective: the height changes linearly along the text
+        y = y * (1 + self._uniform(batch_size, self.perspective).unsqueeze(1) * x)
+        # rotation, in pixels as the valid region is not square
+        half_w = widths.to(image).unsqueeze(1) / 2 if widths is not None else image.new_tensor(width / 2)
+        angle = self._uniform(batch_size, math.radians(self.rotate)).unsqueeze(1)
+        x_pixel, y_pixel = x * half_w, y * (height / 2)
+        x = (x_pixel * torch.cos(angle) - y_pixel * torch.sin(angle)) / half_w
+        y = (x_pixel * torch.sin(angle) + y_pixel * torch.cos(angle)) / (height / 2)
+        batch_C_prime = torch.stack([x, y], 2)
+
+        batch_P_hat = None
+        if widths is not None:
+            # output pixels in the coordinates of the valid region of every sample
+            scale = width / widths.to(image).view(-1, 1, 1)
+            batch_P = image.new_tensor(grid_generator.P).repeat(batch_size, 1, 1)
+            batch_P = torch.cat([(batch_P[:, :, :1] + 1) * scale - 1, batch_P[:, :, 1:]], 2)
+            batch_P_hat = grid_generator.build_batch_P_hat(batch_P)
+        batch_P_prime = grid_generator.build_P_prime(batch_C_prime, batch_P_hat)  # batch_size x n x 2
+        if widths is not None:
+            batch_P_prime = torch.cat([(batch_P_prime[:, :, :1] + 1) / scale - 1, batch_P_prime[:, :, 1:]], 2)
+        grid = batch_P_prime.view(batch_size, height, width, 2)
+        return F.grid_sample(image, grid, padding_mode='border', align_corners=False)
+
+    def gaussian_blur(self, image):
+        """ separable gaussian blur with a per-sample sigma, as grouped convolutions """
+        batch_size, channel, height, width = image.size()
+        radius = int(math.ceil(2 * self.blur))
+        sigma = self._uniform(batch_size, self.blur).abs().clamp(min=1e-2)
+        offsets = torch.arange(-radius, radius + 1, device=self.device, dtype=image.dtype)
+        kernel = torch.exp(-offsets.square() / (2 * sigma.unsqueeze(1).square()))
+        kernel = (kernel / kernel.sum(1, keepdim=True)).repeat_interleave(channel, 0)  # batch_size*channel x 2r+1
+
+        image = image.reshape(1, batch_size * channel, height, width)
+        image = F.pad(image, (radius, radius, radius, radius), mode='replicate')
+        image = F.conv2d(image, kernel.view(-1, 1, 1, 2 * radius + 1), groups=batch_size * channel)
+        image = F.conv2d(image, kernel.view(-1, 1, 2 * radius + 1, 1), groups=batch_size * channel)
+        return image.view(batch_size, channel, height, width)
+
+    def __call__(self, image, widths=None):
+        """
+        image  : normalized batch on self.device [batch_size x channel x imgH x W]
+        widths : valid width of every sample with --PAD / --variable_width, the padding is kept replicated
+        """
+        batch_size = image.size(0)
+        with torch.no_grad():
+            if self.rotate > 0 or self.perspective > 0 or self.stretch > 0:
+                image = self.warp(image, widths)
+            if self.blur > 0:
+                image = self.gaussian_blur(image)
+            if self.contrast > 0:
+                factor = (1 + self._uniform(batch_size, self.contrast)).view(-1, 1, 1, 1)
+                mean = image.mean(dim=(1, 2, 3), keepdim=True)
+                image = (image - mean) * factor + mean
+            if self.noise > 0:
+                std = self._uniform(batch_size, self.noise).abs().view(-1, 1, 1, 1)
+                noise = torch.randn(image.size(), generator=self.generator, device=self.device, dtype=image.dtype)
+                image = image + noise * std
+            image = image.clamp_(-1, 1)
+            if widths is not None:
+                # the padding replicates the last valid column again, like NormalizePAD
+                width = image.size(3)
+                columns = torch.arange(width, device=self.device)
+                columns = torch.min(columns.unsqueeze(0), widths.to(self.device).unsqueeze(1) - 1)
+                image = image.gather(3, columns.view(batch_size, 1, 1, width).expand_as(image))
+        return image
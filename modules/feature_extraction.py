@@ -18,9 +18,10 @@ class SimpleConv(nn.Module):
     def forward(self, input):
         batch_size = input.size(0)
         out =  self.ConvNet(input)
-        out = out.permute(0, 3, 2, 1).contiguous() # [b, c, h, w] -> [b, w, h, c]
-        out = out.view(batch_size, -1, self.output_channel)
-        out = out.unsqueeze(2).permute(0,3,2,1).contiguous()
+        out = out.permute(0, 3, 2, 1) # [b, c, h, w] -> [b, w, h, c]
+        out = out.reshape(batch_size, -1, self.output_channel)
+        # [b, w, c'] -> [b, c', 1, w] as a view, i.e. NHWC in memory like the channels_last stages.
+        out = out.unsqueeze(2).permute(0,3,2,1)
         return out
 
 
@@ -116,17 +117,94 @@ class GRCL(nn.Module):
         self.GRCL = [GRCL_unit(output_channel) for _ in range(num_iteration)]
         self.GRCL = nn.Sequential(*self.GRCL)
 
+        self.pad = pad
+        # the 1x1 gate conv can be zero padded into the kernel_size window of its sibling conv
+        self.fuse_conv = kernel_size == 2 * pad + 1
+        for name in ('folded_x_init', 'folded_weight', 'folded_bias', 'folded_affine'):
+            self.register_buffer(name, None, persistent=False)
+
+    def _conv_pair(self, conv_gate, conv, input):
+        """ conv_gate(input), conv(input) as one convolution, with the 1x1 gate kernel zero padded """
+        if not self.fuse_conv:
+            return conv_gate(input), conv(input)
+        weight = torch.cat([F.pad(conv_gate.weight, [self.pad] * 4), conv.weight], 0)
+        return F.conv2d(input, weight, padding=self.pad).split(conv.out_channels, 1)
+
+    def _batch_norms(self, input, batch_norms):
+        """ batch_norms[i](input) for every unit. In training they share the batch statistics,
+        so input is normalized once and only the affine transforms (and running stats) differ per unit. """
+        if not self.training:
+            return [batch_norm(input) for batch_norm in batch_norms]
+        var, mean = torch.var_mean(input, dim=(0, 2, 3), unbiased=False)
+        normalized = (input - mean[:, None, None]) * torch.rsqrt(var + batch_norms[0].eps)[:, None, None]
+        with torch.no_grad():
+            n = input.numel() / input.size(1)
+            unbiased_var = var * (n / max(n - 1, 1))
+            for batch_norm in batch_norms:
+                batch_norm.num_batches_tracked.add_(1)
+                if batch_norm.momentum is None:  # cumulative moving average
+                    factor = 1.0 / float(batch_norm.num_batches_tracked)
+                else:
+                    factor = batch_norm.momentum
+                batch_norm.running_mean.mul_(1 - factor).add_(mean, alpha=factor)
+                batch_norm.running_var.mul_(1 - factor).add_(unbiased_var, alpha=factor)
+        return [torch.addcmul(batch_norm.bias[:, None, None], normalized, batch_norm.weight[:, None, None])
+                for batch_norm in batch_norms]
+
     def forward(self, input):
         """ The input of GRCL is consistant over time t, which is denoted by u(0)
         thus wgf_u / wf_u is also consistant over time t.
         """
-        wgf_u = self.wgf_u(input)
-        wf_u = self.wf_u(input)
+        wgf_u, wf_u = self._conv_pair(self.wgf_u, self.wf_u, input)
+        if self.folded_weight is not None and not self.training:
+            return self._forward_folded(wgf_u, wf_u)
         x = F.relu(self.BN_x_init(wf_u))
 
-        for i in range(self.num_iteration):
-            x = self.GRCL[i](wgf_u, self.wgr_x(x), wf_u, self.wr_x(x))
+        # BN_gfu(wgf_u) / BN_fu(wf_u) do not depend on the iteration either.
+        G_first_terms = self._batch_norms(wgf_u, [unit.BN_gfu for unit in self.GRCL])
+        x_first_terms = self._batch_norms(wf_u, [unit.BN_fu for unit in self.GRCL])
+        for unit, G_first_term, x_first_term in zip(self.GRCL, G_first_terms, x_first_terms):
+            wgr_x, wr_x = self._conv_pair(self.wgr_x, self.wr_x, x)
+            x = unit(G_first_term, wgr_x, x_first_term, wr_x)
+
+        return x
 
+    def fold_bn(self):
+        """ fold the inference batch norms: BN_grx / BN_rx into per iteration conv weights, the others
+        into per channel scale and shift. Kept in non-persistent buffers, so the state_dict is unchanged,
+        and cleared by train(). """
+        def affine(batch_norm):
+            scale = batch_norm.weight * torch.rsqrt(batch_norm.running_var + batch_norm.eps)
+            return torch.stack([scale, batch_norm.bias - batch_norm.running_mean * scale])[:, :, None, None]
+
+        if not self.fuse_conv:
+            return self
+        with torch.no_grad():
+            weights, biases, affines = [], [], []
+            for unit in self.GRCL:
+                grx, rx = affine(unit.BN_grx), affine(unit.BN_rx)
+                weights.append(torch.cat([F.pad(self.wgr_x.weight, [self.pad] * 4) * grx[0, ..., None],
+                                          self.wr_x.weight * rx[0, ..., None]], 0))
+                biases.append(torch.cat([grx[1], rx[1]], 0).flatten())
+                affines.append(torch.stack([affine(unit.BN_gfu), affine(unit.BN_fu), affine(unit.BN_Gx)]))
+            self.folded_x_init = affine(self.BN_x_init)
+            self.folded_weight = torch.stack(weights)
+            self.folded_bias = torch.stack(biases)
+            self.folded_affine = torch.stack(affines)
+        return self
+
+    def train(self, mode=True):
+        if mode:
+            for name in ('folded_x_init', 'folded_weight', 'folded_bias', 'folded_affine'):
+                setattr(self, name, None)
+        return super(GRCL, self).train(mode)
+
+    def _forward_folded(self, wgf_u, wf_u):
+        x = F.relu(torch.addcmul(self.folded_x_init[1], wf_u, self.folded_x_init[0]))
+        for weight, bias, (gfu, fu, Gx) in zip(self.folded_weight, self.folded_bias, self.folded_affine):
+            wgr_x, wr_x = F.conv2d(x, weight, bias, padding=self.pad).split(self.wr_x.out_channels, 1)
+            G = torch.sigmoid(torch.addcmul(gfu[1], wgf_u, gfu[0]) + wgr_x)
+            x = F.relu(torch.addcmul(fu[1], wf_u, fu[0]) + torch.addcmul(Gx[1], wr_x * G, Gx[0]))
         return x
 
 
@@ -140,12 +218,11 @@ class GRCL_unit(nn.Module):
         self.BN_rx = nn.BatchNorm2d(output_channel)
         self.BN_Gx = nn.BatchNorm2d(output_channel)
 
-    def forward(self, wgf_u, wgr_x, wf_u, wr_x):
-        G_first_term = self.BN_gfu(wgf_u)
+    def forward(self, G_first_term, wgr_x, x_first_term, wr_x):
+        """ G_first_term / x_first_term : BN_gfu(wgf_u) / BN_fu(wf_u), computed once by GRCL """
         G_second_term = self.BN_grx(wgr_x)
         G = torch.sigmoid(G_first_term + G_second_term)
 
-        x_first_term = self.BN_fu(wf_u)
         x_second_term = self.BN_Gx(self.BN_rx(wr_x) * G)
         x = F.relu(x_first_term + x_second_term)
 
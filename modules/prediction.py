@@ -3,6 +3,15 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+@torch.jit.script
+def lstm_pointwise(gates, prev_c):
+    """ LSTM cell update from the summed gate pre-activations, fused into one kernel by TorchScript """
+    in_gate, forget_gate, cell_gate, out_gate = gates.chunk(4, 1)
+    cur_c = torch.sigmoid(forget_gate) * prev_c + torch.sigmoid(in_gate) * torch.tanh(cell_gate)
+    cur_h = torch.sigmoid(out_gate) * torch.tanh(cur_c)
+    return cur_h, cur_c
+
+
 class Attention(nn.Module):
 
     def __init__(self, input_size, hidden_size, num_classes):
@@ -11,13 +20,7 @@ class Attention(nn.Module):
         self.hidden_size = hidden_size
         self.num_classes = num_classes
         self.generator = nn.Linear(hidden_size, num_classes)
-
-    def _char_to_onehot(self, input_char, onehot_dim=38):
-        input_char = input_char.unsqueeze(1)
-        batch_size = input_char.size(0)
-        one_hot = torch.cuda.FloatTensor(batch_size, onehot_dim).zero_()
-        one_hot = one_hot.scatter_(1, input_char, 1)
-        return one_hot
+        self.fast_train = True  # teacher forced training through AttentionCell.forward_teacher
 
     def forward(self, batch_H, text, is_train=True, batch_max_length=25):
         """
@@ -29,26 +32,29 @@ class Attention(nn.Module):
         batch_size = batch_H.size(0)
         num_steps = batch_max_length + 1  # +1 for [s] at end of sentence.
 
-        output_hiddens = torch.cuda.FloatTensor(batch_size, num_steps, self.hidden_size).fill_(0)
-        hidden = (torch.cuda.FloatTensor(batch_size, self.hidden_size).fill_(0),
-                  torch.cuda.FloatTensor(batch_size, self.hidden_size).fill_(0))
+        output_hiddens = batch_H.new_zeros(batch_size, num_steps, self.hidden_size)
+        hidden = (batch_H.new_zeros(batch_size, self.hidden_size),
+                  batch_H.new_zeros(batch_size, self.hidden_size))
+        # the encoder projection does not change over the decoding steps.
+        batch_H_proj = self.attention_cell.i2h(batch_H)
+
+        if is_train and self.fast_train:
+            output_hiddens = self.attention_cell.forward_teacher(batch_H, text[:, :num_steps], batch_H_proj)
+            probs = self.generator(output_hiddens)
 
-        if is_train:
+        elif is_train:
             for i in range(num_steps):
-                # one-hot vectors for a i-th char. in a batch
-                char_onehots = self._char_to_onehot(text[:, i], onehot_dim=self.num_classes)
-                # hidden : decoder's hidden s_{t-1}, batch_H : encoder's hidden H, char_onehots : one-hot(y_{t-1})
-                hidden, alpha = self.attention_cell(hidden, batch_H, char_onehots)
+                # hidden : decoder's hidden s_{t-1}, batch_H : encoder's hidden H, text[:, i] : y_{t-1}
+                hidden, alpha = self.attention_cell(hidden, batch_H, text[:, i], batch_H_proj)
                 output_hiddens[:, i, :] = hidden[0]  # LSTM hidden index (0: hidden, 1: Cell)
             probs = self.generator(output_hiddens)
 
         else:
-            targets = torch.cuda.LongTensor(batch_size).fill_(0)  # [GO] token
-            probs = torch.cuda.FloatTensor(batch_size, num_steps, self.num_classes).fill_(0)
+            targets = text.new_zeros(batch_size)  # [GO] token
+            probs = batch_H.new_zeros(batch_size, num_steps, self.num_classes)
 
             for i in range(num_steps):
-                char_onehots = self._char_to_onehot(targets, onehot_dim=self.num_classes)
-                hidden, alpha = self.attention_cell(hidden, batch_H, char_onehots)
+                hidden, alpha = self.attention_cell(hidden, batch_H, targets, batch_H_proj)
                 probs_step = self.generator(hidden[0])
                 probs[:, i, :] = probs_step
                 _, next_input = probs_step.max(1)
@@ -65,16 +71,49 @@ class AttentionCell(nn.Module):
         self.h2h = nn.Linear(hidden_size, hidden_size)  # either i2i or h2h should have bias
         self.score = nn.Linear(hidden_size, 1, bias=False)
         self.rnn = nn.LSTMCell(input_size + num_embeddings, hidden_size)
+        self.input_size = input_size
         self.hidden_size = hidden_size
 
-    def forward(self, prev_hidden, batch_H, char_onehots):
+    def char_embedding(self, chars):
+        """ the one-hot part of the LSTM input only selects columns of weight_ih: look them up instead.
+        chars : [batch_size] or [batch_size x num_steps] -> [... x 4*hidden_size] gate contributions """
+        return F.embedding(chars, self.rnn.weight_ih[:, self.input_size:].t())
+
+    def forward(self, prev_hidden, batch_H, chars, batch_H_proj=None):
         # [batch_size x num_encoder_step x num_channel] -> [batch_size x num_encoder_step x hidden_size]
-        batch_H_proj = self.i2h(batch_H)
+        if batch_H_proj is None:
+            batch_H_proj = self.i2h(batch_H)
         prev_hidden_proj = self.h2h(prev_hidden[0]).unsqueeze(1)
         e = self.score(torch.tanh(batch_H_proj + prev_hidden_proj))  # batch_size x num_encoder_step * 1
 
         alpha = F.softmax(e, dim=1)
         context = torch.bmm(alpha.permute(0, 2, 1), batch_H).squeeze(1)  # batch_size x num_channel
-        concat_context = torch.cat([context, char_onehots], 1)  # batch_size x (num_channel + num_embedding)
-        cur_hidden = self.rnn(concat_context, prev_hidden)
-        return cur_hidden, alpha
+
+        # nn.LSTMCell on cat([context, one-hot(chars)]), with the same parameters.
+        gates = F.linear(context, self.rnn.weight_ih[:, :self.input_size], self.rnn.bias_ih) \
+            + self.char_embedding(chars) + F.linear(prev_hidden[0], self.rnn.weight_hh, self.rnn.bias_hh)
+        return lstm_pointwise(gates, prev_hidden[1]), alpha
+
+    def forward_teacher(self, batch_H, chars, batch_H_proj):
+        """ all steps of teacher forced decoding, chars : [batch_size x num_steps] -> hiddens of every step.
+        The character gates of all steps are looked up at once, and h2h and weight_hh, which both read
+        the previous hidden state, are computed with a single matmul per step. """
+        batch_size, num_steps = chars.size()
+        char_gates = self.char_embedding(chars)  # batch_size x num_steps x 4*hidden_size
+        h_weight = torch.cat([self.h2h.weight, self.rnn.weight_hh], 0)
+        h_bias = torch.cat([self.h2h.bias, self.rnn.bias_ih + self.rnn.bias_hh], 0)
+        context_weight = self.rnn.weight_ih[:, :self.input_size].t()
+
+        hidden = batch_H.new_zeros(batch_size, self.hidden_size)
+        cell = batch_H.new_zeros(batch_size, self.hidden_size)
+        hiddens = []
+        for i in range(num_steps):
+            prev_hidden_proj, hidden_gates = F.linear(hidden, h_weight, h_bias).split(
+                [self.hidden_size, 4 * self.hidden_size], 1)
+            e = self.score(torch.tanh(batch_H_proj + prev_hidden_proj.unsqueeze(1)))
+            alpha = F.softmax(e, dim=1)
+            context = torch.bmm(alpha.permute(0, 2, 1), batch_H).squeeze(1)
+            gates = torch.addmm(hidden_gates + char_gates[:, i], context, context_weight)
+            hidden, cell = lstm_pointwise(gates, cell)
+            hiddens.append(hidden)
+        return torch.stack(hiddens, 1)
@@ -1,5 +1,5 @@
 import torch.nn as nn
-from .transformer_component.Block import Encoder, Decoder
+from .transformer_component.Block import Encoder, Decoder, get_position_ids
 from .transformer_component import Constants
 import torch
 
@@ -12,14 +12,20 @@ class BidirectionalLSTM(nn.Module):
                            bidirectional=True, batch_first=True)
         self.linear = nn.Linear(hidden_size * 2, output_size)
 
-    def forward(self, input):
+    def forward(self, input, lengths=None):
         """
         input : visual feature [batch_size x T x input_size]
+        lengths : number of valid frames of every sample, the padded frames are skipped when given
         output : contextual feature [batch_size x T x output_size]
         """
         self.rnn.flatten_parameters()
         # batch_size x T x input_size -> batch_size x T x (2*hidden_size)
-        recurrent, _ = self.rnn(input)
+        if lengths is not None:
+            packed = nn.utils.rnn.pack_padded_sequence(input, lengths.cpu(), batch_first=True, enforce_sorted=False)
+            recurrent, _ = self.rnn(packed)
+            recurrent, _ = nn.utils.rnn.pad_packed_sequence(recurrent, batch_first=True, total_length=input.size(1))
+        else:
+            recurrent, _ = self.rnn(input)
         output = self.linear(recurrent)  # batch_size x T x output_size
         return output
 
@@ -33,10 +39,14 @@ class Transformer(nn.Module):
             d_word_vec=512, d_model=512, d_inner=1024,
             n_layers_enc=6, n_layers_dec=6, n_head=8, d_k=64, d_v=64, dropout=0.1,
             tgt_emb_prj_weight_sharing=False,
-            emb_src_tgt_weight_sharing=False):
+            emb_src_tgt_weight_sharing=False,
+            decode_mode='greedy', refine_iters=0):
 
         super().__init__()
         self.num_classes = n_tgt_vocab
+        assert decode_mode in ('greedy', 'parallel'), f'unknown decode_mode {decode_mode}'
+        self.decode_mode = decode_mode
+        self.refine_iters = refine_iters
         self.encoder = Encoder(
             n_src_vocab=n_src_vocab, len_max_seq=len_max_seq_enc,
             d_word_vec=d_word_vec, d_model=d_model, d_inner=d_inner,
@@ -69,31 +79,92 @@ class Transformer(nn.Module):
                 "To share word embedding table, the vocabulary size of src/tgt shall be the same."
             self.encoder.src_word_emb.weight = self.decoder.tgt_word_emb.weight
 
-    def forward(self, src_seq, src_pos, tgt_seq, tgt_pos, batch_max_length, is_train=True):
-        if is_train:
+    def set_checkpoint_layers(self, n_layers):
+        """ activation checkpointing of the first n_layers encoder and decoder layers in training """
+        self.encoder.checkpoint_layers = n_layers
+        self.decoder.checkpoint_layers = n_layers
+
+    def parallel_queries(self, tgt_seq):
+        """ CMLM style training input: the <s> token (never a target) is used as the mask token.
+        Each sample hides a random fraction of its target tokens, at least one, and all padding positions,
+        since the length is unknown at inference and every position is queried.
+        Returns the queries and the mask, the loss only covers the masked target tokens. """
+        target = tgt_seq[:, 1:]
+        real = target.ne(Constants.PAD)
+        mask_ratio = torch.rand(target.size(0), 1, device=target.device)
+        masked = torch.rand(target.size(), device=target.device) < mask_ratio
+        # mask_ratio may hide none of the tokens, so one random real token of every sample is always hidden
+        forced = torch.rand(target.size(), device=target.device).masked_fill_(~real, -1).argmax(1, keepdim=True)
+        masked.scatter_(1, forced, True)
+        masked |= ~real
+        return target.masked_fill(masked, Constants.BOS), masked
+
+    def refine_parallel(self, seq_logit, src_seq, enc_output, src_non_pad=None):
+        """ Mask-Predict: every pass re-masks the least confident tokens of the predicted length
+        (up to the first </s>), fewer on every pass, and re-predicts them. The positions after the
+        predicted length stay masked, like the padding in training. """
+        num_steps = seq_logit.size(1)
+        positions = torch.arange(num_steps, device=seq_logit.device)
+        probs, tokens = seq_logit.softmax(2).max(2)
+        for refine_iter in range(1, self.refine_iters + 1):
+            is_eos = tokens.eq(Constants.EOS)
+            length = torch.where(is_eos.any(1), is_eos.int().argmax(1) + 1, torch.full_like(tokens[:, 0], num_steps))
+            valid = positions < length.unsqueeze(1)
+            num_masked = length * (self.refine_iters + 1 - refine_iter) // (self.refine_iters + 1)
+            # rank of every position by confidence, the padding positions last
+            rank = probs.masked_fill(~valid, float('inf')).argsort(1).argsort(1)
+            update = (rank < num_masked.unsqueeze(1)) | ~valid
+            queries = tokens.masked_fill(update | tokens.eq(Constants.PAD), Constants.BOS)
+            new_logit = self.decode_parallel(queries, src_seq, enc_output, src_non_pad)
+            new_probs, new_tokens = new_logit.softmax(2).max(2)
+            seq_logit = torch.where(update.unsqueeze(2), new_logit, seq_logit)
+            probs = torch.where(update, new_probs, probs)
+            tokens = torch.where(update, new_tokens, tokens)
+        return seq_logit
+
+    def decode_parallel(self, queries, src_seq, enc_output, src_non_pad=None):
+        pos = get_position_ids(queries.size(0), queries.size(1), queries.device)
+        dec_output, *_ = self.decoder(queries, pos, src_seq, enc_output, src_non_pad=src_non_pad, causal=False)
+        return self.tgt_word_prj(dec_output) * self.x_logit_scale
+
+    def forward(self, src_seq, src_pos, tgt_seq, tgt_pos, batch_max_length, is_train=True, src_non_pad=None):
+        """ src_non_pad : b x len_src, False for the padded positions of variable width batches """
+        if is_train and self.decode_mode == 'parallel':
+            # returns the target as well, PAD where the query holds the target token
+            enc_output, *_ = self.encoder(src_seq, src_pos, src_non_pad=src_non_pad)
+            queries, masked = self.parallel_queries(tgt_seq)
+            target = tgt_seq[:, 1:].masked_fill(~masked, Constants.PAD)
+            return self.decode_parallel(queries, src_seq, enc_output, src_non_pad), target
+        elif is_train:
             tgt_seq, tgt_pos = tgt_seq[:, :-1], tgt_pos[:, :-1]
-            enc_output, *_ = self.encoder(src_seq, src_pos)
+            enc_output, *_ = self.encoder(src_seq, src_pos, src_non_pad=src_non_pad)
             dec_output, * \
-                _ = self.decoder(tgt_seq, tgt_pos, src_seq, enc_output)
+                _ = self.decoder(tgt_seq, tgt_pos, src_seq, enc_output, src_non_pad=src_non_pad)
             seq_logit = self.tgt_word_prj(dec_output) * self.x_logit_scale
             return seq_logit
+        elif self.decode_mode == 'parallel':
+            # one pass over all-mask queries, then refine_iters Mask-Predict passes
+            batch_size = src_seq.size(0)
+            num_steps = batch_max_length + 1
+            enc_output, *_ = self.encoder(src_seq, src_pos, src_non_pad=src_non_pad)
+            queries = torch.full((batch_size, num_steps), Constants.BOS, dtype=torch.long, device=src_seq.device)
+            seq_logit = self.decode_parallel(queries, src_seq, enc_output, src_non_pad)
+            return self.refine_parallel(seq_logit, src_seq, enc_output, src_non_pad)
         else:
             batch_size = src_seq.size(0)
             num_steps = batch_max_length + 1
-            seq_logit = torch.cuda.FloatTensor(
-                batch_size, num_steps, self.num_classes).fill_(0)
+            seq_logit = src_seq.new_zeros(batch_size, num_steps, self.num_classes)
 
-            enc_output, *_ = self.encoder(src_seq, src_pos)
+            enc_output, *_ = self.encoder(src_seq, src_pos, src_non_pad=src_non_pad)
             if tgt_pos is not None:
                 pos = tgt_pos
             else:
-                pos = torch.arange(
-                    1, num_steps+1, dtype=torch.long, device='cuda').expand(batch_size, -1)
-            ys = torch.zeros(batch_size, num_steps+1).long().cuda()
+                pos = get_position_ids(batch_size, num_steps, src_seq.device)
+            ys = torch.zeros(batch_size, num_steps+1, dtype=torch.long, device=src_seq.device)
             ys[:, 0] = Constants.BOS
             for i in range(num_steps):
                 out, *_ = self.decoder(ys[:, :i+1],
-                                       pos[:, :i+1], src_seq, enc_output)
+                                       pos[:, :i+1], src_seq, enc_output, src_non_pad=src_non_pad)
                 prob = self.tgt_word_prj(out) * self.x_logit_scale
                 seq_logit[:, i, :] = prob[:, -1, :]
                 _, next_word = torch.max(prob[:, -1, :], dim=1)
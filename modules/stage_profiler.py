@@ -0,0 +1,97 @@
+import json
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+
+class StageProfiler(object):
+    """ Opt-in instrumentation of Model.forward (set model.profiler = StageProfiler()).
+
+    For every stage it records the host wall time, the device time (CUDA events, resolved lazily so
+    nothing synchronizes while profiling), the peak device memory allocated on top of the memory
+    allocated on entry, and the output shape, and opens a torch.profiler record_function range named
+    after the stage. Records are aggregated over the run by summary() and export_chrome_trace().
+
+    The process-wide peak memory stats are left alone by default, as train.py and benchmark.py read
+    them, so the stage peak is an upper bound: exact when the stage raises the process peak.
+    With reset_peak the profiler owns the measurement window and resets the stats for exact stage peaks.
+    """
+
+    def __init__(self, use_cuda=None, reset_peak=False):
+        self.use_cuda = torch.cuda.is_available() if use_cuda is None else use_cuda
+        self.reset_peak = reset_peak
+        self.origin = time.perf_counter()
+        self.records = []
+
+    def reset(self):
+        self.origin = time.perf_counter()
+        self.records = []
+
+    @contextmanager
+    def stage(self, name):
+        record = {'name': name}
+        with torch.profiler.record_function(name):
+            if self.use_cuda:
+                if self.reset_peak:
+                    torch.cuda.reset_peak_memory_stats()
+                memory_start = torch.cuda.memory_allocated()
+                record['start_event'] = torch.cuda.Event(enable_timing=True)
+                record['end_event'] = torch.cuda.Event(enable_timing=True)
+                record['start_event'].record()
+            record['start'] = time.perf_counter()
+            yield record
+            record['wall'] = time.perf_counter() - record['start']
+            if self.use_cuda:
+                record['end_event'].record()
+                record['peak_memory'] = torch.cuda.max_memory_allocated() - memory_start
+        # the caller may store the stage output in record['output'], only its shape is kept.
+        output = record.pop('output', None)
+        record['shape'] = list(output.size()) if torch.is_tensor(output) else None
+        self.records.append(record)
+
+    def _resolve(self):
+        """ convert pending CUDA events into device times (seconds) """
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        for record in self.records:
+            if 'start_event' in record:
+                record['device'] = record.pop('start_event').elapsed_time(record.pop('end_event')) / 1000
+            elif 'device' not in record:
+                record['device'] = record['wall']
+        return self.records
+
+    def stats(self):
+        """ per-stage lists of wall and device times in seconds, in order of first appearance """
+        stats = {}
+        for record in self._resolve():
+            stage = stats.setdefault(record['name'], {'wall': [], 'device': [], 'peak_memory': 0, 'shape': None})
+            stage['wall'].append(record['wall'])
+            stage['device'].append(record['device'])
+            stage['peak_memory'] = max(stage['peak_memory'], record.get('peak_memory', 0))
+            stage['shape'] = record['shape']
+        return stats
+
+    def summary(self):
+        stats = self.stats()
+        total = sum(sum(stage['device']) for stage in stats.values())
+        table = f'{"stage":20s}{"calls":>8s}{"wall ms":>12s}{"device ms":>12s}{"p90 ms":>12s}{"share":>8s}'
+        table += f'{"+peak MiB":>10s}  output shape\n'
+        for name, stage in stats.items():
+            device = np.array(stage['device']) * 1000
+            share = device.sum() / (total * 1000) * 100 if total > 0 else 0
+            table += f'{name:20s}{len(device):8d}{np.mean(stage["wall"]) * 1000:12.3f}{device.mean():12.3f}'
+            table += f'{np.percentile(device, 90):12.3f}{share:7.1f}%{stage["peak_memory"] / 2**20:10.1f}  {stage["shape"]}\n'
+        return table
+
+    def export_chrome_trace(self, path):
+        """ write the records in the Chrome trace event format (chrome://tracing, perfetto) """
+        events = []
+        for record in self._resolve():
+            events.append({'name': record['name'], 'ph': 'X', 'pid': 0, 'tid': 0,
+                           'ts': (record['start'] - self.origin) * 1e6, 'dur': record['device'] * 1e6,
+                           'args': {'wall_ms': record['wall'] * 1000, 'shape': record['shape'],
+                                    'peak_memory': record.get('peak_memory', 0)}})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events}, f)
@@ -143,13 +143,21 @@ class GridGenerator(nn.Module):
         P_hat = np.concatenate([np.ones((n, 1)), P, rbf], axis=1)
         return P_hat  # n x F+3
 
-    def build_P_prime(self, batch_C_prime):
-        """ Generate Grid from batch_C_prime [batch_size x F x 2] """
+    def build_batch_P_hat(self, batch_P):
+        """ P_hat of per-sample points batch_P [batch_size x n x 2], like _build_P_hat """
+        C = batch_P.new_tensor(self.C)  # F x 2
+        rbf_norm = torch.norm(batch_P.unsqueeze(2) - C, dim=3)  # batch_size x n x F
+        rbf = rbf_norm.square() * torch.log(rbf_norm + self.eps)
+        return torch.cat([torch.ones_like(batch_P[:, :, :1]), batch_P, rbf], dim=2)  # batch_size x n x F+3
+
+    def build_P_prime(self, batch_C_prime, batch_P_hat=None):
+        """ Generate Grid from batch_C_prime [batch_size x F x 2], at the points of batch_P_hat if given """
         batch_size = batch_C_prime.size(0)
         batch_inv_delta_C = self.inv_delta_C.repeat(batch_size, 1, 1)
-        batch_P_hat = self.P_hat.repeat(batch_size, 1, 1)
-        batch_C_prime_with_zeros = torch.cat((batch_C_prime, torch.zeros(
-            batch_size, 3, 2).float().cuda()), dim=1)  # batch_size x F+3 x 2
+        if batch_P_hat is None:
+            batch_P_hat = self.P_hat.repeat(batch_size, 1, 1)
+        batch_C_prime_with_zeros = torch.cat((batch_C_prime, batch_C_prime.new_zeros(
+            batch_size, 3, 2)), dim=1)  # batch_size x F+3 x 2
         batch_T = torch.bmm(batch_inv_delta_C, batch_C_prime_with_zeros)  # batch_size x F+3 x 2
         batch_P_prime = torch.bmm(batch_P_hat, batch_T)  # batch_size x n x 2
         return batch_P_prime  # batch_size x n x 2
@@ -1,6 +1,8 @@
 ''' Define the Encoder Decoder block '''
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.utils.checkpoint
 import numpy as np
 try:
     import Constants
@@ -19,14 +21,9 @@ def get_non_pad_mask(seq):
 def get_sinusoid_encoding_table(n_position, d_hid, padding_idx=None):
     ''' Sinusoid position encoding table '''
 
-    def cal_angle(position, hid_idx):
-        return position / np.power(10000, 2 * (hid_idx // 2) / d_hid)
-
-    def get_posi_angle_vec(position):
-        return [cal_angle(position, hid_j) for hid_j in range(d_hid)]
-
-    sinusoid_table = np.array([get_posi_angle_vec(pos_i)
-                               for pos_i in range(n_position)])
+    position = np.arange(n_position)[:, np.newaxis]
+    hid_idx = np.arange(d_hid)[np.newaxis, :]
+    sinusoid_table = position / np.power(10000, 2 * (hid_idx // 2) / d_hid)
 
     sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2])  # dim 2i
     sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2])  # dim 2i+1
@@ -38,6 +35,32 @@ def get_sinusoid_encoding_table(n_position, d_hid, padding_idx=None):
     return torch.FloatTensor(sinusoid_table)
 
 
+# masks, positions and position tables only depend on length and device, keep them around and hand out views.
+_cache = {}
+
+
+def _cached(key, length, build):
+    ''' Return the cached tensor for key, rebuilt with a larger length when it is too short. '''
+    cached = _cache.get(key)
+    if cached is None or cached.size(0) < length:
+        cached = build(max(length, 2 * cached.size(0) if cached is not None else 64))
+        _cache[key] = cached
+    return cached
+
+
+def get_position_table(n_position, d_hid, device):
+    ''' Sinusoid position encoding table (position 0 is padding) with at least n_position rows '''
+    return _cached(('position_table', d_hid, device), n_position, lambda n: get_sinusoid_encoding_table(
+        n, d_hid, padding_idx=0).to(device))
+
+
+def get_position_ids(sz_b, len_s, device):
+    ''' Positions 1..len_s for every sequence of the batch, b x ls '''
+    position_ids = _cached(('position_ids', device), len_s, lambda n: torch.arange(
+        1, n + 1, dtype=torch.long, device=device))
+    return position_ids[:len_s].unsqueeze(0).expand(sz_b, -1)
+
+
 def get_attn_key_pad_mask(seq_k, seq_q):
     ''' For masking out the padding part of key sequence. '''
 
@@ -50,18 +73,30 @@ def get_attn_key_pad_mask(seq_k, seq_q):
     return padding_mask
 
 
+def get_src_key_pad_mask(src_non_pad, len_q):
+    ''' For masking out the padded feature columns of the source, src_non_pad is b x lk (True = valid). '''
+    return src_non_pad.eq(0).unsqueeze(1).expand(-1, len_q, -1)  # b x lq x lk
+
+
 def get_subsequent_mask(seq):
     ''' For masking out the subsequent info. '''
 
     sz_b, len_s = seq.size()
-    subsequent_mask = torch.triu(
-        torch.ones((len_s, len_s), device=seq.device, dtype=torch.uint8), diagonal=1)
-    subsequent_mask = subsequent_mask.unsqueeze(
+    subsequent_mask = _cached(('subsequent_mask', seq.device), len_s, lambda n: torch.triu(
+        torch.ones((n, n), device=seq.device, dtype=torch.bool), diagonal=1))
+    subsequent_mask = subsequent_mask[:len_s, :len_s].unsqueeze(
         0).expand(sz_b, -1, -1)  # b x ls x ls
 
     return subsequent_mask
 
 
+def run_layer(layer, checkpointed, *args):
+    """ layer(*args), recomputing its activations in backward instead of keeping them when checkpointed """
+    if checkpointed and layer.training and torch.is_grad_enabled():
+        return torch.utils.checkpoint.checkpoint(layer, *args, use_reentrant=False)
+    return layer(*args)
+
+
 class Encoder(nn.Module):
     ''' A encoder model with self attention mechanism. '''
 
@@ -85,26 +120,34 @@ class Encoder(nn.Module):
         self.layer_stack = nn.ModuleList([
             EncoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout=dropout)
             for _ in range(n_layers)])
+        self.checkpoint_layers = 0  # the first checkpoint_layers layers are recomputed in backward
 
-    def forward(self, src_seq, src_pos, return_attns=False):
+    def forward(self, src_seq, src_pos, return_attns=False, src_non_pad=None):
 
         enc_slf_attn_list = []
 
         # -- Prepare masks
-        # slf_attn_mask = get_attn_key_pad_mask(seq_k=src_seq, seq_q=src_seq)
-        # non_pad_mask = get_non_pad_mask(src_seq)
+        # src_seq is a sequence of features, padding (variable width batches) is given by src_non_pad.
+        if src_non_pad is not None:
+            slf_attn_mask = get_src_key_pad_mask(src_non_pad, src_seq.size(1))
+            non_pad_mask = src_non_pad.type(torch.float).unsqueeze(-1)
+        else:
+            slf_attn_mask, non_pad_mask = None, None
 
         # -- Forward
-        enc_output = self.src_word_emb(src_seq) + self.position_enc(src_pos)
+        if src_pos.size(1) < self.n_position:
+            position_enc = self.position_enc(src_pos)
+        else:
+            # wider input than the table was built for, the sinusoid table extends with the same values.
+            position_enc = F.embedding(src_pos, get_position_table(
+                src_pos.size(1) + 1, self.position_enc.embedding_dim, src_pos.device))
+        enc_output = self.src_word_emb(src_seq) + position_enc
         #enc_output = src_seq + self.position_enc(src_pos)
 
-        for enc_layer in self.layer_stack:
-            enc_output, enc_slf_attn = enc_layer(
-                enc_output,
-                non_pad_mask=None,
-                slf_attn_mask=None)
-            # non_pad_mask=non_pad_mask,
-            # slf_attn_mask=slf_attn_mask)
+        for i, enc_layer in enumerate(self.layer_stack):
+            enc_output, enc_slf_attn = run_layer(
+                enc_layer, i < self.checkpoint_layers,
+                enc_output, non_pad_mask, slf_attn_mask)
             if return_attns:
                 enc_slf_attn_list += [enc_slf_attn]
 
@@ -136,31 +179,33 @@ class Decoder(nn.Module):
         self.layer_stack = nn.ModuleList([
             DecoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout=dropout)
             for _ in range(n_layers)])
+        self.checkpoint_layers = 0  # the first checkpoint_layers layers are recomputed in backward
 
-    def forward(self, tgt_seq, tgt_pos, src_seq, enc_output, return_attns=False):
+    def forward(self, tgt_seq, tgt_pos, src_seq, enc_output, return_attns=False, src_non_pad=None, causal=True):
+        """ causal=False lets every query attend to the whole target (parallel decoding) """
 
         dec_slf_attn_list, dec_enc_attn_list = [], []
 
         # -- Prepare masks
         non_pad_mask = get_non_pad_mask(tgt_seq)
 
-        slf_attn_mask_subseq = get_subsequent_mask(tgt_seq)
-        slf_attn_mask_keypad = get_attn_key_pad_mask(
+        slf_attn_mask = get_attn_key_pad_mask(
             seq_k=tgt_seq, seq_q=tgt_seq)
-        slf_attn_mask = (slf_attn_mask_keypad + slf_attn_mask_subseq).gt(0)
+        if causal:
+            slf_attn_mask = slf_attn_mask | get_subsequent_mask(tgt_seq)
 
-        # dec_enc_attn_mask = get_attn_key_pad_mask(seq_k=src_seq, seq_q=tgt_seq)
+        if src_non_pad is not None:
+            dec_enc_attn_mask = get_src_key_pad_mask(src_non_pad, tgt_seq.size(1))
+        else:
+            dec_enc_attn_mask = None
 
         # -- Forward
         dec_output = self.tgt_word_emb(tgt_seq) + self.position_enc(tgt_pos)
 
-        for dec_layer in self.layer_stack:
-            dec_output, dec_slf_attn, dec_enc_attn = dec_layer(
-                dec_output, enc_output,
-                non_pad_mask=non_pad_mask,
-                slf_attn_mask=slf_attn_mask,
-                dec_enc_attn_mask=None)
-            # dec_enc_attn_mask=dec_enc_attn_mask)
+        for i, dec_layer in enumerate(self.layer_stack):
+            dec_output, dec_slf_attn, dec_enc_attn = run_layer(
+                dec_layer, i < self.checkpoint_layers,
+                dec_output, enc_output, non_pad_mask, slf_attn_mask, dec_enc_attn_mask)
 
             if return_attns:
                 dec_slf_attn_list += [dec_slf_attn]
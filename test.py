@@ -10,62 +10,217 @@ import numpy as np
 from nltk.metrics.distance import edit_distance
 
 from utils import CTCLabelConverter, AttnLabelConverter, Averager, TransformerLabelConverter
-from dataset import hierarchical_dataset, AlignCollate
-from model import Model
+from dataset import hierarchical_dataset, AlignCollate, BatchConcatDataset, lmdb_worker_init_fn
+from model import Model, get_preds_size
+from modules.stage_profiler import StageProfiler
+from modules.transformer_component.Block import get_position_ids
+from iotools import read_json, write_json
 
 
-def benchmark_all_eval(model, criterion, converter, opt, calculate_infer_time=False):
-    """ evaluation with 10 benchmark evaluation datasets """
-    # The evaluation datasets, dataset order is same with Table 1 in our paper.
-    eval_data_list = ['IIIT5k_3000', 'SVT', 'IC03_860', 'IC03_867', 'IC13_857',
-                      'IC13_1015', 'IC15_1811', 'IC15_2077', 'SVTP', 'CUTE80']
+# The evaluation datasets, dataset order is same with Table 1 in our paper.
+eval_data_list = ['IIIT5k_3000', 'SVT', 'IC03_860', 'IC03_867', 'IC13_857',
+                  'IC13_1015', 'IC15_1811', 'IC15_2077', 'SVTP', 'CUTE80']
+
+
+def shard_eval_data(eval_datasets, num_shards):
+    """ split the evaluation datasets into num_shards groups of similar total size (greedy, largest first) """
+    shards = [[] for _ in range(num_shards)]
+    shard_sizes = [0] * num_shards
+    for index in sorted(range(len(eval_datasets)), key=lambda i: -len(eval_datasets[i])):
+        smallest = shard_sizes.index(min(shard_sizes))
+        shards[smallest].append(index)
+        shard_sizes[smallest] += len(eval_datasets[index])
+    return [sorted(shard) for shard in shards]
+
 
+def benchmark_all_eval(model, criterion, converter, opt, calculate_infer_time=False):
+    """ evaluation with 10 benchmark evaluation datasets
+    All datasets are built once and evaluated through a single DataLoader, so one worker pool serves
+    every dataset and batches are packed across dataset boundaries. Accuracy is still counted per dataset.
+    With opt.num_shards > 1 only the datasets of shard opt.shard_id are evaluated, and the per-dataset
+    counts are written to a json file that merge_benchmark_shards() combines into the final report.
+    """
     if calculate_infer_time:
         # batch_size should be 1 to calculate the GPU inference time per image.
         evaluation_batch_size = 1
     else:
         evaluation_batch_size = opt.batch_size
 
-    list_accuracy = []
+    print('-' * 80)
+    eval_datasets = [hierarchical_dataset(root=os.path.join(opt.eval_data, eval_data), opt=opt)
+                     for eval_data in eval_data_list]
+    selected = list(range(len(eval_data_list)))
+    if opt.num_shards > 1:
+        selected = shard_eval_data(eval_datasets, opt.num_shards)[opt.shard_id]
+        print(f'shard {opt.shard_id}/{opt.num_shards}: {[eval_data_list[i] for i in selected]}')
+
+    AlignCollate_evaluation = AlignCollate(
+        imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD, variable_width=opt.variable_width)
+    evaluation_loader = torch.utils.data.DataLoader(
+        BatchConcatDataset([eval_datasets[i] for i in selected]), batch_size=evaluation_batch_size,
+        shuffle=False,
+        num_workers=int(opt.workers), worker_init_fn=lmdb_worker_init_fn,
+        collate_fn=AlignCollate_evaluation, pin_memory=True)
+    # dataset id of every sample, in loader order.
+    sample_dataset = np.repeat(selected, [len(eval_datasets[i]) for i in selected])
+
+    for p in model.parameters():
+        p.requires_grad = False
+
+    result = {eval_data_list[i]: {'length_of_data': 0, 'n_correct': 0, 'norm_ED': 0.0} for i in selected}
+    total_forward_time = 0
+    offset = 0
+    for batch in evaluation_loader:
+        image_tensors, labels = batch[:2]
+        input_widths = batch[2] if len(batch) > 2 else None
+        _, preds_str, labels, forward_time = predict_batch(model, criterion, image_tensors, labels, converter, opt,
+                                                           input_widths=input_widths)
+        total_forward_time += forward_time
+        for pred, gt in zip(preds_str, labels):
+            pred, gt = prune_eos(pred, gt, opt)
+            per_data = result[eval_data_list[sample_dataset[offset]]]
+            per_data['length_of_data'] += 1
+            per_data['n_correct'] += int(pred == gt)
+            per_data['norm_ED'] += edit_distance(pred, gt) / len(gt)
+            offset += 1
+
+    shard = {'result': result,
+             'total_forward_time': total_forward_time,
+             'params_num': int(sum([np.prod(p.size()) for p in model.parameters()]))}
+    if opt.num_shards > 1:
+        write_json(shard, f'./result/{opt.experiment_name}/benchmark_shard{opt.shard_id}.json')
+    else:
+        report_all_eval([shard], opt)
+
+    return None
+
+
+def merge_benchmark_shards(opt):
+    """ combine the json files written by every shard of benchmark_all_eval into one report """
+    shards = [read_json(f'./result/{opt.experiment_name}/benchmark_shard{shard_id}.json')
+              for shard_id in range(opt.num_shards)]
+    report_all_eval(shards, opt)
+
+
+def report_all_eval(shards, opt):
+    result = {}
     total_forward_time = 0
+    for shard in shards:
+        result.update(shard['result'])
+        total_forward_time += shard['total_forward_time']
+    params_num = shards[0]['params_num']
+
     total_evaluation_data_number = 0
     total_correct_number = 0
+    evaluation_log = 'accuracy: '
+    for name in eval_data_list:
+        per_data = result[name]
+        accuracy = per_data['n_correct'] / float(per_data['length_of_data']) * 100
+        print(f'{name}: Acc {accuracy:0.3f}\t normalized_ED {per_data["norm_ED"]:0.3f}')
+        evaluation_log += f'{name}: {accuracy:0.3f}\t'
+        total_evaluation_data_number += per_data['length_of_data']
+        total_correct_number += per_data['n_correct'] * 100
     print('-' * 80)
-    for eval_data in eval_data_list:
-        eval_data_path = os.path.join(opt.eval_data, eval_data)
-        AlignCollate_evaluation = AlignCollate(
-            imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD)
-        eval_data = hierarchical_dataset(root=eval_data_path, opt=opt)
-        evaluation_loader = torch.utils.data.DataLoader(
-            eval_data, batch_size=evaluation_batch_size,
-            shuffle=False,
-            num_workers=int(opt.workers),
-            collate_fn=AlignCollate_evaluation, pin_memory=True)
-
-        _, accuracy_by_best_model, norm_ED_by_best_model, _, _, infer_time, length_of_data = validation(
-            model, criterion, evaluation_loader, converter, opt)
-        list_accuracy.append(f'{accuracy_by_best_model:0.3f}')
-        total_forward_time += infer_time
-        total_evaluation_data_number += len(eval_data)
-        total_correct_number += accuracy_by_best_model * length_of_data
-        print('Acc %0.3f\t normalized_ED %0.3f' %
-              (accuracy_by_best_model, norm_ED_by_best_model))
-        print('-' * 80)
 
     averaged_forward_time = total_forward_time / total_evaluation_data_number * 1000
     total_accuracy = total_correct_number / total_evaluation_data_number
-    params_num = sum([np.prod(p.size()) for p in model.parameters()])
-
-    evaluation_log = 'accuracy: '
-    for name, accuracy in zip(eval_data_list, list_accuracy):
-        evaluation_log += f'{name}: {accuracy}\t'
     evaluation_log += f'total_accuracy: {total_accuracy:0.3f}\t'
     evaluation_log += f'averaged_infer_time: {averaged_forward_time:0.3f}\t# parameters: {params_num/1e6:0.3f}'
     print(evaluation_log)
     with open(f'./result/{opt.experiment_name}/log_all_evaluation.txt', 'a') as log:
         log.write(evaluation_log + '\n')
 
-    return None
+
+def prune_eos(pred, gt, opt):
+    """ prune prediction and ground truth after the "end of sentence" token """
+    if 'Transformer' in opt.SequenceModeling:
+        pred = pred[:pred.find('</s>')]
+        gt = gt[:gt.find('</s>')]
+    elif 'Attn' in opt.Prediction:
+        # prune after "end of sentence" token ([s])
+        pred = pred[:pred.find('[s]')]
+        gt = gt[:gt.find('[s]')]
+    return pred, gt
+
+
+def predict_batch(model, criterion, image_tensors, labels, converter, opt, encoded=None, input_widths=None):
+    """ forward one batch, return (cost, preds_str, labels, forward_time)
+    encoded : labels already encoded by the converter, e.g. by ResidentDataset.
+    input_widths : unpadded image widths of a variable width or PAD batch.
+    """
+    batch_size = image_tensors.size(0)
+    with torch.no_grad():
+        image = image_tensors.cuda()
+        # For max length prediction
+        length_for_pred = torch.cuda.IntTensor(
+            [opt.batch_max_length] * batch_size)
+        text_for_pred = torch.cuda.LongTensor(
+            batch_size, opt.batch_max_length + 1).fill_(0)
+
+        if encoded is not None:
+            text_for_loss, length_for_loss = encoded[:2]
+        elif 'Transformer' in opt.SequenceModeling:
+            text_for_loss, length_for_loss, text_pos_for_loss = converter.encode(
+                labels, opt.batch_max_length)
+        elif 'CTC' in opt.Prediction:
+            text_for_loss, length_for_loss = converter.encode(labels)
+        else:
+            text_for_loss, length_for_loss = converter.encode(
+                labels, opt.batch_max_length)
+
+    # forward calls are asynchronous on GPU, synchronize so forward_time covers the actual computation.
+    if 'Transformer' in opt.SequenceModeling:
+        text_pos = get_position_ids(batch_size, opt.batch_max_length + 1, image.device)
+
+    torch.cuda.synchronize()
+    start_time = time.time()
+    if 'Transformer' in opt.SequenceModeling:
+        preds = model(image, text_for_pred,
+                      is_train=False, tgt_pos=text_pos, input_widths=input_widths)
+        torch.cuda.synchronize()
+        forward_time = time.time() - start_time
+        preds = preds[:, :text_for_loss.shape[1] - 1, :]
+
+        target = text_for_loss[:, 1:]  # without [GO] Symbol
+        cost = criterion(preds.contiguous().view(-1,
+                                                 preds.shape[-1]), target.contiguous().view(-1))
+
+        # select max probabilty (greedy decoding) then decode index to character
+        _, preds_index = preds.max(2)
+        preds_str = converter.decode(preds_index, length_for_pred)
+        labels = converter.decode(text_for_loss[:, 1:], length_for_loss)
+    elif 'CTC' in opt.Prediction:
+        preds = model(image, text_for_pred, input_widths=input_widths).log_softmax(2)
+        torch.cuda.synchronize()
+        forward_time = time.time() - start_time
+
+        # Calculate evaluation loss for CTC deocder.
+        preds_size = get_preds_size(preds, input_widths, image.size(3), opt)
+        preds = preds.permute(1, 0, 2)  # to use CTCloss format
+        cost = criterion(preds, text_for_loss, preds_size, length_for_loss)
+
+        # Select max probabilty (greedy decoding) then decode the valid frames of every sample to character
+        _, preds_index = preds.max(2)
+        preds_index = preds_index.transpose(1, 0)
+        valid = torch.arange(preds_index.size(1)).unsqueeze(0) < preds_size.unsqueeze(1)
+        preds_str = converter.decode(preds_index[valid.to(preds_index.device)].data, preds_size.data)
+
+    else:
+        preds = model(image, text_for_pred, is_train=False, input_widths=input_widths)
+        torch.cuda.synchronize()
+        forward_time = time.time() - start_time
+
+        preds = preds[:, :text_for_loss.shape[1] - 1, :]
+        target = text_for_loss[:, 1:]  # without [GO] Symbol
+        cost = criterion(preds.contiguous().view(-1,
+                                                 preds.shape[-1]), target.contiguous().view(-1))
+
+        # select max probabilty (greedy decoding) then decode index to character
+        _, preds_index = preds.max(2)
+        preds_str = converter.decode(preds_index, length_for_pred)
+        labels = converter.decode(text_for_loss[:, 1:], length_for_loss)
+
+    return cost, preds_str, labels, forward_time
 
 
 def validation(model, criterion, evaluation_loader, converter, opt):
@@ -75,98 +230,27 @@ def validation(model, criterion, evaluation_loader, converter, opt):
 
     n_correct = 0
     norm_ED = 0
-    max_length = opt.batch_max_length
     length_of_data = 0
     infer_time = 0
     valid_loss_avg = Averager()
+    # labels pre-encoded by ResidentDataset.
+    encoded = getattr(evaluation_loader, 'encoded', None)
 
-    if 'Transformer' in opt.SequenceModeling:
-        text_pos = torch.arange(1, max_length+2, dtype=torch.long, device='cuda').expand(evaluation_loader.batch_size, -1)
-
-    for i, (image_tensors, labels) in enumerate(evaluation_loader):
+    for i, batch in enumerate(evaluation_loader):
+        image_tensors, labels = batch[:2]
+        input_widths = batch[2] if len(batch) > 2 else None
         batch_size = image_tensors.size(0)
         length_of_data = length_of_data + batch_size
-        with torch.no_grad():
-            image = image_tensors.cuda()
-            # For max length prediction
-            length_for_pred = torch.cuda.IntTensor(
-                [opt.batch_max_length] * batch_size)
-            text_for_pred = torch.cuda.LongTensor(
-                batch_size, opt.batch_max_length + 1).fill_(0)
-            
-            if 'Transformer' in opt.SequenceModeling:
-                text_for_loss, length_for_loss, text_pos_for_loss = converter.encode(
-                    labels, opt.batch_max_length)
-            elif 'CTC' in opt.Prediction:
-                text_for_loss, length_for_loss = converter.encode(labels)
-            else:
-                text_for_loss, length_for_loss = converter.encode(
-                    labels, opt.batch_max_length)
-
-        start_time = time.time()
-        if 'Transformer' in opt.SequenceModeling:
-            batch_text_pos = text_pos[:batch_size]
-            preds = model(image, text_for_pred,
-                          is_train=False, tgt_pos=batch_text_pos)
-            forward_time = time.time() - start_time
-            # print('test pred',preds[0].size(),text_for_loss.shape[1] - 1)
-            preds = preds[:, :text_for_loss.shape[1] - 1, :]
-
-            target = text_for_loss[:, 1:]  # without [GO] Symbol
-            # print('pred',preds.size(),target.size())
-            # print('pred[0]',preds[0],target[0])
-            cost = criterion(preds.contiguous().view(-1,
-                                                     preds.shape[-1]), target.contiguous().view(-1))
-
-            # select max probabilty (greedy decoding) then decode index to character
-            # print('cost',cost)
-            # exit()
-            _, preds_index = preds.max(2)
-            # print('preds_index',preds_index,length_for_pred)
-            # exit()
-            preds_str = converter.decode(preds_index, length_for_pred)
-            labels = converter.decode(text_for_loss[:, 1:], length_for_loss)
-        elif 'CTC' in opt.Prediction:
-            preds = model(image, text_for_pred).log_softmax(2)
-            forward_time = time.time() - start_time
-
-            # Calculate evaluation loss for CTC deocder.
-            preds_size = torch.IntTensor([preds.size(1)] * batch_size)
-            preds = preds.permute(1, 0, 2)  # to use CTCloss format
-            cost = criterion(preds, text_for_loss, preds_size, length_for_loss)
-
-            # Select max probabilty (greedy decoding) then decode index to character
-            _, preds_index = preds.max(2)
-            preds_index = preds_index.transpose(1, 0).contiguous().view(-1)
-            preds_str = converter.decode(preds_index.data, preds_size.data)
-
-        else:
-            preds = model(image, text_for_pred, is_train=False)
-            forward_time = time.time() - start_time
-
-            preds = preds[:, :text_for_loss.shape[1] - 1, :]
-            target = text_for_loss[:, 1:]  # without [GO] Symbol
-            cost = criterion(preds.contiguous().view(-1,
-                                                     preds.shape[-1]), target.contiguous().view(-1))
-
-            # select max probabilty (greedy decoding) then decode index to character
-            _, preds_index = preds.max(2)
-            preds_str = converter.decode(preds_index, length_for_pred)
-            labels = converter.decode(text_for_loss[:, 1:], length_for_loss)
+        cost, preds_str, labels, forward_time = predict_batch(
+            model, criterion, image_tensors, labels, converter, opt,
+            encoded=encoded[i] if encoded is not None else None, input_widths=input_widths)
 
         infer_time += forward_time
         valid_loss_avg.add(cost)
 
         # calculate accuracy.
         for pred, gt in zip(preds_str, labels):
-            if 'Transformer' in opt.SequenceModeling:
-                pred = pred[:pred.find('</s>')]
-                gt = gt[:gt.find('</s>')]
-            elif 'Attn' in opt.Prediction:
-                # prune after "end of sentence" token ([s])
-                pred = pred[:pred.find('[s]')]
-                gt = gt[:gt.find('[s]')]
-
+            pred, gt = prune_eos(pred, gt, opt)
             if pred == gt:
                 n_correct += 1
             norm_ED += edit_distance(pred, gt) / len(gt)
@@ -223,16 +307,20 @@ def test(opt):
 
     """ evaluation """
     model.eval()
+    if opt.fold_bn:
+        model.module.fold_bn()
+    if opt.profile_stages:
+        model.module.profiler = StageProfiler()
     if opt.benchmark_all_eval:  # evaluation with 10 benchmark evaluation datasets
         benchmark_all_eval(model, criterion, converter, opt)
     else:
         AlignCollate_evaluation = AlignCollate(
-            imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD)
+            imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD, variable_width=opt.variable_width)
         eval_data = hierarchical_dataset(root=opt.eval_data, opt=opt)
         evaluation_loader = torch.utils.data.DataLoader(
             eval_data, batch_size=opt.batch_size,
             shuffle=False,
-            num_workers=int(opt.workers),
+            num_workers=int(opt.workers), worker_init_fn=lmdb_worker_init_fn,
             collate_fn=AlignCollate_evaluation, pin_memory=True)
         _, accuracy_by_best_model, _, _, _, _, _ = validation(
             model, criterion, evaluation_loader, converter, opt)
@@ -241,6 +329,22 @@ def test(opt):
         with open('./result/{0}/log_evaluation.txt'.format(opt.experiment_name), 'a') as log:
             log.write(str(accuracy_by_best_model) + '\n')
 
+    if opt.profile_stages:
+        profile_summary = model.module.profiler.summary()
+        print(profile_summary)
+        with open(f'./result/{opt.experiment_name}/log_stage_profile.txt', 'a') as log:
+            log.write(profile_summary + '\n')
+        model.module.profiler.export_chrome_trace(f'./result/{opt.experiment_name}/stage_profile_trace.json')
+
+
+def run_shard(shard_id, opt):
+    """ entry point of one benchmark_all_eval shard process, each shard is pinned to one device """
+    if opt.num_gpu > 0:
+        visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES', ','.join(map(str, range(opt.num_gpu)))).split(',')
+        os.environ['CUDA_VISIBLE_DEVICES'] = visible_devices[shard_id % opt.num_gpu]
+    opt.shard_id = shard_id
+    test(opt)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -248,12 +352,22 @@ if __name__ == '__main__':
                         help='path to evaluation dataset')
     parser.add_argument('--benchmark_all_eval', action='store_true',
                         help='evaluate 10 benchmark evaluation datasets')
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='split the benchmark evaluation datasets into this many shards')
+    parser.add_argument('--shard_id', type=int, default=-1,
+                        help='evaluate only this shard. -1 runs every shard in its own process and merges the results')
+    parser.add_argument('--merge_shards', action='store_true',
+                        help='only combine the results of already evaluated shards into one report')
+    parser.add_argument('--profile_stages', action='store_true',
+                        help='record per-stage time, memory and shapes, and export a summary and a chrome trace')
     parser.add_argument('--workers', type=int,
                         help='number of data loading workers', default=4)
+    parser.add_argument('--decode_threads', type=int, default=2, help='image decoding threads per data loading worker, 1 decodes serially')
     parser.add_argument('--batch_size', type=int,
                         default=192, help='input batch size')
     parser.add_argument('--saved_model', required=True,
                         help="path to saved_model to evaluation")
+    parser.add_argument('--fold_bn', action='store_true', help='fold batch norms for inference (RCNN)')
     """ Data processing """
     parser.add_argument('--batch_max_length', type=int,
                         default=25, help='maximum-label-length')
@@ -268,6 +382,8 @@ if __name__ == '__main__':
                         help='for sensitive character mode')
     parser.add_argument('--PAD', action='store_true',
                         help='whether to keep ratio then pad for image resize')
+    parser.add_argument('--variable_width', action='store_true',
+                        help='keep the ratio of each image up to imgW and pad per batch, masking the padding (Transformer)')
     """ Model Architecture """
     parser.add_argument('--Transformation', type=str,
                         required=True, help='Transformation stage. None|TPS')
@@ -285,6 +401,7 @@ if __name__ == '__main__':
                         help='the number of output channel of Feature extractor')
     parser.add_argument('--hidden_size', type=int, default=256,
                         help='the size of the LSTM hidden state')
+    parser.add_argument('--channels_last', action='store_true', help='run the convolutional stages in channels_last')
     """Transformer"""
     parser.add_argument('-d_word_vec', type=int, default=512)
     parser.add_argument('-d_model', type=int, default=512)
@@ -298,6 +415,9 @@ if __name__ == '__main__':
     parser.add_argument('-n_warmup_steps', type=int, default=5000)
 
     parser.add_argument('-dropout', type=float, default=0.1)
+    parser.add_argument('--decode_mode', type=str, default='greedy', help='Transformer decoding: greedy | parallel')
+    parser.add_argument('--refine_iters', type=int, default=2,
+                        help='refinement passes that re-feed the predictions in parallel decoding')
     parser.add_argument('-embs_share_weight', action='store_true')
     parser.add_argument('-proj_share_weight', action='store_true')
     parser.add_argument('-use_scheduled_optim', action='store_true')
@@ -314,4 +434,11 @@ if __name__ == '__main__':
     cudnn.deterministic = True
     opt.num_gpu = torch.cuda.device_count()
 
-    test(opt)
+    if opt.benchmark_all_eval and opt.num_shards > 1 and (opt.shard_id < 0 or opt.merge_shards):
+        if not opt.merge_shards:
+            # one process per shard, spread over the visible devices.
+            torch.multiprocessing.spawn(run_shard, args=(opt,), nprocs=opt.num_shards)
+        opt.experiment_name = '_'.join(opt.saved_model.split('/')[1:])
+        merge_benchmark_shards(opt)
+    else:
+        test(opt)
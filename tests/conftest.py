@@ -0,0 +1,37 @@
+import os
+import sys
+import argparse
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def make_opt():
+    """ model options like the train.py / test.py defaults, overridden by keyword """
+    def make(**kwargs):
+        opt = dict(Transformation='None', FeatureExtraction='VGG', SequenceModeling='BiLSTM', Prediction='Attn',
+                   imgH=32, imgW=100, num_fiducial=20, input_channel=1, output_channel=64, hidden_size=32,
+                   num_class=38, batch_max_length=25, channels_last=False, character='0123456789abcdefghijklmnopqrstuvwxyz',
+                   d_word_vec=64, d_model=64, d_inner_hid=64, d_k=16, d_v=16, n_head=4, n_layers_enc=1,
+                   n_layers_dec=1, dropout=0.1, decode_mode='greedy', refine_iters=2,
+                   embs_share_weight=False, proj_share_weight=False)
+        opt.update(kwargs)
+        return argparse.Namespace(**opt)
+    return make
+
+
+@pytest.fixture
+def lmdb_root(tmp_path):
+    """ an LMDB dataset of 7 small word images, written by create_lmdb_dataset.py under tmp_path/lmdb/train """
+    from PIL import Image
+    from create_lmdb_dataset import createDataset
+
+    (tmp_path / 'img').mkdir()
+    with open(tmp_path / 'gt.txt', 'w') as gt:
+        for index in range(7):
+            Image.new('L', (40 + 10 * index, 32), color=index * 30).save(tmp_path / 'img' / f'{index}.png')
+            gt.write(f'{index}.png\tWord{index}\n')
+    createDataset(str(tmp_path / 'img'), str(tmp_path / 'gt.txt'), str(tmp_path / 'lmdb' / 'train'), checkValid=False)
+    return str(tmp_path / 'lmdb')
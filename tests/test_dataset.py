@@ -0,0 +1,66 @@
+import numpy as np
+import torch
+
+from dataset import (Batch_Balanced_Dataset, TokenBudgetBatchSampler, ResidentDataset, AlignCollate, hierarchical_dataset,
+                     normalize_label)
+
+
+def test_normalize_label(make_opt):
+    assert normalize_label('Hello, World!', make_opt(sensitive=False)) == 'helloworld'
+    assert normalize_label('Hello, World!', make_opt(sensitive=True, character='HWdelor')) == 'HelloWorld'
+
+
+def test_token_budget_len_counts_batches():
+    rng = np.random.RandomState(0)
+    label_lengths = rng.randint(1, 26, size=1000)
+    for token_budget, max_length in [(0, 25), (400, 25), (400, 10)]:
+        sampler = TokenBudgetBatchSampler(label_lengths, None, 16, token_budget=token_budget, pool_batches=4)
+        sampler.max_length = max_length
+        for _ in range(2):
+            length = len(sampler)
+            batches = list(sampler)
+            assert length == len(batches)
+            assert all(label_lengths[batch].max() <= max_length for batch in batches)
+
+
+def test_token_budget_cut_matches_greedy_loop():
+    rng = np.random.RandomState(0)
+    sampler = TokenBudgetBatchSampler(rng.randint(1, 26, size=2000), rng.randint(20, 101, size=2000), 32,
+                                      token_budget=1600, imgW=100)
+    pool = rng.permutation(2000)
+    pool = pool[np.argsort(sampler.label_tokens[pool] + sampler.width_tokens[pool], kind='stable')]
+    expected, start = [], 0
+    max_label = max_width = 0
+    for end, index in enumerate(pool):
+        max_label = max(max_label, sampler.label_tokens[index])
+        max_width = max(max_width, sampler.width_tokens[index])
+        if end > start and (end + 1 - start) * (max_label + max_width) > sampler.token_budget:
+            expected.append(pool[start:end].tolist())
+            start = end
+            max_label, max_width = sampler.label_tokens[index], sampler.width_tokens[index]
+    expected.append(pool[start:].tolist())
+    assert [batch.tolist() for batch in sampler._cut(pool)] == expected
+
+
+def test_batch_balanced_dataset_cycles(make_opt, lmdb_root):
+    opt = make_opt(train_data=lmdb_root, select_data=['train'], batch_ratio=['1'], PAD=False, variable_width=False,
+                   batch_size=4, total_data_usage_ratio='1.0', token_budget=0, curriculum_iters=0,
+                   hard_sampling=False, workers=0, manualSeed=1, sensitive=False, rgb=False, decode_threads=1,
+                   data_filtering_off=False)
+    train_dataset = Batch_Balanced_Dataset(opt)
+    # 7 samples in batches of 4: the third batch starts a new epoch of the loader
+    sizes = [train_dataset.get_batch()[0].size(0) for _ in range(3)]
+    assert sizes == [4, 3, 4]
+
+
+def test_resident_dataset_matches_loader(make_opt, lmdb_root):
+    opt = make_opt(sensitive=False, rgb=False, PAD=False, variable_width=False, data_filtering_off=False,
+                   decode_threads=1)
+    dataset = hierarchical_dataset(root=lmdb_root, opt=opt)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=3, shuffle=False,
+                                         collate_fn=AlignCollate(imgH=opt.imgH, imgW=opt.imgW))
+    resident = ResidentDataset(loader)
+    assert len(resident) == len(loader)
+    for (images, labels), (resident_images, resident_labels) in zip(loader, resident):
+        assert torch.allclose(resident_images.cpu(), images, atol=1e-6)
+        assert tuple(labels) == resident_labels
@@ -0,0 +1,33 @@
+import os
+
+import torch
+import torch.nn as nn
+
+from iotools import CheckpointWriter, snapshot_to_cpu
+
+
+def test_snapshot_keeps_state_dict_metadata():
+    state_dict = nn.Sequential(nn.Conv2d(1, 2, 3), nn.BatchNorm2d(2)).state_dict()
+    snapshot = snapshot_to_cpu({'state_dict': state_dict})['state_dict']
+    assert snapshot._metadata == state_dict._metadata
+    assert snapshot._metadata['1']['version'] == nn.BatchNorm2d._version
+
+
+def test_keep_last_prunes_resumed_checkpoints(tmp_path):
+    for step in [1000, 2000, 3000, 10000]:
+        torch.save({'step': step}, tmp_path / f'iter_{step}.pth')
+    torch.save({}, tmp_path / 'best_accuracy.pth')
+    checkpointer = CheckpointWriter(keep_last=2, asynchronous=True)
+    for step in [11000, 12000]:
+        checkpointer.save({'step': step}, False, str(tmp_path / f'iter_{step}.pth'), rotate=True)
+    checkpointer.close()
+    assert sorted(os.listdir(tmp_path)) == ['best_accuracy.pth', 'iter_11000.pth', 'iter_12000.pth']
+
+
+def test_is_best_links_best_model(tmp_path):
+    checkpointer = CheckpointWriter(asynchronous=False)
+    checkpointer.save({'step': 1}, True, str(tmp_path / 'checkpoint.pth.tar'))
+    checkpointer.save({'step': 2}, False, str(tmp_path / 'checkpoint.pth.tar'))
+    checkpointer.close()
+    assert torch.load(tmp_path / 'best_model.pth.tar')['step'] == 1
+    assert torch.load(tmp_path / 'checkpoint.pth.tar')['step'] == 2
@@ -0,0 +1,20 @@
+import torch
+
+from benchmark import dense_smoothed_loss
+from train import transformer_loss
+
+
+def test_fused_smoothing_matches_dense_one_hot():
+    torch.manual_seed(0)
+    gold = torch.randint(0, 40, (6, 27))
+    gold[:, 20:] = 2  # PAD
+    logits = torch.randn(gold.numel(), 40, dtype=torch.float64)
+    losses, grads = [], []
+    for criterion in [dense_smoothed_loss, lambda pred, gold: transformer_loss(pred, gold, smoothing=True)]:
+        pred = logits.clone().requires_grad_()
+        loss = criterion(pred, gold)
+        loss.backward()
+        losses.append(loss.detach())
+        grads.append(pred.grad)
+    assert torch.allclose(losses[0], losses[1])
+    assert torch.allclose(grads[0], grads[1])
@@ -0,0 +1,27 @@
+import json
+
+import torch
+
+import metrics
+from metrics import TrainMetrics
+
+
+def test_throughput_excludes_validation(tmp_path, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(metrics.time, 'time', lambda: clock[0])
+    train_metrics = TrainMetrics(str(tmp_path), interval=2, device='cpu')
+    for step in range(2):
+        clock[0] += 1.0  # one second per training step
+        train_metrics.add_batch(torch.tensor(0.5), 10, torch.tensor(3), torch.tensor(4), torch.tensor(1))
+        train_metrics.add_data_time(0.5)
+        if step == 0:
+            clock[0] += 8.0  # validation
+            train_metrics.exclude_time(8.0)
+        train_metrics.step(step)
+    train_metrics.close()
+    with open(tmp_path / 'metrics.jsonl') as f:
+        record = json.loads(f.readline())
+    assert record['images_per_sec'] == 10.0
+    assert record['data_wait'] == 0.5
+    assert record['loss'] == 0.5
+    assert record['token_accuracy'] == 0.75
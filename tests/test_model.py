@@ -0,0 +1,183 @@
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from model import Model
+from modules.feature_extraction import GRCL, GRCL_unit
+
+
+def test_attn_pad_ignores_widths(make_opt):
+    """ a PAD (keep_ratio_with_pad) Attn checkpoint gives the outputs it gave without widths """
+    torch.manual_seed(0)
+    opt = make_opt(Prediction='Attn')
+    checkpoint = Model(opt).state_dict()
+    model = Model(opt)
+    model.load_state_dict(checkpoint)
+    model.eval()
+    image = torch.rand(3, 1, opt.imgH, opt.imgW) * 2 - 1
+    text = torch.zeros(3, opt.batch_max_length + 1, dtype=torch.long)
+    with torch.no_grad():
+        expected = model(image, text, is_train=False)
+        full = model(image, text, is_train=False, input_widths=torch.IntTensor([opt.imgW] * 3))
+        padded = model(image, text, is_train=False, input_widths=torch.IntTensor([opt.imgW, 60, 30]))
+    assert torch.equal(full, expected)
+    assert torch.equal(padded, expected)
+
+
+def test_ctc_full_widths_match_unpacked(make_opt):
+    torch.manual_seed(0)
+    opt = make_opt(Prediction='CTC')
+    model = Model(opt).eval()
+    image = torch.rand(2, 1, opt.imgH, opt.imgW) * 2 - 1
+    with torch.no_grad():
+        expected = model(image, None)
+        full = model(image, None, input_widths=torch.IntTensor([opt.imgW] * 2))
+    assert torch.allclose(full, expected, atol=1e-6)
+
+
+def test_transformer_greedy_on_cpu(make_opt):
+    torch.manual_seed(0)
+    opt = make_opt(FeatureExtraction='SimpleConv', SequenceModeling='Transformer', Prediction='None', output_channel=512)
+    model = Model(opt).eval()
+    image = torch.rand(2, 1, opt.imgH, opt.imgW) * 2 - 1
+    with torch.no_grad():
+        preds = model(image, None, is_train=False)
+    assert preds.device.type == 'cpu'
+    assert preds.shape == (2, opt.batch_max_length + 1, opt.num_class)
+
+
+class ReferenceGRCL(nn.Module):
+    """ GRCL as it was before the fused convolutions: one conv and five batch norms per unit and iteration """
+
+    def __init__(self, input_channel, output_channel, num_iteration, kernel_size, pad):
+        super(ReferenceGRCL, self).__init__()
+        self.wgf_u = nn.Conv2d(input_channel, output_channel, 1, 1, 0, bias=False)
+        self.wgr_x = nn.Conv2d(output_channel, output_channel, 1, 1, 0, bias=False)
+        self.wf_u = nn.Conv2d(input_channel, output_channel, kernel_size, 1, pad, bias=False)
+        self.wr_x = nn.Conv2d(output_channel, output_channel, kernel_size, 1, pad, bias=False)
+        self.BN_x_init = nn.BatchNorm2d(output_channel)
+        self.GRCL = nn.Sequential(*[GRCL_unit(output_channel) for _ in range(num_iteration)])
+
+    def forward(self, input):
+        wgf_u = self.wgf_u(input)
+        wf_u = self.wf_u(input)
+        x = F.relu(self.BN_x_init(wf_u))
+        for unit in self.GRCL:
+            G = torch.sigmoid(unit.BN_gfu(wgf_u) + unit.BN_grx(self.wgr_x(x)))
+            x = F.relu(unit.BN_fu(wf_u) + unit.BN_Gx(unit.BN_rx(self.wr_x(x)) * G))
+        return x
+
+
+def randomize_batch_norms(module):
+    for batch_norm in module.modules():
+        if isinstance(batch_norm, nn.BatchNorm2d):
+            batch_norm.weight.data.uniform_(0.5, 1.5)
+            batch_norm.bias.data.uniform_(-0.5, 0.5)
+            batch_norm.running_mean.uniform_(-0.5, 0.5)
+            batch_norm.running_var.uniform_(0.5, 1.5)
+
+
+def test_grcl_matches_reference():
+    torch.manual_seed(0)
+    grcl = GRCL(8, 16, num_iteration=5, kernel_size=3, pad=1)
+    randomize_batch_norms(grcl)
+    reference = ReferenceGRCL(8, 16, num_iteration=5, kernel_size=3, pad=1)
+    reference.load_state_dict(grcl.state_dict(), strict=True)
+    input = torch.randn(4, 8, 8, 20)
+
+    grcl.eval(), reference.eval()
+    with torch.no_grad():
+        expected = reference(input)
+        assert torch.allclose(grcl(input), expected, atol=1e-5)
+        assert torch.allclose(grcl.fold_bn()(input), expected, atol=1e-5)
+
+    grcl.train(), reference.train()
+    assert grcl.folded_weight is None
+    assert torch.allclose(grcl(input), reference(input), atol=1e-5)
+    for (name, buffer), (_, expected_buffer) in zip(grcl.state_dict().items(), reference.state_dict().items()):
+        assert torch.allclose(buffer.float(), expected_buffer.float(), atol=1e-6), name
+
+
+def test_rcnn_loads_reference_state_dict(make_opt):
+    """ an RCNN checkpoint of the unfused GRCL loads strictly and gives the same outputs, folded or not """
+    torch.manual_seed(0)
+    opt = make_opt(FeatureExtraction='RCNN', Prediction='CTC')
+    reference = Model(opt)
+    for index, module in enumerate(reference.FeatureExtraction.ConvNet):
+        if isinstance(module, GRCL):
+            reference.FeatureExtraction.ConvNet[index] = ReferenceGRCL(
+                module.wgf_u.in_channels, module.wgf_u.out_channels, module.num_iteration, 3, 1)
+    randomize_batch_norms(reference)
+    model = Model(opt)
+    model.load_state_dict(copy.deepcopy(reference.state_dict()), strict=True)
+
+    reference.eval(), model.eval()
+    image = torch.rand(2, 1, opt.imgH, opt.imgW) * 2 - 1
+    with torch.no_grad():
+        expected = reference(image, None)
+        assert torch.allclose(model(image, None), expected, atol=1e-4)
+        assert torch.allclose(model.fold_bn()(image, None), expected, atol=1e-4)
+
+
+def parallel_model(make_opt, refine_iters):
+    opt = make_opt(FeatureExtraction='SimpleConv', SequenceModeling='Transformer', Prediction='None', output_channel=512,
+                   decode_mode='parallel', refine_iters=refine_iters)
+    return Model(opt), opt
+
+
+def test_parallel_training_targets_masked_positions(make_opt):
+    torch.manual_seed(0)
+    model, opt = parallel_model(make_opt, 0)
+    transformer = model.SequenceModeling
+    # <s> + labels of 1 to 4 characters + </s>, PAD after
+    text = torch.full((64, opt.batch_max_length + 2), 2, dtype=torch.long)
+    text[:, 0] = 0
+    for index in range(64):
+        length = index % 4 + 1
+        text[index, 1:length + 1] = torch.randint(3, opt.num_class, (length,))
+        text[index, length + 1] = 1
+    queries, masked = transformer.parallel_queries(text)
+    target = text[:, 1:]
+    real = target.ne(2)
+    assert (masked & real).any(1).all()  # every sample masks at least one real token
+    assert queries[masked].eq(0).all() and torch.equal(queries[~masked], target[~masked])
+
+    image = torch.rand(64, 1, opt.imgH, opt.imgW) * 2 - 1
+    text_pos = torch.arange(text.size(1)).repeat(64, 1)
+    preds, loss_target = model(image, text, tgt_pos=text_pos)
+    assert preds.shape == (64, opt.batch_max_length + 1, opt.num_class)
+    # the tokens given in the queries are not targets
+    assert loss_target.ne(2).sum() < real.sum()
+    assert loss_target.ne(2).any(1).all()
+
+
+def test_parallel_refinement_remasks_least_confident(make_opt, monkeypatch):
+    torch.manual_seed(0)
+    model, opt = parallel_model(make_opt, 0)
+    model.eval()
+    image = torch.rand(2, 1, opt.imgH, opt.imgW) * 2 - 1
+    with torch.no_grad():
+        single_pass = model(image, None, is_train=False)
+
+    transformer = model.SequenceModeling
+    transformer.refine_iters = 2
+    queries_seen = []
+    decode_parallel = transformer.decode_parallel
+
+    def record_queries(queries, *args):
+        queries_seen.append(queries.clone())
+        return decode_parallel(queries, *args)
+
+    monkeypatch.setattr(transformer, 'decode_parallel', record_queries)
+    with torch.no_grad():
+        refined = model(image, None, is_train=False)
+    assert len(queries_seen) == 3
+    assert queries_seen[0].eq(0).all()
+    # the first refinement pass gets partially masked queries: some predictions kept, some re-masked
+    first = queries_seen[1]
+    assert first.ne(0).any() and first.eq(0).any()
+    assert not torch.equal(refined, single_pass)
+    # fewer tokens are re-masked on the last pass
+    assert queries_seen[2].eq(0).sum() <= first.eq(0).sum()
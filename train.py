@@ -13,13 +13,16 @@ import torch.utils.data
 import numpy as np
 
 from utils import CTCLabelConverter, AttnLabelConverter, Averager, TransformerLabelConverter
-from dataset import hierarchical_dataset, AlignCollate, Batch_Balanced_Dataset
-from model import Model
+from dataset import hierarchical_dataset, AlignCollate, Batch_Balanced_Dataset, ResidentDataset, lmdb_worker_init_fn
+from model import Model, get_preds_size
+from modules.augmentation import BatchAugmentation
 from test import validation
 import modules.transformer_component.Constants as Constants
 from Optim import ScheduledOptim
-from iotools import save_checkpoint, check_isfile
+from iotools import CheckpointWriter, check_isfile
+from metrics import TrainMetrics, sequence_accuracy, ctc_accuracy
 import pickle
+from contextlib import nullcontext
 from functools import partial
 from tqdm import tqdm
 import torch.nn.functional as F
@@ -38,8 +41,9 @@ def count_num_param(model):
     return num_param
 
 
-def transformer_loss(pred, gold, smoothing=False):
-    ''' Calculate cross entropy loss, apply label smoothing if needed. '''
+def transformer_loss(pred, gold, smoothing=False, reduction='mean'):
+    ''' Calculate cross entropy loss, apply label smoothing if needed.
+    reduction='none' returns the loss of every token, 0 for padding. '''
 
     gold = gold.contiguous().view(-1)
 
@@ -47,20 +51,79 @@ def transformer_loss(pred, gold, smoothing=False):
         eps = 0.1
         n_class = pred.size(1)
 
-        one_hot = torch.zeros_like(pred).scatter(1, gold.view(-1, 1), 1)
-        one_hot = one_hot * (1 - eps) + (1 - one_hot) * eps / (n_class - 1)
+        # the target gets 1 - eps and every other class eps / (n_class - 1). Without a dense smoothed one-hot,
+        # -(one_hot * log_prb).sum(1) = -((1 - eps - off_value) * log_prb[gold] + off_value * log_prb.sum(1))
         log_prb = F.log_softmax(pred, dim=1)
+        gold_log_prb = log_prb.gather(1, gold.view(-1, 1)).squeeze(1)
+        off_value = eps / (n_class - 1)
 
         non_pad_mask = gold.ne(Constants.PAD)
-        loss = -(one_hot * log_prb).sum(dim=1)
-        loss = loss.masked_select(non_pad_mask).mean()
+        loss = -((1 - eps - off_value) * gold_log_prb + off_value * log_prb.sum(dim=1))
+        if reduction == 'none':
+            loss = loss * non_pad_mask
+        else:
+            loss = loss.masked_select(non_pad_mask).mean()
     else:
         loss = F.cross_entropy(
-            pred, gold, ignore_index=Constants.PAD, reduction='mean')
+            pred, gold, ignore_index=Constants.PAD, reduction=reduction)
 
     return loss
 
 
+def forward_batch(model, criterion, converter, batch, opt, augment=None, metrics=None):
+    """
+    loss of one (micro-)batch from Batch_Balanced_Dataset.get_batch, and the (detached) loss of every sample.
+    criterion has reduction='none', the batch loss is reduced like the default 'mean' reduction.
+    The loss and accuracy of the batch are added to metrics (TrainMetrics) on the device.
+    """
+    cpu_images, cpu_texts = batch[:2]
+    input_widths = batch[2] if len(batch) > 2 else None
+    image = cpu_images.cuda()
+    if augment is not None:
+        image = augment(image, input_widths)
+    batch_max_length = opt.batch_max_length
+    if opt.token_budget > 0 or opt.curriculum_iters > 0:
+        # the decoders only run up to the longest label of the batch
+        batch_max_length = max(len(t) for t in cpu_texts)
+    if 'Transformer' in opt.SequenceModeling:
+        text, length, text_pos = converter.encode(
+            cpu_texts, batch_max_length)
+    elif 'CTC' in opt.Prediction:
+        text, length = converter.encode(cpu_texts)
+    else:
+        text, length = converter.encode(cpu_texts, batch_max_length)
+
+    if 'CTC' in opt.Prediction and 'Transformer' not in opt.SequenceModeling:
+        preds = model(image, text, input_widths=input_widths).log_softmax(2)
+        preds_size = get_preds_size(preds, input_widths, image.size(3), opt)
+        preds = preds.permute(1, 0, 2)  # to use CTCLoss format
+        # 'mean' divides the loss of every sample by its target length
+        sample_losses = criterion(preds, text, preds_size, length) / length.to(preds.device).clamp(min=1)
+        cost = sample_losses.mean()
+        if metrics is not None:
+            metrics.add_batch(cost, image.size(0), *ctc_accuracy(preds.permute(1, 0, 2), preds_size, text, length))
+        return cost, sample_losses.detach()
+
+    if 'Transformer' in opt.SequenceModeling:
+        preds = model(image, text, tgt_pos=text_pos, input_widths=input_widths)
+        target = text[:, 1:]  # without <s> Symbol
+        if opt.decode_mode == 'parallel':
+            # only the masked positions are targets, the others are given in the queries
+            preds, target = preds
+        ignore_index = Constants.PAD
+    else:
+        preds = model(image, text, input_widths=input_widths)
+        target = text[:, 1:]  # without [GO] Symbol
+        ignore_index = 0
+    token_losses = criterion(
+        preds.view(-1, preds.shape[-1]), target.contiguous().view(-1)).view(target.size())
+    num_tokens = target.ne(ignore_index).sum(1)
+    cost = token_losses.sum() / num_tokens.sum()
+    if metrics is not None:
+        metrics.add_batch(cost, image.size(0), *sequence_accuracy(preds.detach(), target, ignore_index))
+    return cost, (token_losses.sum(1) / num_tokens.clamp(min=1)).detach()
+
+
 def train(opt):
     """ dataset preparation """
     opt.select_data = opt.select_data.split('-')
@@ -68,13 +131,13 @@ def train(opt):
     train_dataset = Batch_Balanced_Dataset(opt)
 
     AlignCollate_valid = AlignCollate(
-        imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD)
+        imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD, variable_width=opt.variable_width)
     valid_dataset = hierarchical_dataset(root=opt.valid_data, opt=opt)
     valid_loader = torch.utils.data.DataLoader(
         valid_dataset, batch_size=opt.batch_size,
         # 'True' to check training progress with validation function.
         shuffle=True,
-        num_workers=int(opt.workers),
+        num_workers=int(opt.workers), worker_init_fn=lmdb_worker_init_fn,
         collate_fn=AlignCollate_valid, pin_memory=True)
     print('-' * 80)
 
@@ -87,6 +150,13 @@ def train(opt):
         converter = AttnLabelConverter(opt.character)
     opt.num_class = len(converter.character)
 
+    if opt.valid_cache != 'None':
+        assert not opt.variable_width, 'the validation cache needs fixed size batches'
+        # validation set is fixed: decode, resize and encode it only once.
+        valid_loader = ResidentDataset(valid_loader, dtype=opt.valid_cache, converter=converter,
+                                       batch_max_length=opt.batch_max_length, mmap_path=opt.valid_cache_mmap)
+        print('-' * 80)
+
     if opt.rgb:
         opt.input_channel = 3
     model = Model(opt)
@@ -108,17 +178,25 @@ def train(opt):
             if 'weight' in name:
                 param.data.fill_(1)
             continue
+    if opt.checkpoint_layers > 0:
+        assert 'Transformer' in opt.SequenceModeling, '--checkpoint_layers applies to the Transformer layers'
+        model.SequenceModeling.set_checkpoint_layers(opt.checkpoint_layers)
 
     """ setup loss """
     if 'Transformer' in opt.SequenceModeling:
-        criterion = transformer_loss
+        criterion = partial(transformer_loss, smoothing=opt.label_smoothing)
+        train_criterion = partial(transformer_loss, smoothing=opt.label_smoothing, reduction='none')
     elif 'CTC' in opt.Prediction:
         criterion = torch.nn.CTCLoss(zero_infinity=True).cuda()
+        train_criterion = torch.nn.CTCLoss(zero_infinity=True, reduction='none').cuda()
     else:
         # ignore [GO] token = ignore index 0
         criterion = torch.nn.CrossEntropyLoss(ignore_index=0).cuda()
+        train_criterion = torch.nn.CrossEntropyLoss(ignore_index=0, reduction='none').cuda()
     # loss averager
     loss_avg = Averager()
+    # training batches are augmented on the GPU, after the copy
+    augment = BatchAugmentation(opt) if opt.augment else None
 
     # filter that only require gradient decent
     filtered_parameters = []
@@ -130,6 +208,7 @@ def train(opt):
     # [print(name, p.numel()) for name, p in filter(lambda p: p[1].requires_grad, model.named_parameters())]
 
     # setup optimizer
+    optimizer_schedule = None
     if opt.adam:
         optimizer = optim.Adam(filtered_parameters,
                                lr=opt.lr, betas=(opt.beta1, 0.999))
@@ -195,123 +274,146 @@ def train(opt):
             best_accuracy = checkpoint['best_accuracy']
         if 'best_norm_ED' in checkpoint.keys():
             best_norm_ED = checkpoint['best_norm_ED']
+        if 'sampler' in checkpoint.keys():
+            train_dataset.load_state_dict(checkpoint['sampler'])
         del checkpoint
         torch.cuda.empty_cache()
     # data parallel for multi-GPU
     model = torch.nn.DataParallel(model).cuda()
     model.train()
     print("Model size:", count_num_param(model), 'M')
-    if 'Transformer' in opt.SequenceModeling and opt.use_scheduled_optim:
-        optimizer.n_current_steps = start_iter
-
-    for i in tqdm(range(start_iter, opt.num_iter)):
-        for p in model.parameters():
-            p.requires_grad = True
-
-        cpu_images, cpu_texts = train_dataset.get_batch()
-        image = cpu_images.cuda()
-        if 'Transformer' in opt.SequenceModeling:
-            text, length, text_pos = converter.encode(
-                cpu_texts, opt.batch_max_length)
-        elif 'CTC' in opt.Prediction:
-            text, length = converter.encode(cpu_texts)
-        else:
-            text, length = converter.encode(cpu_texts, opt.batch_max_length)
-        batch_size = image.size(0)
-
-        if 'Transformer' in opt.SequenceModeling:
-            preds = model(image, text, tgt_pos=text_pos)
-            target = text[:, 1:]  # without <s> Symbol
-            cost = criterion(
-                preds.view(-1, preds.shape[-1]), target.contiguous().view(-1))
-        elif 'CTC' in opt.Prediction:
-            preds = model(image, text).log_softmax(2)
-            preds_size = torch.IntTensor([preds.size(1)] * batch_size)
-            preds = preds.permute(1, 0, 2)  # to use CTCLoss format
-            cost = criterion(preds, text, preds_size, length)
-        else:
-            preds = model(image, text)
-            target = text[:, 1:]  # without [GO] Symbol
-            cost = criterion(
-                preds.view(-1, preds.shape[-1]), target.contiguous().view(-1))
-
-        model.zero_grad()
-        cost.backward()
-
-        if 'Transformer' in opt.SequenceModeling and opt.use_scheduled_optim:
-            optimizer_schedule.step_and_update_lr()
-        elif 'Transformer' in opt.SequenceModeling:
-            optimizer.step()
-        else:
-            # gradient clipping with 5 (Default)
-            torch.nn.utils.clip_grad_norm_(model.parameters(), opt.grad_clip)
-            optimizer.step()
-
-        loss_avg.add(cost)
-
-        # validation part
-        if i > 0 and (i+1) % opt.valInterval == 0:
-            elapsed_time = time.time() - start_time
-            print(
-                f'[{i+1}/{opt.num_iter}] Loss: {loss_avg.val():0.5f} elapsed_time: {elapsed_time:0.5f}')
-            # for log
-            with open(f'./saved_models/{opt.experiment_name}/log_train.txt', 'a') as log:
-                log.write(
-                    f'[{i+1}/{opt.num_iter}] Loss: {loss_avg.val():0.5f} elapsed_time: {elapsed_time:0.5f}\n')
-                loss_avg.reset()
-
-                model.eval()
-                with torch.no_grad():
-                    valid_loss, current_accuracy, current_norm_ED, preds, gts, infer_time, length_of_data = validation(
-                        model, criterion, valid_loader, converter, opt)
-                model.train()
-
-                for pred, gt in zip(preds[:5], gts[:5]):
-                    if 'Transformer' in opt.SequenceModeling:
-                        pred = pred[:pred.find('</s>')]
-                        gt = gt[:gt.find('</s>')]
-                    elif 'Attn' in opt.Prediction:
-                        pred = pred[:pred.find('[s]')]
-                        gt = gt[:gt.find('[s]')]
-                    
-                    print(f'{pred:20s}, gt: {gt:20s},   {str(pred == gt)}')
+    if optimizer_schedule is not None:
+        # iterations are optimizer steps, so the warmup counts effective batches.
+        optimizer_schedule.n_current_steps = start_iter
+
+    # checkpoints are snapshotted to host memory and written by a background thread with --async_checkpoint.
+    checkpointer = CheckpointWriter(keep_last=opt.keep_checkpoints, asynchronous=opt.async_checkpoint)
+    # per step loss / accuracy stay on the GPU, every log_interval steps they are written by a background thread.
+    metrics = None
+    if opt.log_interval > 0:
+        metrics = TrainMetrics(f'./saved_models/{opt.experiment_name}', interval=opt.log_interval,
+                               formats=opt.metrics_format.split(','), tensorboard=opt.tensorboard)
+
+    # the pending checkpoints and metrics records are written even when training fails
+    try:
+        interval_start_time, interval_start_iter = time.time(), start_iter
+        for i in tqdm(range(start_iter, opt.num_iter)):
+            if opt.curriculum_iters > 0:
+                # the longest sampled label grows linearly to batch_max_length over curriculum_iters
+                progress = min(i / opt.curriculum_iters, 1.0)
+                max_length = opt.curriculum_start + (opt.batch_max_length - opt.curriculum_start) * progress
+                train_dataset.set_max_length(round(max_length))
+            for p in model.parameters():
+                p.requires_grad = True
+
+            # one iteration is one optimizer step over opt.accum_steps micro-batches.
+            model.zero_grad()
+            for micro_step in range(opt.accum_steps):
+                # DistributedDataParallel only needs to all-reduce the gradients of the last micro-batch.
+                last_micro_step = micro_step == opt.accum_steps - 1
+                no_sync = getattr(model, 'no_sync', None)
+                data_start_time = time.time()
+                batch = train_dataset.get_batch()
+                if metrics is not None:
+                    metrics.add_data_time(time.time() - data_start_time)
+                with nullcontext() if last_micro_step or no_sync is None else no_sync():
+                    cost, sample_losses = forward_batch(
+                        model, train_criterion, converter, batch, opt, augment, metrics)
+                    (cost / opt.accum_steps).backward()
+                train_dataset.update_losses(sample_losses)
+                loss_avg.add(cost)
+
+            if optimizer_schedule is not None:
+                optimizer_schedule.step_and_update_lr()
+            elif 'Transformer' in opt.SequenceModeling:
+                optimizer.step()
+            else:
+                # gradient clipping with 5 (Default)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), opt.grad_clip)
+                optimizer.step()
+            if metrics is not None:
+                metrics.step(i, lr=optimizer.param_groups[0]['lr'])
+
+            # validation part
+            if i > 0 and (i+1) % opt.valInterval == 0:
+                validation_start_time = time.time()
+                elapsed_time = validation_start_time - start_time
+                # training step time (without validation) against the peak memory, e.g. to size --checkpoint_layers
+                step_time = (time.time() - interval_start_time) / (i + 1 - interval_start_iter)
+                peak_memory = torch.cuda.max_memory_allocated() / 2**20
+                memory_log = f'step_time: {step_time * 1000:0.1f}ms peak_memory: {peak_memory:0.0f}MiB'
+                # the loss sum stays on the device between intervals, it is read once here
+                train_loss = float(loss_avg.val())
+                print(
+                    f'[{i+1}/{opt.num_iter}] Loss: {train_loss:0.5f} elapsed_time: {elapsed_time:0.5f} {memory_log}')
+                # for log
+                with open(f'./saved_models/{opt.experiment_name}/log_train.txt', 'a') as log:
                     log.write(
-                        f'{pred:20s}, gt: {gt:20s},   {str(pred == gt)}\n')
-
-                valid_log = f'[{i+1}/{opt.num_iter}] valid loss: {valid_loss:0.5f}'
-                valid_log += f' accuracy: {current_accuracy:0.3f}, norm_ED: {current_norm_ED:0.2f}'
-                print(valid_log)
-                log.write(valid_log + '\n')
-
-                # keep best accuracy model
-                if current_accuracy > best_accuracy:
-                    best_accuracy = current_accuracy
-                    state_dict = model.module.state_dict()
-                    save_checkpoint({'best_accuracy': best_accuracy,
-                                     'state_dict': state_dict,
-                                     }, False, f'./saved_models/{opt.experiment_name}/best_accuracy.pth')
-                if current_norm_ED < best_norm_ED:
-                    best_norm_ED = current_norm_ED
-                    state_dict = model.module.state_dict()
-                    save_checkpoint({'best_norm_ED': best_norm_ED,
-                                     'state_dict': state_dict,
-                                     }, False, f'./saved_models/{opt.experiment_name}/best_norm_ED.pth')
-                    # torch.save(
-                    #     model.state_dict(), f'./saved_models/{opt.experiment_name}/best_norm_ED.pth')
-                best_model_log = f'best_accuracy: {best_accuracy:0.3f}, best_norm_ED: {best_norm_ED:0.2f}'
-                print(best_model_log)
-                log.write(best_model_log + '\n')
-
-        # save model per 1000 iter.
-        if (i + 1) % 1000 == 0:
-            state_dict = model.module.state_dict()
-            optimizer_state_dict = optimizer.state_dict()
-            save_checkpoint({'state_dict': state_dict,
-                             'optimizer': optimizer_state_dict,
-                             'step': i,
-                             'best_accuracy': best_accuracy,
-                             'best_norm_ED': best_norm_ED,
-                             }, False, f'./saved_models/{opt.experiment_name}/iter_{i+1}.pth')
+                        f'[{i+1}/{opt.num_iter}] Loss: {train_loss:0.5f} elapsed_time: {elapsed_time:0.5f} {memory_log}\n')
+                    loss_avg.reset()
+
+                    model.eval()
+                    with torch.no_grad():
+                        valid_loss, current_accuracy, current_norm_ED, preds, gts, infer_time, length_of_data = validation(
+                            model, criterion, valid_loader, converter, opt)
+                    model.train()
+
+                    for pred, gt in zip(preds[:5], gts[:5]):
+                        if 'Transformer' in opt.SequenceModeling:
+                            pred = pred[:pred.find('</s>')]
+                            gt = gt[:gt.find('</s>')]
+                        elif 'Attn' in opt.Prediction:
+                            pred = pred[:pred.find('[s]')]
+                            gt = gt[:gt.find('[s]')]
+                    
+                        print(f'{pred:20s}, gt: {gt:20s},   {str(pred == gt)}')
+                        log.write(
+                            f'{pred:20s}, gt: {gt:20s},   {str(pred == gt)}\n')
+
+                    valid_log = f'[{i+1}/{opt.num_iter}] valid loss: {valid_loss:0.5f}'
+                    valid_log += f' accuracy: {current_accuracy:0.3f}, norm_ED: {current_norm_ED:0.2f}'
+                    print(valid_log)
+                    log.write(valid_log + '\n')
+
+                    # keep best accuracy model
+                    if current_accuracy > best_accuracy:
+                        best_accuracy = current_accuracy
+                        state_dict = model.module.state_dict()
+                        checkpointer.save({'best_accuracy': best_accuracy,
+                                           'state_dict': state_dict,
+                                           }, False, f'./saved_models/{opt.experiment_name}/best_accuracy.pth')
+                    if current_norm_ED < best_norm_ED:
+                        best_norm_ED = current_norm_ED
+                        state_dict = model.module.state_dict()
+                        checkpointer.save({'best_norm_ED': best_norm_ED,
+                                           'state_dict': state_dict,
+                                           }, False, f'./saved_models/{opt.experiment_name}/best_norm_ED.pth')
+                        # torch.save(
+                        #     model.state_dict(), f'./saved_models/{opt.experiment_name}/best_norm_ED.pth')
+                    best_model_log = f'best_accuracy: {best_accuracy:0.3f}, best_norm_ED: {best_norm_ED:0.2f}'
+                    print(best_model_log)
+                    log.write(best_model_log + '\n')
+                torch.cuda.reset_peak_memory_stats()
+                interval_start_time, interval_start_iter = time.time(), i + 1
+                if metrics is not None:
+                    # the throughput and data wait of the next record only count the training steps
+                    metrics.exclude_time(interval_start_time - validation_start_time)
+
+            # save model per 1000 iter.
+            if (i + 1) % 1000 == 0:
+                state_dict = model.module.state_dict()
+                optimizer_state_dict = optimizer.state_dict()
+                checkpointer.save({'state_dict': state_dict,
+                                   'optimizer': optimizer_state_dict,
+                                   'step': i,
+                                   'best_accuracy': best_accuracy,
+                                   'best_norm_ED': best_norm_ED,
+                                   'sampler': train_dataset.state_dict(),
+                                   }, False, f'./saved_models/{opt.experiment_name}/iter_{i+1}.pth', rotate=True)
+    finally:
+        checkpointer.close()
+        if metrics is not None:
+            metrics.close()
 
 
 if __name__ == '__main__':
@@ -326,16 +428,30 @@ if __name__ == '__main__':
                         default=1111, help='for random seed setting')
     parser.add_argument('--workers', type=int,
                         help='number of data loading workers', default=4)
+    parser.add_argument('--decode_threads', type=int, default=2, help='image decoding threads per data loading worker, 1 decodes serially')
     parser.add_argument('--batch_size', type=int,
                         default=196, help='input batch size')
     parser.add_argument('--num_iter', type=int, default=300000,
                         help='number of iterations to train for')
     parser.add_argument('--valInterval', type=int, default=1000,
                         help='Interval between each validation')
+    parser.add_argument('--checkpoint_layers', type=int, default=0,
+                        help='recompute the activations of the first N Transformer encoder and decoder layers in backward')
+    parser.add_argument('--accum_steps', type=int, default=1,
+                        help='micro-batches accumulated per optimizer step, an iteration is one optimizer step')
     parser.add_argument('--continue_model', default='',
                         help="path to model to continue training")
     parser.add_argument('--load_weights', default='',
                         help="path to model to load pretrain")
+    parser.add_argument('--async_checkpoint', action='store_true',
+                        help='write checkpoints on a background thread instead of stalling training')
+    parser.add_argument('--keep_checkpoints', type=int, default=0,
+                        help='number of recent iter_*.pth checkpoints to keep, 0 keeps all')
+    parser.add_argument('--log_interval', type=int, default=0,
+                        help='interval of the training metrics (loss, accuracy, throughput) records, 0 disables them. '
+                             'The accuracy adds an argmax per batch on the device')
+    parser.add_argument('--metrics_format', type=str, default='jsonl', help='comma separated metrics logs: jsonl,csv')
+    parser.add_argument('--tensorboard', action='store_true', help='write the training metrics to TensorBoard as well')
     parser.add_argument('--adam', action='store_true',
                         help='Whether to use adam (default is Adadelta)')
     parser.add_argument('--lr', type=float, default=1,
@@ -368,6 +484,34 @@ if __name__ == '__main__':
                         help='for sensitive character mode')
     parser.add_argument('--PAD', action='store_true',
                         help='whether to keep ratio then pad for image resize')
+    parser.add_argument('--variable_width', action='store_true',
+                        help='keep the ratio of each image up to imgW and pad per batch, masking the padding (Transformer)')
+    parser.add_argument('--augment', action='store_true', help='augment the training batches on the GPU')
+    parser.add_argument('--aug_prob', type=float, default=0.5, help='probability of each augmentation per sample')
+    parser.add_argument('--aug_seed', type=int, default=-1, help='seed of the augmentation, -1 uses manualSeed')
+    parser.add_argument('--aug_rotate', type=float, default=5, help='maximum rotation in degrees')
+    parser.add_argument('--aug_perspective', type=float, default=0.2,
+                        help='maximum relative change of the text height from one end to the center')
+    parser.add_argument('--aug_stretch', type=float, default=0.5,
+                        help='local horizontal stretch, 1 moves the inner fiducial points by up to 0.45 of their spacing')
+    parser.add_argument('--aug_blur', type=float, default=1.0, help='maximum sigma of the gaussian blur in pixels')
+    parser.add_argument('--aug_noise', type=float, default=0.05, help='maximum std of the gaussian noise')
+    parser.add_argument('--aug_contrast', type=float, default=0.3, help='maximum relative change of the contrast')
+    parser.add_argument('--hard_sampling', action='store_true',
+                        help='sample the training data of every source proportionally to its recent loss')
+    parser.add_argument('--hard_alpha', type=float, default=1.0, help='sampling probability is proportional to loss ** hard_alpha')
+    parser.add_argument('--hard_uniform', type=float, default=0.2,
+                        help='share of every batch still sampled uniformly with --hard_sampling')
+    parser.add_argument('--token_budget', type=int, default=0,
+                        help='size the batches by tokens (longest label + widest image, see TokenBudgetBatchSampler) '
+                             'instead of batch_size, e.g. batch_size * 2 * (batch_max_length + 1). 0 is off')
+    parser.add_argument('--curriculum_iters', type=int, default=0,
+                        help='grow the longest sampled label from curriculum_start to batch_max_length over this many iterations')
+    parser.add_argument('--curriculum_start', type=int, default=5, help='longest sampled label at the start of the curriculum')
+    parser.add_argument('--valid_cache', type=str, default='None',
+                        help='keep the preprocessed validation set resident in memory. None|uint8|fp16')
+    parser.add_argument('--valid_cache_mmap', type=str, default='',
+                        help='memory-mapped file backing the validation cache instead of pinned host memory')
     """ Model Architecture """
     parser.add_argument('--Transformation', type=str,
                         required=False, help='Transformation stage. None|TPS')
@@ -385,6 +529,7 @@ if __name__ == '__main__':
                         help='the number of output channel of Feature extractor')
     parser.add_argument('--hidden_size', type=int, default=256,
                         help='the size of the LSTM hidden state')
+    parser.add_argument('--channels_last', action='store_true', help='run the convolutional stages in channels_last')
     """ Transformer """
     parser.add_argument('-d_word_vec', type=int, default=512)
     parser.add_argument('-d_model', type=int, default=512)
@@ -398,6 +543,10 @@ if __name__ == '__main__':
     parser.add_argument('-n_warmup_steps', type=int, default=16000)
 
     parser.add_argument('-dropout', type=float, default=0.1)
+    parser.add_argument('--decode_mode', type=str, default='greedy', help='Transformer decoding: greedy | parallel')
+    parser.add_argument('--refine_iters', type=int, default=2,
+                        help='refinement passes that re-feed the predictions in parallel decoding')
+    parser.add_argument('--label_smoothing', action='store_true', help='smooth the Transformer targets with eps 0.1')
     parser.add_argument('-embs_share_weight', action='store_true')
     parser.add_argument('-proj_share_weight', action='store_true')
     parser.add_argument('-use_scheduled_optim', action='store_true')
@@ -52,12 +52,14 @@ class CTCLabelConverter(object):
 class AttnLabelConverter(object):
     """ Convert between text-label and text-index """
 
-    def __init__(self, character):
+    def __init__(self, character, device='cuda'):
         # character (str): set of the possible characters.
         # [GO] for the start token of the attention decoder. [s] for end-of-sentence token.
+        # device: where encode puts the text-index.
         list_token = ['[GO]', '[s]']  # ['[s]','[UNK]','[PAD]','[GO]']
         list_character = list(character)
         self.character = list_token + list_character
+        self.device = device
 
         self.dict = {}
         for i, char in enumerate(self.character):
@@ -79,13 +81,14 @@ class AttnLabelConverter(object):
         # batch_max_length = max(length) # this is not allowed for multi-gpu setting
         batch_max_length += 1
         # additional +1 for [GO] at first step. batch_text is padded with [GO] token after [s] token.
-        batch_text = torch.cuda.LongTensor(len(text), batch_max_length + 1).fill_(0)
+        # filled on the host and copied to self.device once
+        batch_text = torch.LongTensor(len(text), batch_max_length + 1).fill_(0)
         for i, t in enumerate(text):
             text = list(t)
             text.append('[s]')
             text = [self.dict[char] for char in text]
-            batch_text[i][1:1 + len(text)] = torch.cuda.LongTensor(text)  # batch_text[:, 0] = [GO] token
-        return (batch_text, torch.cuda.IntTensor(length))
+            batch_text[i][1:1 + len(text)] = torch.LongTensor(text)  # batch_text[:, 0] = [GO] token
+        return (batch_text.to(self.device), torch.IntTensor(length).to(self.device))
 
     def decode(self, text_index, length):
         """ convert text-index into text-label. """
@@ -98,14 +101,16 @@ class AttnLabelConverter(object):
 class TransformerLabelConverter(object):
     """ Convert between text-label and text-index """
     # PAD = 2 BOS = 0 EOS = 1 PAD_WORD = '<blank>' BOS_WORD = '<s>' EOS_WORD = '</s>'
-    def __init__(self, character):
+    def __init__(self, character, device='cuda'):
         # character (str): set of the possible characters.
         # [GO] for the start token of the attention decoder. [s] for end-of-sentence token.
         # ['[s]','[UNK]','[PAD]','[GO]']
+        # device: where encode puts the text-index.
         list_token = ['<s>', '</s>','<blank>']
         self.value_token={'BOS':0,'EOS':1,'<PAD>':2}
         list_character = list(character)
         self.character = list_token + list_character
+        self.device = device
 
         self.dict = {}
         for i, char in enumerate(self.character):
@@ -127,9 +132,10 @@ class TransformerLabelConverter(object):
         # batch_max_length = max(length) # this is not allowed for multi-gpu setting
         batch_max_length += 1  # +1 for <s>
         # additional +1 for <s> at first step. batch_text is padded with <blank> token after </s> token.
-        batch_text = torch.cuda.LongTensor(
+        # filled on the host and copied to self.device once
+        batch_text = torch.LongTensor(
             len(text), batch_max_length + 1).fill_(self.value_token['<PAD>'])  # +1 more for </s>
-        text_pos = torch.cuda.LongTensor(
+        text_pos = torch.LongTensor(
             len(text), batch_max_length + 1).fill_(0)
         for i, t in enumerate(text):
             text = list(t)
@@ -137,9 +143,9 @@ class TransformerLabelConverter(object):
             text.append('</s>')
             text = [self.dict[char] for char in text]
             # batch_text[:, 0] = <s> token
-            batch_text[i][0:len(text)] = torch.cuda.LongTensor(text)
-            text_pos[i][0:len(text)] = torch.cuda.LongTensor(list(range(1,len(text)+1)))
-        return (batch_text, torch.cuda.IntTensor(length),text_pos)
+            batch_text[i][0:len(text)] = torch.LongTensor(text)
+            text_pos[i][0:len(text)] = torch.LongTensor(list(range(1,len(text)+1)))
+        return (batch_text.to(self.device), torch.IntTensor(length).to(self.device), text_pos.to(self.device))
 
     def decode(self, text_index, length):
         """ convert text-index into text-label. """